@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""
+Compiled execution of larch code.
+
+A parsed larch module is checked against the nodes supported by the
+Interpreter, and the statements that can be are translated into Python
+code objects.  These run with a namespace that looks up, sets, and deletes
+names through the SymbolTable, so that the usual larch search groups
+apply.  Statements with larch-specific behavior (procedure definitions,
+imports, try/except, print, ...) are left to the Interpreter.
+"""
+from __future__ import division, print_function
+import __future__
+import ast
+import copy
+import sys
+import numpy
+import six
+
+# nodes that the Interpreter supports, but that must be run by the
+# Interpreter because larch gives them a different meaning than Python
+INTERPRETED_NODES = ('arg', 'excepthandler', 'functiondef', 'import',
+                     'importfrom', 'interrupt', 'print', 'raise', 'return',
+                     'try', 'tryexcept')
+
+# AST nodes that are not run by any Interpreter handler, but appear as
+# parts of supported nodes
+HELPER_NODES = (ast.expr_context, ast.operator, ast.boolop, ast.cmpop,
+                ast.unaryop, ast.comprehension, ast.keyword)
+
+CALL_HELPER = '__larch_call__'
+FIX_HELPER = '__larch_fix__'
+
+class CompiledAbort(Exception):
+    """raised to stop compiled code when a larch error has been recorded"""
+    pass
+
+def fix_output(out):
+    """fix up the result of a calculation, as the Interpreter does for each
+    node:  for some cases (especially when using Parameter objects), a
+    calculation returns an otherwise numeric array, but with dtype
+    'object'.  fix here, trying (float, complex, list).  Enumeration
+    objects are also list-ified."""
+    if isinstance(out, numpy.ndarray):
+        if out.dtype == numpy.object:
+            try:
+                out = out.astype(float)
+            except TypeError:
+                try:
+                    out = out.astype(complex)
+                except TypeError:
+                    out = list(out)
+    if isinstance(out, enumerate):
+        out = list(out)
+    return out
+
+class CompiledNamespace(dict):
+    """namespace for running compiled larch code, used as both globals
+    and locals:  names are looked up, set, and deleted with the
+    SymbolTable.  The dict itself holds only __builtins__ (empty, so that
+    all builtins come from the larch search groups) and the helper
+    functions used by compiled code."""
+    def __init__(self, larch):
+        dict.__init__(self)
+        self.symtable = larch.symtable
+        dict.__setitem__(self, '__builtins__', {})
+
+        def call(func, *args, **kws):
+            "call a function, stopping if it recorded a larch error"
+            out = func(*args, **kws)
+            if len(larch.error) > 0:
+                raise CompiledAbort()
+            return out
+        dict.__setitem__(self, CALL_HELPER, call)
+        dict.__setitem__(self, FIX_HELPER, fix_output)
+
+    def __getitem__(self, name):
+        if dict.__contains__(self, name):
+            return dict.__getitem__(self, name)
+        try:
+            return self.symtable.get_symbol(name)
+        except (NameError, LookupError):
+            raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        self.symtable.set_symbol(name, value=value)
+
+    def __delitem__(self, name):
+        try:
+            self.symtable.del_symbol(name)
+        except (NameError, LookupError):
+            raise KeyError(name)
+
+class _Transformer(ast.NodeTransformer):
+    """rewrite a larch AST for compilation:
+       - function calls go through CALL_HELPER, so that errors recorded
+         by larch procedures and plugins stop the compiled code.
+       - assigned values go through FIX_HELPER, as the Interpreter would
+         do for each node.
+       - augmented assignments become assignments, as in the Interpreter.
+    """
+    def _helper(self, name, node, *args):
+        return ast.copy_location(
+            ast.Call(func=ast.Name(id=name, ctx=ast.Load()),
+                     args=list(args), keywords=[]), node)
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        node.args = [node.func] + node.args
+        node.func = ast.Name(id=CALL_HELPER, ctx=ast.Load())
+        return node
+
+    def visit_Assign(self, node):
+        self.generic_visit(node)
+        node.value = self._helper(FIX_HELPER, node.value, node.value)
+        return node
+
+    def visit_AugAssign(self, node):
+        self.generic_visit(node)
+        target = copy.deepcopy(node.target)
+        target.ctx = ast.Load()
+        value = ast.copy_location(ast.BinOp(left=target, op=node.op,
+                                            right=node.value), node)
+        return ast.copy_location(
+            ast.Assign(targets=[node.target],
+                       value=self._helper(FIX_HELPER, value, value)), node)
+
+def can_compile(node, supported_nodes, unsafe_attrs=()):
+    """return whether an AST statement can be compiled: all nodes must be
+    supported by the Interpreter and not need larch-specific handling,
+    and no names or attributes may be private or unsafe."""
+    for tnode in ast.walk(node):
+        if isinstance(tnode, HELPER_NODES):
+            continue
+        nodename = tnode.__class__.__name__.lower()
+        if nodename not in supported_nodes or nodename in INTERPRETED_NODES:
+            return False
+        if isinstance(tnode, ast.Name) and tnode.id.startswith('__'):
+            return False
+        if isinstance(tnode, ast.Attribute) and (tnode.attr in unsafe_attrs
+                                                 or tnode.attr.startswith('__')):
+            return False
+    return True
+
+def _compile(node, fname, mode):
+    "compile a transformed AST with true division"
+    node = ast.fix_missing_locations(node)
+    return compile(node, fname or '<larch>', mode,
+                   __future__.division.compiler_flag, True)
+
+class CompiledBlock(object):
+    """a parsed larch module, with runs of statements that can be compiled
+    held as Python code objects, and other statements held as AST nodes
+    for the Interpreter.
+
+    If the last statement is an expression, it is compiled in 'eval' mode
+    so that its value is returned, as for Interpreter.run()
+    """
+    def __init__(self, node, supported_nodes, unsafe_attrs=(), fname=None):
+        self.fname = fname
+        self.segments = []
+        body = list(node.body)
+        pending = []
+        for i, stmt in enumerate(body):
+            if not can_compile(stmt, supported_nodes, unsafe_attrs):
+                self._add_code(pending)
+                pending = []
+                self.segments.append(('node', stmt, stmt))
+            elif i == len(body)-1 and isinstance(stmt, ast.Expr):
+                self._add_code(pending)
+                pending = []
+                expr = _Transformer().visit(copy.deepcopy(stmt)).value
+                expr = ast.Expression(body=expr)
+                self.segments.append(('eval', _compile(expr, fname, 'eval'),
+                                      stmt))
+            else:
+                pending.append(stmt)
+        self._add_code(pending)
+
+    def _add_code(self, stmts):
+        if len(stmts) == 0:
+            return
+        trans = _Transformer()
+        module = ast.parse('')
+        module.body = [trans.visit(copy.deepcopy(s)) for s in stmts]
+        code = _compile(module, self.fname, 'exec')
+        self.segments.append(('exec', code, stmts[0]))
+
+    @property
+    def ncompiled(self):
+        "number of compiled segments"
+        return len([s for s in self.segments if s[0] != 'node'])
+
+    def run(self, larch, namespace, expr=None, fname=None, lineno=0):
+        """run the block with an Interpreter and CompiledNamespace,
+        returning the value of the last statement"""
+        out = None
+        for kind, code, node in self.segments:
+            if kind == 'node':
+                out = larch.run(node, expr=expr, fname=fname, lineno=lineno)
+                if len(larch.error) > 0:
+                    return None
+                continue
+            try:
+                if kind == 'eval':
+                    out = fix_output(eval(code, namespace, namespace))
+                else:
+                    six.exec_(code, namespace, namespace)
+                    out = None
+            except CompiledAbort:
+                return None
+            except:
+                # report the line of the innermost compiled frame
+                tb = sys.exc_info()[2]
+                errline = node.lineno
+                while tb is not None:
+                    if tb.tb_frame.f_code.co_filename == code.co_filename:
+                        errline = tb.tb_lineno
+                    tb = tb.tb_next
+                larch.raise_exception(node, expr=expr, fname=fname,
+                                      lineno=lineno + errline - 1)
+                return None
+        return out
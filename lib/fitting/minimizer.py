@@ -327,10 +327,18 @@ or set  leastsq_kws['maxfev']  to increase this maximum."""
     def __jacobian(self, fvars):
         """
         analytical jacobian to be used with the Levenberg-Marquardt
+
+        The user-supplied function gives derivatives with respect to the
+        parameter values.  These are scaled here to derivatives with respect
+        to the internal values of the fitted variables.
         """
         # computing the jacobian
         self.__update_params(fvars)
-        return self.jacfcn(self.paramgroup, *self.userargs, **self.userkws)
+        jac = self.jacfcn(self.paramgroup, *self.userargs, **self.userkws)
+        group = self.paramgroup
+        grad = [getattr(group, name).scale_gradient(val)
+                for name, val in zip(self.var_names, fvars)]
+        return asarray(jac) * array(grad)
 
 
     def prepare_fit(self, force=False):
@@ -378,6 +386,15 @@ or set  leastsq_kws['maxfev']  to increase this maximum."""
         This wraps scipy.optimize.leastsq, and keyward arguments are passed
         directly as options to scipy.optimize.leastsq
 
+        If Dfun is given, it is called with the same arguments as the
+        objective function, and must return the derivatives of the residual
+        with respect to the values of the variable Parameters, as an array
+        of shape (npts, nvarys).  For Parameters with bounds, these are
+        scaled here to derivatives with respect to the internal variables
+        used in the fit.  Note that earlier versions passed the result of
+        Dfun to scipy.optimize.leastsq unchanged, so a Dfun that already
+        applies this scaling for bounded Parameters must no longer do so.
+
         When possible, this calculates the estimated uncertainties and
         variable correlations from the covariance matrix.
 
@@ -1,10 +1,151 @@
-from numpy import arcsin, cos, inf, nan, sin, sqrt
+from __future__ import division
+import __future__
+import ast
+import copy
 import json
+import numbers
+import numpy
+from numpy import arcsin, cos, inf, nan, sin, sqrt
 from ..larchlib import isNamedClass
 
 # use local version of uncertainties package
 from . import uncertainties
 
+# AST nodes allowed in compiled constraint expressions, by lower-case name.
+# Anything else (and any private attribute) leaves the expression to the
+# larch interpreter.
+COMPILED_NODES = ('expression', 'expr', 'binop', 'unaryop', 'boolop',
+                  'compare', 'call', 'keyword', 'name', 'attribute',
+                  'num', 'str', 'nameconstant', 'constant', 'tuple',
+                  'list', 'subscript', 'index', 'slice', 'extslice',
+                  'ifexp', 'load')
+
+# builtin functions that are known to depend only on their arguments.
+# numpy ufuncs are also taken to be pure.  Other builtins may not be
+# (numpy.random.normal, for example), so are not in this list.
+PURE_BUILTINS = (abs, min, max, round, pow, divmod, float, int, complex,
+                 bool)
+_PURE_BUILTIN_IDS = set([id(func) for func in PURE_BUILTINS])
+
+def _is_pure(func):
+    "return whether a function depends only on its arguments"
+    return (isinstance(func, numpy.ufunc) or
+            id(func) in _PURE_BUILTIN_IDS)
+
+def _dotted_name(node):
+    "dotted name for a Name or chain of Attributes of a Name, or None"
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    parts.append(node.id)
+    return '.'.join(reversed(parts))
+
+class _SymbolCollector(ast.NodeTransformer):
+    """replace each symbol name (possibly dotted) in an expression
+    with a local variable, recording the symbol names"""
+    def __init__(self):
+        self.symbols = []
+        self.functions = []
+
+    def _replace(self, node, is_function=False):
+        name = _dotted_name(node)
+        if name is None:
+            return self.generic_visit(node)
+        if name not in self.symbols:
+            self.symbols.append(name)
+        isym = self.symbols.index(name)
+        if is_function and isym not in self.functions:
+            self.functions.append(isym)
+        return ast.copy_location(ast.Name(id='_sym%i' % isym,
+                                          ctx=ast.Load()), node)
+
+    visit_Name = _replace
+    visit_Attribute = _replace
+
+    def visit_Call(self, node):
+        node.func = self._replace(node.func, is_function=True)
+        node.args = [self.visit(arg) for arg in node.args]
+        node.keywords = [self.visit(key) for key in node.keywords]
+        return node
+
+class CompiledExpr(object):
+    """a constraint expression compiled to a Python code object.
+
+    Symbol names are resolved with the larch symbol table at each
+    evaluation, and Parameters are replaced by their values.  When all
+    symbols resolve to scalar values and only pure functions are called,
+    the result is kept, and the expression is only re-evaluated when
+    one of these values has changed.
+    """
+    def __init__(self, code, symbols, functions):
+        self.code = code
+        self.symbols = symbols
+        self.functions = functions
+        self._inputs = None
+        self._result = None
+
+    def eval(self, symtable):
+        "evaluate expression with symbols from symtable"
+        get_symbol = symtable.get_symbol
+        names = {}
+        inputs = []
+        cacheable = True
+        for isym, name in enumerate(self.symbols):
+            val = get_symbol(name)
+            if isym in self.functions:
+                cacheable = cacheable and _is_pure(val)
+                inputs.append(id(val))
+            else:
+                val = param_value(val)
+                cacheable = cacheable and isinstance(val, numbers.Number)
+                inputs.append(val)
+            names['_sym%i' % isym] = val
+        if cacheable and inputs == self._inputs:
+            return self._result
+
+        result = eval(self.code, {'__builtins__': {}}, names)
+        if (isinstance(result, numpy.ndarray) and
+            result.dtype == numpy.object):
+            result = result.astype(float)
+        self._inputs = inputs if cacheable else None
+        self._result = result
+        return result
+
+def compile_expr(tree):
+    """compile parsed larch expression (Module from Interpreter.parse())
+    to a CompiledExpr, or return None if it cannot be compiled"""
+    if (not isinstance(tree, ast.Module) or len(tree.body) != 1 or
+        not isinstance(tree.body[0], ast.Expr)):
+        return None
+    from ..interpreter import UNSAFE_ATTRS
+    for node in ast.walk(tree.body[0]):
+        if isinstance(node, (ast.operator, ast.unaryop, ast.cmpop,
+                             ast.boolop)):
+            continue
+        if node.__class__.__name__.lower() not in COMPILED_NODES:
+            return None
+        if (isinstance(node, ast.Attribute) and
+            (node.attr in UNSAFE_ATTRS or node.attr.startswith('__'))):
+            return None
+        if isinstance(node, ast.Name) and node.id.startswith('_sym'):
+            return None
+        if isinstance(node, ast.Call) and (getattr(node, 'starargs', None)
+                                           or getattr(node, 'kwargs', None)):
+            return None
+
+    collector = _SymbolCollector()
+    body = collector.visit(copy.deepcopy(tree.body[0].value))
+    expr = ast.fix_missing_locations(ast.Expression(body=body))
+    try:
+        code = compile(expr, '<larch expr>', 'eval',
+                       __future__.division.compiler_flag, True)
+    except (SyntaxError, TypeError, ValueError):
+        return None
+    return CompiledExpr(code, collector.symbols, collector.functions)
+
 class Parameter(object):
     """returns a parameter object: a floating point value with bounds that can
     be flagged as a variable for a fit, or given an expression to use to
@@ -35,6 +176,7 @@ class Parameter(object):
         self.units = units
         self.decimals = decimals
         self._ast = None
+        self._compiled = None
         self._larch = None
         self._from_internal = lambda val: val
         if (hasattr(_larch, 'run') and
@@ -71,6 +213,7 @@ class Parameter(object):
     @expr.setter
     def expr(self, val):
         self._ast = None
+        self._compiled = None
         self._expr = val
 
     @property
@@ -97,8 +240,19 @@ class Parameter(object):
                 self._ast = self._larch.parse(self._expr)
                 if self._ast is None:
                     self._larch.writer.write(self.__invalid % self._expr)
+                self._compiled = compile_expr(self._ast)
             if self._ast is not None:
-                self._val = self._larch.run(self._ast, expr=self._expr)
+                evaluated = False
+                if self._compiled is not None:
+                    try:
+                        self._val = self._compiled.eval(self._larch.symtable)
+                        evaluated = True
+                    except Exception:
+                        # let the interpreter evaluate the expression
+                        # and report the error
+                        pass
+                if not evaluated:
+                    self._val = self._larch.run(self._ast, expr=self._expr)
                 # self._larch.symtable.save_frame()
                 # self._larch.symtable.restore_frame()
 
@@ -12,8 +12,10 @@ import sys
 import types
 import ast
 import math
+import hashlib
 import numpy
 import six
+from collections import OrderedDict
 
 from . import builtins
 from . import site_config
@@ -22,6 +24,7 @@ from .larchlib import (LarchExceptionHolder, ReturnedNone,
                        Procedure, StdWriter, enable_plugins)
 from .fitting  import isParameter
 from .utils import Closure
+from .astcompiler import CompiledBlock, CompiledNamespace, fix_output
 
 UNSAFE_ATTRS = ('__subclasses__', '__bases__', '__code__',
                 '__closure__', '__globals__', 'func_code',
@@ -65,6 +68,9 @@ PYTHON_RESERVED_WORDS = ('and', 'as', 'assert', 'break', 'class',
                          'not', 'or', 'pass', 'print', 'raise', 'return',
                          'try', 'while', 'with', 'yield')
 
+# maximum number of compiled blocks kept by an Interpreter
+COMPILE_CACHE_SIZE = 256
+
 class Interpreter:
     """larch program compiler and interpreter.
   This module compiles expressions and statements to AST representation,
@@ -78,6 +84,10 @@ class Interpreter:
       Exec, Lambda, Class, Global, Generators, Yield, Decorators
 
   In addition, Function is greatly altered so as to allow a Larch procedure.
+
+  With use_compiler=True (or by setting _sys.use_compiler), statements are
+  instead translated to Python code objects where possible, and cached.
+  See the astcompiler module.
   """
 
     supported_nodes = ('arg', 'assert', 'assign', 'attribute', 'augassign',
@@ -91,13 +101,17 @@ class Interpreter:
                        'str', 'subscript', 'try', 'tryexcept', 'tuple',
                        'unaryop', 'while')
 
-    def __init__(self, symtable=None, writer=None, with_plugins=True):
+    def __init__(self, symtable=None, writer=None, with_plugins=True,
+                 use_compiler=False):
         self.writer = writer or StdWriter()
         self.writer._larch = self
 
         if symtable is None:
             symtable = SymbolTable(larch=self)
         self.symtable   = symtable
+        self.symtable._sys.use_compiler = use_compiler
+        self.compiled_blocks = OrderedDict()
+        self._namespace = None
         self._interrupt = None
         self.error      = []
         self.expr       = None
@@ -251,20 +265,8 @@ class Interpreter:
         else:
             # for some cases (especially when using Parameter objects),
             # a calculation returns an otherwise numeric array, but with
-            # dtype 'object'. fix here, trying (float, complex, list).
-            if isinstance(out, numpy.ndarray):
-                if out.dtype == numpy.object:
-                    try:
-                        out = out.astype(float)
-                    except TypeError:
-                        try:
-                            out = out.astype(complex)
-                        except TypeError:
-                            out = list(out)
-            # enumeration objects are list-ified here...
-            if isinstance(out, enumerate):
-                out = list(out)
-            return out
+            # dtype 'object', and enumeration objects are list-ified.
+            return fix_output(out)
 
     def __call__(self, expr, **kw):
         return self.eval(expr, **kw)
@@ -274,6 +276,8 @@ class Interpreter:
         self.fname = fname
         self.lineno = lineno
         self.error = []
+        if getattr(self.symtable._sys, 'use_compiler', False):
+            return self.run_compiled(expr, fname=fname, lineno=lineno)
         try:
             node = self.parse(expr, fname=fname, lineno=lineno)
         except RuntimeError:
@@ -288,6 +292,49 @@ class Interpreter:
         except RuntimeError:
             return
 
+    def compile(self, expr, fname=None, lineno=0):
+        """parse and compile a block of larch text, returning a
+        CompiledBlock.  Compiled blocks are cached using a hash of the
+        text, the file name, and the modification time of the file."""
+        mtime = None
+        if fname is not None and os.path.isfile(fname):
+            mtime = os.path.getmtime(fname)
+        text = expr
+        if isinstance(text, six.text_type):
+            text = text.encode('utf-8')
+        key = (fname, mtime, hashlib.sha1(text).hexdigest())
+        if key in self.compiled_blocks:
+            return self.compiled_blocks[key]
+
+        node = self.parse(expr, fname=fname, lineno=lineno)
+        if node is None or len(self.error) > 0:
+            return None
+        block = CompiledBlock(node, self.supported_nodes,
+                              unsafe_attrs=UNSAFE_ATTRS, fname=fname)
+        self.compiled_blocks[key] = block
+        while len(self.compiled_blocks) > COMPILE_CACHE_SIZE:
+            self.compiled_blocks.popitem(last=False)
+        return block
+
+    def run_compiled(self, expr, fname=None, lineno=0):
+        """evaluates a block of larch text, using compiled code where
+        possible, and the Interpreter otherwise"""
+        self.expr = expr
+        try:
+            block = self.compile(expr, fname=fname, lineno=lineno)
+        except RuntimeError:
+            return
+        except:
+            self.raise_exception(None, exc=SyntaxError, msg='Compile Error',
+                                 expr=expr, fname=fname, lineno=lineno)
+            return
+        if block is None:
+            return
+        if self._namespace is None:
+            self._namespace = CompiledNamespace(self)
+        return block.run(self, self._namespace, expr=expr, fname=fname,
+                         lineno=lineno)
+
     def run_init_scripts(self):
         for fname in site_config.init_files:
             if os.path.exists(fname):
@@ -8,9 +8,17 @@ import sys
 import types
 import numpy
 import copy
+from collections import OrderedDict
 from .utils import Closure, fixName, isValidName
 from . import site_config
 
+# number of frames (sets of search groups) to keep symbol lookup caches for
+LOOKUP_CACHE_FRAMES = 8
+
+# incremented whenever a name is added to or removed from any Group, so
+# that symbol lookup caches can tell when a name may have been hidden
+_group_generation = 0
+
 class Group(object):
     """
     Generic Group: a container for variables, modules, and subgroups.
@@ -24,6 +32,17 @@ class Group(object):
         for key, val in kws.items():
             setattr(self, key, val)
 
+    def __setattr__(self, name, value):
+        global _group_generation
+        if name not in self.__dict__:
+            _group_generation += 1
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        global _group_generation
+        _group_generation += 1
+        object.__delattr__(self, name)
+
     def __len__(self):
         return max(1, len(dir(self))-1)
 
@@ -126,12 +145,17 @@ class SymbolTable(Group):
                 'has_symbol', 'has_group', 'get_group',
                 'create_group', 'new_group', 'isgroup',
                 'get_symbol', 'set_symbol',  'del_symbol',
-                'get_parent', 'add_plugin', '_path', '__parents')
+                'get_parent', 'add_plugin', '_path', '__parents',
+                'get_lookup_stats')
 
     def __init__(self, larch=None):
         Group.__init__(self, name=self.top_group)
         self._larch = larch
         self._sys = None
+        self.__frame_caches = OrderedDict()
+        self.__lookup_cache = {}
+        self.__cache_generation = -1
+        self.__lookup_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
         setattr(self, self.top_group, self)
 
         for gname in self.core_groups:
@@ -275,9 +299,50 @@ class SymbolTable(Group):
                 snames.append(name)
 
         self._sys.searchGroups = cache[3] = snames[:]
+        if self not in sgroups:
+            sgroups.append(self)
         sys.searchGroupObjects = cache[4] = sgroups[:]
+        self.__lookup_cache = self.__frame_cache(cache[4])
         return sys.searchGroupObjects
 
+    def __frame_cache(self, sgroups):
+        """return the symbol lookup cache for a list of search groups:
+        caches are kept for the most recently used LOOKUP_CACHE_FRAMES
+        frames, so that returning from a procedure does not lose the
+        cache for the calling frame."""
+        key = tuple([id(g) for g in sgroups])
+        caches = self.__frame_caches
+        if key in caches:
+            # the stored list of groups keeps the ids valid
+            caches[key] = caches.pop(key)
+            return caches[key][1]
+        cache = {}
+        caches[key] = (sgroups, cache)
+        while len(caches) > LOOKUP_CACHE_FRAMES:
+            caches.popitem(last=False)
+        return cache
+
+    def __check_caches(self):
+        """clear all symbol lookup caches if any Group has gained or lost
+        a name since they were filled: a new name in one group may hide
+        the same name in a group later in the search path"""
+        if self.__cache_generation != _group_generation:
+            for sgroups, cache in self.__frame_caches.values():
+                cache.clear()
+            self.__lookup_stats['invalidations'] += 1
+            self.__cache_generation = _group_generation
+
+    def get_lookup_stats(self, reset=False):
+        """return dictionary of symbol lookup cache statistics: hits,
+        misses, invalidations, and hit_rate"""
+        stats = dict(self.__lookup_stats)
+        ntotal = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits']/max(1.0, float(ntotal))
+        if reset:
+            for key in self.__lookup_stats:
+                self.__lookup_stats[key] = 0
+        return stats
+
     def get_parentpath(self, sym):
         """ get parent path for a symbol"""
         obj = self._lookup(sym)
@@ -293,38 +358,57 @@ class SymbolTable(Group):
     def _lookup(self, name=None, create=False):
         """looks up symbol in search path
         returns symbol given symbol name,
-        creating symbol if needed (and create=True)"""
-        debug = False # not ('force'in name)
-        if debug:  print( '====\nLOOKUP ', name)
-        searchGroups = self._fix_searchGroups()
-        self.__parents = []
-        if self not in searchGroups:
-            searchGroups.append(self)
-
-        def public_attr(grp, name):
-            return (hasattr(grp, name)  and
-                    not (grp is self and name in self._private))
+        creating symbol if needed (and create=True)
 
+        The group holding each top-level name is cached for the current
+        frame.  The caches are cleared whenever a name is added to or
+        removed from any Group, however that is done.
+        """
+        searchGroups = self._fix_searchGroups()
+        self.__check_caches()
+        cache = self.__lookup_cache
         parts = name.split('.')
-        if len(parts) == 1:
-            for grp in searchGroups:
-                if public_attr(grp, name):
-                    self.__parents.append(grp)
-                    return getattr(grp, name)
-
-        # more complex case: not immediately found in Local or Module Group
+        dotted = len(parts) > 1
         parts.reverse()
         top   = parts.pop()
-        out   = self.__invalid_name
-        if top == self.top_group:
-            out = self
+
+        entry = cache.get((top, dotted), None)
+        if entry is not None and hasattr(entry[0], top):
+            self.__lookup_stats['hits'] += 1
+            self.__parents = entry[1][:]
+            out = getattr(entry[0], top)
+            if not dotted:
+                return out
         else:
-            for grp in searchGroups:
-                if public_attr(grp, top):
-                    self.__parents.append(grp)
-                    out = getattr(grp, top)
-        if out is self.__invalid_name:
-            raise NameError("'%s' is not defined" % name)
+            self.__lookup_stats['misses'] += 1
+            self.__parents = []
+
+            def public_attr(grp, name):
+                return (hasattr(grp, name)  and
+                        not (grp is self and name in self._private))
+
+            if not dotted:
+                for grp in searchGroups:
+                    if public_attr(grp, top):
+                        self.__parents.append(grp)
+                        cache[(top, dotted)] = (grp, self.__parents[:])
+                        return getattr(grp, top)
+
+            # more complex case: not immediately found in Local or Module Group
+            out   = self.__invalid_name
+            found = None
+            if top == self.top_group:
+                out = self
+            else:
+                for grp in searchGroups:
+                    if public_attr(grp, top):
+                        self.__parents.append(grp)
+                        out = getattr(grp, top)
+                        found = grp
+            if out is self.__invalid_name:
+                raise NameError("'%s' is not defined" % name)
+            if found is not None:
+                cache[(top, dotted)] = (found, self.__parents[:])
 
         if len(parts) == 0:
             return out
@@ -4,11 +4,11 @@ from .xafsft import xftf, xftr, xftf_fast, xftr_fast, ftwindow
 
 from .pre_edge import pre_edge, preedge, find_e0
 
-from .feffdat import FeffPathGroup, FeffDatFile, _ff2chi
+from .feffdat import FeffPathGroup, FeffDatFile, _ff2chi, _sum_paths_dchi
 
 from .feffit import FeffitDataSet, TransformGroup, feffit
 
-from .autobk import autobk
+from .autobk import autobk, autobk_batch
 from .mback import mback
 from .diffkk import diffkk
 from .fluo import fluo_corr
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 import numpy as np
+from multiprocessing.pool import ThreadPool
 from scipy.interpolate import splrep, splev, UnivariateSpline
+from scipy.linalg import solve_banded
 
 from larch import (Group, Parameter, Minimizer, Make_CallArgs,
                    ValidateLarchPlugin, parse_group_args, isgroup)
@@ -10,7 +12,7 @@ from larch_plugins.math import (index_of, index_nearest,
                                 realimag, remove_dups)
 
 from larch_plugins.xafs import (ETOK, set_xafsGroup, ftwindow, xftf_fast,
-                                find_e0, pre_edge)
+                                find_e0, pre_edge, preedge)
 
 # check for uncertainties package
 HAS_UNCERTAIN = False
@@ -28,23 +30,225 @@ def spline_eval(kraw, mu, knots, coefs, order, kout):
     chi = UnivariateSpline(kraw, (mu-bkg), s=0)(kout)
     return bkg, chi
 
-def __resid(pars, ncoefs=1, knots=None, order=3, irbkg=1, nfft=2048,
-            kraw=None, mu=None, kout=None, ftwin=1, kweight=1, chi_std=None,
-            nclamp=0, clamp_lo=1, clamp_hi=1, **kws):
+def _autobk_grid(energy, e0, rbkg=1, kmin=0, kmax=None, kweight=1, dk=0,
+                 win='hanning', nfft=2048, kstep=0.05):
+    """set up the k grids, FT window and spline knot positions used by
+    autobk.  These depend only on the energy grid and e0, not on mu(E),
+    so can be shared by many spectra.
 
-    coefs = [getattr(pars, FMT_COEF % i) for i in range(ncoefs)]
-    bkg, chi = spline_eval(kraw, mu, knots, coefs, order, kout)
-    if chi_std is not None:
-        chi = chi - chi_std
-    out =  realimag(xftf_fast(chi*ftwin, nfft=nfft)[:irbkg])
+    returns a Group with ie0, iemax, irbkg, kraw, kout, kmax, ftwin,
+    and iknots (indices into kraw for the spline knots).
+    """
+    # get array indices for rkbg and e0: irbkg, ie0
+    ie0 = index_of(energy, e0)
+    rgrid = np.pi/(kstep*nfft)
+    if rbkg < 2*rgrid: rbkg = 2*rgrid
+    irbkg = int(1.01 + rbkg/rgrid)
+
+    # save ungridded k (kraw) and grided k (kout)
+    # and ftwin (*k-weighting) for FT in residual
+    enpe = energy[ie0:] - e0
+    kraw = np.sign(enpe)*np.sqrt(ETOK*abs(enpe))
+    if kmax is None:
+        kmax = max(kraw)
+    else:
+        kmax = max(0, min(max(kraw), kmax))
+    kout  = kstep * np.arange(int(1.01+kmax/kstep), dtype='float64')
+    iemax = min(len(energy), 2+index_of(energy, e0+kmax*kmax/ETOK)) - 1
+
+    # pre-load FT window
+    ftwin = kout**kweight * ftwindow(kout, xmin=kmin, xmax=kmax,
+                                     window=win, dx=dk)
+    # calc k-values of spline knots
+    nspl = max(4, min(128, 2*int(rbkg*(kmax-kmin)/np.pi) + 1))
+    iknots = []
+    for i in range(nspl):
+        q  = kmin + i*(kmax-kmin)/(nspl - 1)
+        iknots.append(index_nearest(kraw, q))
+
+    return Group(ie0=ie0, iemax=iemax, irbkg=irbkg, kraw=kraw, kout=kout,
+                 kmax=kmax, ftwin=ftwin, iknots=iknots)
+
+def _spline_basis(kraw, knots, order, ncoefs):
+    """B-spline design matrix, so that
+         splev(kraw, [knots, coefs, order]) == basis.dot(coefs[:ncoefs])
+    for coefs that are 0 past ncoefs.  kraw must be increasing.
+
+    Each B-spline is evaluated only where it is non-zero (and, for the
+    first and last few, where splev extrapolates them)."""
+    basis = np.zeros((len(kraw), ncoefs))
+    coefs = np.zeros(len(knots))
+    nlast = len(knots) - 2*order - 2
+    for i in range(ncoefs):
+        i1, i2 = 0, len(kraw)
+        if i > order:
+            i1 = np.searchsorted(kraw, knots[i], side='left')
+        if i < nlast:
+            i2 = np.searchsorted(kraw, knots[i+order+1], side='right')
+        if i2 > i1:
+            coefs[i] = 1.0
+            basis[i1:i2, i] = splev(kraw[i1:i2], [knots, coefs, order])
+            coefs[i] = 0
+    return basis
+
+def _resample_matrix(kraw, kout):
+    """matrix for the (cubic spline) interpolation done in spline_eval, so
+    that
+         UnivariateSpline(kraw, y, s=0)(kout) == resample.dot(y)
+
+    The knots of the interpolating spline depend only on kraw, so this is
+    the B-spline basis at kout times the inverse of the (banded) basis at
+    kraw.
+    """
+    knots, coefs, order = splrep(kraw, np.zeros(len(kraw)), s=0)
+    nraw = len(kraw)
+    braw = _spline_basis(kraw, knots, order, nraw)
+    bout = _spline_basis(kout, knots, order, nraw)
+    # solve braw.T x = bout.T, with braw.T in banded storage
+    irow, icol = np.nonzero(braw.T)
+    nlo, nup = max(0, (irow-icol).max()), max(0, (icol-irow).max())
+    banded = np.zeros((nlo+nup+1, nraw))
+    banded[nup + irow - icol, icol] = braw.T[irow, icol]
+    return solve_banded((nlo, nup), banded, bout.T).T
+
+def _lowr_matrix(ftwin, irbkg, nfft=2048):
+    """matrix for the low-R Fourier transform of the autobk residual:
+         realimag(xftf_fast(chi*ftwin, nfft=nfft)[:irbkg]) == lowr.dot(chi)
+    """
+    lowr = np.zeros((2*irbkg, len(ftwin)))
+    unit = np.zeros(len(ftwin))
+    for i in range(len(ftwin)):
+        unit[:] = 0
+        unit[i] = ftwin[i]
+        lowr[:, i] = realimag(xftf_fast(unit, nfft=nfft)[:irbkg])
+    return lowr
+
+def _autobk_operators(kraw, kout, knots, order, ncoefs, ftwin, irbkg,
+                      nfft=2048):
+    """linear operators for the autobk fit, for fixed knots and k grids:
+        basis:     bkg(kraw) = basis.dot(coefs)
+        resample:  chi(kout) = resample.dot(mu - bkg)
+        lowr:      low-R FT  = lowr.dot(chi)
+        chimat:    resample.dot(basis)
+        design:    lowr.dot(chimat)
+    so that the residual is linear in the spline coefficients, apart from
+    the clamps.
+    """
+    basis = _spline_basis(kraw, knots, order, ncoefs)
+    resample = _resample_matrix(kraw, kout)
+    lowr = _lowr_matrix(ftwin, irbkg, nfft=nfft)
+    chimat = resample.dot(basis)
+    return Group(basis=basis, resample=resample, lowr=lowr,
+                 chimat=chimat, design=lowr.dot(chimat))
+
+def _param_coefs(pars, ncoefs):
+    """spline coefficients from the fit Parameters, as a (1, ncoefs)
+    array of floats"""
+    return np.array([[getattr(pars, FMT_COEF % i).value
+                      for i in range(ncoefs)]], dtype='float64')
+
+def __resid(pars, ncoefs=1, ft0=None, chi0=None, design=None, chimat=None,
+            kout=None, kweight=1, nclamp=0, clamp_lo=1, clamp_hi=1, **kws):
+    """autobk residual, using the precomputed linear operators"""
+    coefs = _param_coefs(pars, ncoefs)
+    resid, jac = _clamped_resid(coefs, ft0, chi0, design, chimat, kout,
+                                kweight=kweight, nclamp=nclamp,
+                                clamp_lo=clamp_lo, clamp_hi=clamp_hi)
+    return resid[0]
+
+def __jacobian(pars, ncoefs=1, ft0=None, chi0=None, design=None,
+               chimat=None, kout=None, kweight=1, nclamp=0, clamp_lo=1,
+               clamp_hi=1, **kws):
+    """exact jacobian of the autobk residual, with one column per
+    spline coefficient"""
+    coefs = _param_coefs(pars, ncoefs)
+    resid, jac = _clamped_resid(coefs, ft0, chi0, design, chimat, kout,
+                                kweight=kweight, nclamp=nclamp,
+                                clamp_lo=clamp_lo, clamp_hi=clamp_hi)
+    return jac[0]
+
+def _clamped_resid(coefs, ft0, chi0, design, chimat, kout, kweight=1,
+                   nclamp=0, clamp_lo=1, clamp_hi=1):
+    """residual and jacobian of the autobk objective (same as __resid) for
+    a stack of spectra, using the linear operators from _autobk_operators:
+
+      coefs:   (nspectra, ncoefs) spline coefficients
+      ft0:     (nspectra, 2*irbkg) low-R FT of chi(k) with bkg=0
+      chi0:    (nspectra, nk) chi(k) with bkg=0
+      design:  (2*irbkg, ncoefs) low-R FT of chi(k) per coefficient
+      chimat:  (nk, ncoefs) chi(k) per coefficient
+
+    returns resid (nspectra, nresid), jac (nspectra, nresid, ncoefs)
+    """
+    nspec = coefs.shape[0]
+    out = ft0 - coefs.dot(design.T)
+    jac = np.zeros((nspec, out.shape[1], coefs.shape[1]))
+    jac[:] = -design
     if nclamp == 0:
-        return out
-    # spline clamps:
-    scale = (1.0 + 100*(out*out).sum())/(len(out)*nclamp)
-    scaled_chik = scale * chi * kout**kweight
-    return np.concatenate((out,
-                           abs(clamp_lo)*scaled_chik[:nclamp],
-                           abs(clamp_hi)*scaled_chik[-nclamp:]))
+        return out, jac
+    # spline clamps
+    nout = out.shape[1]
+    iclamp = np.concatenate((np.arange(len(kout))[:nclamp],
+                             np.arange(len(kout))[-nclamp:]))
+    weight = np.ones(len(iclamp))
+    weight[:nclamp] = abs(clamp_lo)
+    weight[nclamp:] = abs(clamp_hi)
+    weight = weight * kout[iclamp]**kweight
+    chik = (chi0[:, iclamp] - coefs.dot(chimat[iclamp].T)) * weight
+    dchik = -chimat[iclamp] * weight[:, np.newaxis]
+
+    scale = (1.0 + 100*(out*out).sum(axis=1))/(nout*nclamp)
+    dscale = -200*out.dot(design)/(nout*nclamp)
+    resid = np.concatenate((out, scale[:, np.newaxis]*chik), axis=1)
+    jclamp = (chik[:, :, np.newaxis]*dscale[:, np.newaxis, :] +
+              scale[:, np.newaxis, np.newaxis]*dchik)
+    return resid, np.concatenate((jac, jclamp), axis=1)
+
+def _refine_coefs(coefs, ft0, chi0, toler=1.e-4, maxiter=200, **kws):
+    """Levenberg-Marquardt refinement of spline coefficients for a stack of
+    spectra at once, with the clamped autobk residual.  All spectra take
+    steps together, each with its own damping factor.
+
+    returns coefs, the number of iterations used for each spectrum, and
+    whether each fit converged (False if it was still improving after
+    maxiter iterations)
+    """
+    coefs = np.array(coefs, dtype='float64')
+    nspec, ncoefs = coefs.shape
+    resid, jac = _clamped_resid(coefs, ft0, chi0, **kws)
+    cost = (resid*resid).sum(axis=1)
+    lambda_ = 1.e-3*np.ones(nspec)
+    niter = np.zeros(nspec, dtype='int')
+    active = np.ones(nspec, dtype='bool')
+    for i in range(maxiter):
+        if not active.any():
+            break
+        idx = np.where(active)[0]
+        jtj = np.einsum('sij,sik->sjk', jac[idx], jac[idx])
+        grad = np.einsum('sij,si->sj', jac[idx], resid[idx])
+        diag = np.einsum('sjj->sj', jtj)
+        damp = jtj.copy()
+        damp[:, np.arange(ncoefs), np.arange(ncoefs)] += \
+                lambda_[idx, np.newaxis]*np.maximum(diag, 1.e-30)
+        step = -np.linalg.solve(damp, grad[:, :, np.newaxis])[:, :, 0]
+
+        trial = coefs[idx] + step
+        tresid, tjac = _clamped_resid(trial, ft0[idx], chi0[idx], **kws)
+        tcost = (tresid*tresid).sum(axis=1)
+        niter[idx] += 1
+
+        better = tcost < cost[idx]
+        good = idx[better]
+        small = (cost[good] - tcost[better]) <= toler*cost[good]
+        coefs[good] = trial[better]
+        resid[good] = tresid[better]
+        jac[good] = tjac[better]
+        cost[good] = tcost[better]
+        lambda_[good] = lambda_[good] / 10.0
+        lambda_[idx[~better]] = lambda_[idx[~better]] * 10.0
+        active[good[small]] = False
+        active[lambda_ > 1.e10] = False
+    return coefs, niter, ~active
 
 @ValidateLarchPlugin
 @Make_CallArgs(["energy" ,"mu"])
@@ -89,7 +293,7 @@ def autobk(energy, mu=None, group=None, rbkg=1, nknots=None, e0=None,
     if 'kw' in kws:
         kweight = kws.pop('kw')
     if len(kws) > 0:
-        msg('Unrecognized a:rguments for autobk():\n')
+        msg('Unrecognized arguments for autobk():\n')
         msg('    %s\n' % (', '.join(kws.keys())))
         return
     energy, mu, group = parse_group_args(energy, members=('energy', 'mu'),
@@ -124,35 +328,20 @@ def autobk(energy, mu=None, group=None, rbkg=1, nknots=None, e0=None,
         msg('autobk() could not determine e0 or edge_step!: trying running pre_edge first\n')
         return
 
-    # get array indices for rkbg and e0: irbkg, ie0
-    ie0 = index_of(energy, e0)
-    rgrid = np.pi/(kstep*nfft)
-    if rbkg < 2*rgrid: rbkg = 2*rgrid
-    irbkg = int(1.01 + rbkg/rgrid)
-
-    # save ungridded k (kraw) and grided k (kout)
-    # and ftwin (*k-weighting) for FT in residual
-    enpe = energy[ie0:] - e0
-    kraw = np.sign(enpe)*np.sqrt(ETOK*abs(enpe))
-    if kmax is None:
-        kmax = max(kraw)
-    else:
-        kmax = max(0, min(max(kraw), kmax))
-    kout  = kstep * np.arange(int(1.01+kmax/kstep), dtype='float64')
-    iemax = min(len(energy), 2+index_of(energy, e0+kmax*kmax/ETOK)) - 1
+    grid = _autobk_grid(energy, e0, rbkg=rbkg, kmin=kmin, kmax=kmax,
+                        kweight=kweight, dk=dk, win=win, nfft=nfft,
+                        kstep=kstep)
+    ie0, iemax, irbkg = grid.ie0, grid.iemax, grid.irbkg
+    kraw, kout, ftwin, kmax = grid.kraw, grid.kout, grid.ftwin, grid.kmax
 
     # interpolate provided chi(k) onto the kout grid
     if chi_std is not None and k_std is not None:
         chi_std = np.interp(kout, k_std, chi_std)
-    # pre-load FT window
-    ftwin = kout**kweight * ftwindow(kout, xmin=kmin, xmax=kmax,
-                                     window=win, dx=dk)
-    # calc k-value and initial guess for y-values of spline params
-    nspl = max(4, min(128, 2*int(rbkg*(kmax-kmin)/np.pi) + 1))
+
+    # initial guess for y-values of spline params
+    nspl = len(grid.iknots)
     spl_y, spl_k, spl_e  = np.zeros(nspl), np.zeros(nspl), np.zeros(nspl)
-    for i in range(nspl):
-        q  = kmin + i*(kmax-kmin)/(nspl - 1)
-        ik = index_nearest(kraw, q)
+    for i, ik in enumerate(grid.iknots):
         i1 = min(len(kraw)-1, ik + 5)
         i2 = max(0, ik - 5)
         spl_k[i] = kraw[ik]
@@ -174,16 +363,28 @@ def autobk(energy, mu=None, group=None, rbkg=1, nknots=None, e0=None,
     initbkg, initchi = spline_eval(kraw[:iemax-ie0+1], mu[ie0:iemax+1],
                                    knots, coefs, order, kout)
 
+    # the background and the resampling of mu-bkg onto kout are linear in
+    # the spline coefficients, so build these operators once, and use
+    # them for both the residual and its jacobian
+    ops = _autobk_operators(kraw[:iemax-ie0+1], kout, knots, order, nspl,
+                            ftwin, irbkg, nfft=nfft)
+    chi0 = ops.resample.dot(mu[ie0:iemax+1])
+    if chi_std is not None:
+        chi0 = chi0 - chi_std
+    ft0 = ops.lowr.dot(chi0)
+
     # do fit
     fit = Minimizer(__resid, params, _larch=_larch, toler=1.e-4,
-                    fcn_kws = dict(ncoefs=len(coefs), chi_std=chi_std,
-                                   knots=knots, order=order,
-                                   kraw=kraw[:iemax-ie0+1],
-                                   mu=mu[ie0:iemax+1], irbkg=irbkg, kout=kout,
-                                   ftwin=ftwin, kweight=kweight,
-                                   nfft=nfft, nclamp=nclamp,
-                                   clamp_lo=clamp_lo, clamp_hi=clamp_hi))
-    fit.leastsq()
+                    fcn_kws = dict(ncoefs=nspl, ft0=ft0[np.newaxis, :],
+                                   chi0=chi0[np.newaxis, :],
+                                   design=ops.design, chimat=ops.chimat,
+                                   kout=kout, kweight=kweight,
+                                   nclamp=nclamp, clamp_lo=clamp_lo,
+                                   clamp_hi=clamp_hi))
+    icoefs = [int(name[1:]) for name in fit.var_names]
+    def jacobian(pars, **kws):
+        return __jacobian(pars, **kws)[:, icoefs]
+    fit.leastsq(Dfun=jacobian)
 
     # write final results
     coefs = [getattr(params, FMT_COEF % i) for i in range(len(coefs))]
@@ -245,5 +446,157 @@ def autobk(energy, mu=None, group=None, rbkg=1, nknots=None, e0=None,
         dchi  = [fdchi(*uvars).std_dev() for index in range(len(kout))]
         group.delta_chi = np.array(dchi)/edge_step
 
+@ValidateLarchPlugin
+def autobk_batch(energy, mu, group=None, rbkg=1, e0=None, edge_step=None,
+                 kmin=0, kmax=None, kweight=1, dk=0, win='hanning',
+                 k_std=None, chi_std=None, nfft=2048, kstep=0.05,
+                 pre_edge_kws=None, nclamp=4, clamp_lo=1, clamp_hi=1,
+                 nworkers=1, _larch=None, **kws):
+    """Use Autobk algorithm to remove XAFS background for a stack of
+    spectra that share an energy grid, such as a quick-XAFS series or
+    the XANES spectra from the pixels of a map.
+
+    Parameters:
+    -----------
+      energy:    1-d array of x-ray energies, in eV
+      mu:        2-d array of mu(E), one spectrum per row
+      group:     output group (and input group for e0).
+      rbkg:      distance (in Ang) for chi(R) above
+                 which the signal is ignored. Default = 1.
+      e0:        edge energy, in eV, common to all spectra.
+                 If None, it will be determined from the average spectrum.
+      edge_step: edge step, either a single value or one per spectrum.
+                 If None, it will be determined for each spectrum.
+      pre_edge_kws:  keyword arguments to pass to preedge()
+      kmin:      minimum k value   [0]
+      kmax:      maximum k value   [full data range].
+      kweight:   k weight for FFT.  [1]
+      dk:        FFT window window parameter.  [0]
+      win:       FFT window function name.     ['hanning']
+      nfft:      array size to use for FFT [2048]
+      kstep:     k step size to use for FFT [0.05]
+      k_std:     optional k array for standard chi(k).
+      chi_std:   optional chi array for standard chi(k).
+      nclamp:    number of energy end-points for clamp [4]
+      clamp_lo:  weight of low-energy clamp [1]
+      clamp_hi:  weight of high-energy clamp [1]
+      nworkers:  number of worker threads for the clamped fits [1]
+
+    Output arrays are written to the provided group, as for autobk(),
+    but with bkg, chie, and chi as 2-d arrays with one row per spectrum.
+    autobk_details.converged is False for spectra whose clamped fit
+    stopped at the iteration limit before converging, and a warning is
+    written if there are any.
+
+    Notes:
+    ------
+      The spline basis, the interpolation onto the k grid, and the low-R
+      Fourier transform are all linear, and are built once as matrices.
+      Without clamps the fit is then a linear least-squares problem, solved
+      for all spectra at once.  With clamps, that solution is refined with
+      a Levenberg-Marquardt fit for each spectrum, with the spectra split
+      between nworkers threads.
+    """
+    msg = _larch.writer.write
+    if 'kw' in kws:
+        kweight = kws.pop('kw')
+    if len(kws) > 0:
+        msg('Unrecognized arguments for autobk_batch():\n')
+        msg('    %s\n' % (', '.join(kws.keys())))
+        return
+
+    energy = remove_dups(np.asarray(energy).squeeze())
+    mu = np.atleast_2d(np.asarray(mu, dtype='float64'))
+    if mu.shape[1] != len(energy):
+        msg('autobk_batch(): mu must be a 2-d array with one spectrum per row\n')
+        return
+    nspec = mu.shape[0]
+
+    group = set_xafsGroup(group, _larch=_larch)
+    if e0 is None and isgroup(group, 'e0'):
+        e0 = group.e0
+    pre_kws = dict(nnorm=3, nvict=0, pre1=None,
+                   pre2=-50., norm1=100., norm2=None)
+    if pre_edge_kws is not None:
+        pre_kws.update(pre_edge_kws)
+    if e0 is None:
+        e0 = preedge(energy, mu.mean(axis=0), **pre_kws)['e0']
+    if edge_step is None:
+        edge_step = [preedge(energy, mu[i], e0=e0, **pre_kws)['edge_step']
+                     for i in range(nspec)]
+    edge_step = edge_step * np.ones(nspec)
+
+    grid = _autobk_grid(energy, e0, rbkg=rbkg, kmin=kmin, kmax=kmax,
+                        kweight=kweight, dk=dk, win=win, nfft=nfft,
+                        kstep=kstep)
+    ie0, iemax, kout = grid.ie0, grid.iemax, grid.kout
+    nkx = iemax - ie0 + 1
+    kraw = grid.kraw[:nkx]
+    if chi_std is not None and k_std is not None:
+        chi_std = np.interp(kout, k_std, chi_std)
+
+    # knots depend only on the k-values of the knots, so are shared
+    spl_k = grid.kraw[grid.iknots]
+    spl_e = energy[np.array(grid.iknots) + ie0]
+    nspl = len(spl_k)
+    knots, coefs, order = splrep(spl_k, np.zeros(nspl))
+
+    # linear operators, built once for all spectra
+    ops = _autobk_operators(kraw, kout, knots, order, nspl, grid.ftwin,
+                            grid.irbkg, nfft=nfft)
+    mudat = mu[:, ie0:iemax+1]
+    chi0 = mudat.dot(ops.resample.T)
+    if chi_std is not None:
+        chi0 = chi0 - chi_std
+    ft0 = chi0.dot(ops.lowr.T)
+
+    # without clamps, this is the full solution
+    coefs = np.linalg.lstsq(ops.design, ft0.T, rcond=-1)[0].T
+    niter = np.zeros(nspec, dtype='int')
+    converged = np.ones(nspec, dtype='bool')
+
+    if nclamp > 0:
+        fit_kws = dict(design=ops.design, chimat=ops.chimat, kout=kout,
+                       kweight=kweight, nclamp=nclamp,
+                       clamp_lo=clamp_lo, clamp_hi=clamp_hi)
+        def refine(idx):
+            return _refine_coefs(coefs[idx], ft0[idx], chi0[idx], **fit_kws)
+
+        chunks = np.array_split(np.arange(nspec), max(1, nworkers))
+        chunks = [idx for idx in chunks if len(idx) > 0]
+        if len(chunks) > 1:
+            pool = ThreadPool(len(chunks))
+            try:
+                results = pool.map(refine, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [refine(idx) for idx in chunks]
+        for idx, (ccoefs, cniter, cconverged) in zip(chunks, results):
+            coefs[idx] = ccoefs
+            niter[idx] = cniter
+            converged[idx] = cconverged
+        if not converged.all():
+            msg('autobk_batch(): %d of %d spectra did not converge '
+                '(see autobk_details.converged)\n' %
+                ((~converged).sum(), nspec))
+
+    # write final results
+    bkg = coefs.dot(ops.basis.T)
+    obkg = np.copy(mu)
+    obkg[:, ie0:ie0+nkx] = bkg
+    chi = (mudat - bkg).dot(ops.resample.T)
+
+    group.e0 = e0
+    group.edge_step = edge_step
+    group.bkg  = obkg
+    group.chie = (mu-obkg)/edge_step[:, np.newaxis]
+    group.k    = kout
+    group.chi  = chi/edge_step[:, np.newaxis]
+    group.autobk_details = Group(knots_e=spl_e, knots_y=coefs, nfev=niter,
+                                 converged=converged, kmin=kmin,
+                                 kmax=grid.kmax)
+
 def registerLarchPlugin():
-    return ('_xafs', {'autobk': autobk})
+    return ('_xafs', {'autobk': autobk, 'autobk_batch': autobk_batch})
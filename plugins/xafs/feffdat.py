@@ -13,6 +13,8 @@ the path represented by the feffNNNN.dat
 creates a group that contains the chi(k) for the sum of paths.
 """
 import six
+import threading
+from collections import OrderedDict
 import numpy as np
 from scipy.interpolate import UnivariateSpline
 from larch import (Group, Parameter, isParameter,
@@ -23,6 +25,8 @@ from larch_plugins.xafs import ETOK, set_xafsGroup
 from larch_plugins.xray import atomic_mass, atomic_symbol
 
 SMALL = 1.e-6
+# number of recently interpolated wavenumber arrays kept per Feff.dat file
+INTERP_CACHE_SIZE = 4
 
 class FeffDatFile(Group):
     def __init__(self, filename=None, _larch=None, **kws):
@@ -30,6 +34,11 @@ class FeffDatFile(Group):
         kwargs = dict(name='feff.dat: %s' % filename)
         kwargs.update(kws)
         Group.__init__(self,  **kwargs)
+        self.__arrays = None
+        self.__splines = None
+        self.__dsplines = None
+        self.__interp_cache = OrderedDict()
+        self.__cache_lock = threading.Lock()
         if filename is not None:
             self.__read(filename)
 
@@ -70,6 +79,74 @@ class FeffDatFile(Group):
     @rmass.setter
     def rmass(self, val):     pass
 
+    def __check_arrays(self):
+        """discard splines and interpolated values if the Feff.dat
+        arrays have been replaced"""
+        arrays = (self.k, self.pha, self.amp, self.rep, self.lam)
+        if (self.__arrays is None or
+            any(a is not b for a, b in zip(arrays, self.__arrays))):
+            with self.__cache_lock:
+                self.__arrays = arrays
+                self.__splines = None
+                self.__dsplines = None
+                self.__interp_cache = OrderedDict()
+
+    def _splines(self, deriv=False):
+        """spline representations of (pha, amp, rep, lam) vs k, or of
+        their derivatives with deriv=True.
+        These are built on first use, and rebuilt only if the arrays are
+        replaced.
+        """
+        self.__check_arrays()
+        splines = self.__splines
+        if splines is None:
+            splines = [UnivariateSpline(self.k, arr, s=0)
+                       for arr in self.__arrays[1:]]
+            self.__splines = splines
+        if not deriv:
+            return splines
+        dsplines = self.__dsplines
+        if dsplines is None:
+            dsplines = [spl.derivative() for spl in splines]
+            self.__dsplines = dsplines
+        return dsplines
+
+    def interpolate(self, q, interp='cubic', deriv=False):
+        """return (pha, amp, rep, lam) interpolated onto wavenumber q
+
+        interp='cubic' uses splines made once for this file, 'linear' uses
+        linear interpolation.  The results for the INTERP_CACHE_SIZE most
+        recently used q arrays are kept, so that repeated evaluation on a
+        fixed k grid (when e0 does not change) becomes a table lookup.
+
+        With deriv=True, the derivatives of (pha, amp, rep, lam) with
+        respect to k are returned.
+        """
+        self.__check_arrays()
+        linear = interp.startswith('lin')
+        key = (linear, deriv, len(q), q.tobytes())
+        with self.__cache_lock:
+            out = self.__interp_cache.pop(key, None)
+            if out is not None:
+                self.__interp_cache[key] = out
+                return out
+        tables = (self.pha, self.amp, self.rep, self.lam)
+        if linear and deriv:
+            # slope of the linear segment containing each q
+            iseg = np.clip(np.searchsorted(self.k, q) - 1, 0, len(self.k)-2)
+            dk = np.diff(self.k)[iseg]
+            out = tuple(np.diff(arr)[iseg]/dk for arr in tables)
+        elif linear:
+            out = tuple(np.interp(q, self.k, arr) for arr in tables)
+        else:
+            out = tuple(spl(q) for spl in self._splines(deriv=deriv))
+        with self.__cache_lock:
+            cache = self.__interp_cache
+            while len(cache) >= INTERP_CACHE_SIZE:
+                cache.popitem(last=False)
+            cache[key] = out
+        return out
+
     def __read(self, filename):
         try:
             lines = open(filename, 'r').readlines()
@@ -311,56 +388,64 @@ class FeffPathGroup(Group):
 
         return '\n'.join(out)
 
-    def _calc_chi(self, k=None, kmax=None, kstep=None, degen=None, s02=None,
-                 e0=None, ei=None, deltar=None, sigma2=None,
-                 third=None, fourth=None, debug=False, interp='cubic', **kws):
-        """calculate chi(k) with the provided parameters"""
-        fdat = self._feffdat
-        if fdat.reff < 0.05:
-            self._larch.writer.write('reff is too small to calculate chi(k)')
-            return
-        # make sure we have a k array
+    def _make_k(self, k=None, kmax=None, kstep=None):
+        """return k array for chi(k), making a uniform array if needed"""
         if k is None:
             if kmax is None:
                 kmax = 30.0
-            kmax = min(max(fdat.k), kmax)
+            kmax = min(max(self._feffdat.k), kmax)
             if kstep is None: kstep = 0.05
             k = kstep * np.arange(int(1.01 + kmax/kstep), dtype='float64')
+        return k
 
-        reff = fdat.reff
-        # put 'reff' into the paramGroup so that it can be used in
-        # constraint expressions
+    def _pathparam_values(self, **kws):
+        """evaluate path parameters with 'reff' and '_feffdat' for
+        this path put into the paramGroup, so that they can be used in
+        constraint expressions"""
+        fdat = self._feffdat
         if self._larch.symtable._sys.paramGroup is not None:
             self._larch.symtable._sys.paramGroup._feffdat = fdat
             self._larch.symtable._sys.paramGroup.reff = fdat.reff
+        return self._pathparams(**kws)
+
+    def _chi_inputs(self, k, interp='cubic', deriv=False, pars=None, **kws):
+        """evaluate path parameters and look up Feff.dat values for k
 
-        # get values for all the path parameters
-        (degen, s02, e0, ei, deltar, sigma2, third, fourth)  = \
-                self._pathparams(degen=degen, s02=s02, e0=e0, ei=ei,
-                                 deltar=deltar, sigma2=sigma2,
-                                 third=third, fourth=fourth)
-
-        # create e0-shifted energy and k, careful to look for |e0| ~= 0.
-        en = k*k - e0*ETOK
-        if min(abs(en)) < SMALL:
-            try:
-                en[np.where(abs(en) < 2*SMALL)] = SMALL
-            except ValueError:
-                pass
-        # q is the e0-shifted wavenumber
-        q = np.sign(en)*np.sqrt(abs(en))
+        Returns tuple of path parameters (degen, s02, e0, ei, deltar,
+        sigma2, third, fourth), the e0-shifted wavenumber q, and the
+        Feff.dat arrays (pha, amp, rep, lam) interpolated onto q.
+        With deriv=True, the derivatives of the Feff.dat arrays with
+        respect to q are also returned.
+
+        If pars is given, those path parameter values are used and the
+        larch interpreter is not needed.
+        """
+        if pars is None:
+            pars = self._pathparam_values(**kws)
+        q = _shifted_k(k, pars[2])
 
         # lookup Feff.dat values (pha, amp, rep, lam)
-        if interp.startswith('lin'):
-            pha = np.interp(q, fdat.k, fdat.pha)
-            amp = np.interp(q, fdat.k, fdat.amp)
-            rep = np.interp(q, fdat.k, fdat.rep)
-            lam = np.interp(q, fdat.k, fdat.lam)
-        else:
-            pha = UnivariateSpline(fdat.k, fdat.pha, s=0)(q)
-            amp = UnivariateSpline(fdat.k, fdat.amp, s=0)(q)
-            rep = UnivariateSpline(fdat.k, fdat.rep, s=0)(q)
-            lam = UnivariateSpline(fdat.k, fdat.lam, s=0)(q)
+        out = pars, q, self._feffdat.interpolate(q, interp=interp)
+        if deriv:
+            out = out + (self._feffdat.interpolate(q, interp=interp,
+                                                   deriv=True), )
+        return out
+
+    def _calc_chi(self, k=None, kmax=None, kstep=None, degen=None, s02=None,
+                 e0=None, ei=None, deltar=None, sigma2=None,
+                 third=None, fourth=None, debug=False, interp='cubic', **kws):
+        """calculate chi(k) with the provided parameters"""
+        fdat = self._feffdat
+        if fdat.reff < 0.05:
+            self._larch.writer.write('reff is too small to calculate chi(k)')
+            return
+        # make sure we have a k array
+        k = self._make_k(k=k, kmax=kmax, kstep=kstep)
+
+        pars, q, (pha, amp, rep, lam) = \
+              self._chi_inputs(k, interp=interp, degen=degen, s02=s02,
+                               e0=e0, ei=ei, deltar=deltar, sigma2=sigma2,
+                               third=third, fourth=fourth)
 
         if debug:
             self.debug_k   = q
@@ -369,23 +454,192 @@ class FeffPathGroup(Group):
             self.debug_rep = rep
             self.debug_lam = lam
 
-        # p = complex wavenumber, and its square:
-        pp   = (rep + 1j/lam)**2 + 1j * ei * ETOK
-        p    = np.sqrt(pp)
-
-        # the xafs equation:
-        cchi = np.exp(-2*reff*p.imag - 2*pp*(sigma2 - pp*fourth/3) +
-                      1j*(2*q*reff + pha +
-                          2*p*(deltar - 2*sigma2/reff - 2*pp*third/3) ))
-
-        cchi = degen * s02 * amp * cchi / (q*(reff + deltar)**2)
-        cchi[0] = 2*cchi[1] - cchi[2]
+        cchi, p = _xafs_chi(q, fdat.reff, pars, pha, amp, rep, lam)
         # outputs:
         self.k = k
         self.p = p
         self.chi = cchi.imag
         self.chi_imag = -cchi.real
 
+def _shifted_k(k, e0):
+    """e0-shifted wavenumber for k array and e0 value(s)
+
+    e0 may be a scalar or an array of shape (npaths, 1), giving
+    q of shape (npaths, len(k)).
+    """
+    # create e0-shifted energy and k, careful to look for |e0| ~= 0.
+    en = k*k - e0*ETOK
+    small = abs(en) < SMALL
+    if small.any():
+        fix = (abs(en) < 2*SMALL) & small.any(axis=-1)[..., np.newaxis]
+        en[np.where(fix)] = SMALL
+    # q is the e0-shifted wavenumber
+    return np.sign(en)*np.sqrt(abs(en))
+
+def _xafs_chi(q, reff, pars, pha, amp, rep, lam):
+    """evaluate the XAFS equation, returning complex chi and p
+
+    q, pha, amp, rep, lam are either 1-D arrays for a single path, or
+    2-D arrays of shape (npaths, nk), in which case reff and each of the
+    path parameters (degen, s02, e0, ei, deltar, sigma2, third, fourth)
+    in pars must be arrays of shape (npaths, 1).
+    """
+    degen, s02, e0, ei, deltar, sigma2, third, fourth = pars
+    # p = complex wavenumber, and its square:
+    pp   = (rep + 1j/lam)**2 + 1j * ei * ETOK
+    p    = np.sqrt(pp)
+
+    # the xafs equation:
+    cchi = np.exp(-2*reff*p.imag - 2*pp*(sigma2 - pp*fourth/3) +
+                  1j*(2*q*reff + pha +
+                      2*p*(deltar - 2*sigma2/reff - 2*pp*third/3) ))
+
+    cchi = degen * s02 * amp * cchi / (q*(reff + deltar)**2)
+    cchi[..., 0] = 2*cchi[..., 1] - cchi[..., 2]
+    return cchi, p
+
+def _xafs_dchi(q, reff, pars, pha, amp, rep, lam,
+               dpha, damp, drep, dlam):
+    """derivatives of chi(k) with respect to the path parameters
+
+    Arguments are as for _xafs_chi(), with dpha, damp, drep, dlam the
+    derivatives of the Feff.dat arrays with respect to q.  Returns an
+    array of shape (8,) + q.shape, ordered as the path parameters
+    (degen, s02, e0, ei, deltar, sigma2, third, fourth).
+    """
+    degen, s02, e0, ei, deltar, sigma2, third, fourth = pars
+    z    = rep + 1j/lam
+    pp   = z**2 + 1j * ei * ETOK
+    p    = np.sqrt(pp)
+    rpath = reff + deltar
+    xexp = np.exp(-2*reff*p.imag - 2*pp*(sigma2 - pp*fourth/3) +
+                  1j*(2*q*reff + pha +
+                      2*p*(deltar - 2*sigma2/reff - 2*pp*third/3) ))
+    # complex chi without degen*s02, and complex chi
+    cchi0 = amp * xexp / (q*rpath**2)
+    cchi  = degen * s02 * cchi0
+
+    def dexp_dpp(dpp):
+        "change in the exponent for a change in pp"
+        dp = dpp / (2*p)
+        return (-2*reff*dp.imag - 2*dpp*sigma2 + 4*pp*dpp*fourth/3 +
+                1j*(2*dp*(deltar - 2*sigma2/reff) -
+                    4*third*(dp*pp + p*dpp)/3))
+
+    # e0 changes q, and so all the Feff.dat arrays
+    dpp_dq = 2*z*(drep - 1j*dlam/lam**2)
+    dcchi_dq = (degen*s02*xexp*(damp/q - amp/q**2)/rpath**2 +
+                cchi*(1j*(2*reff + dpha) + dexp_dpp(dpp_dq)))
+    dq_de0 = -ETOK/(2*abs(q))
+
+    dcchi = (s02*cchi0,                     # degen
+             degen*cchi0,                   # s02
+             dcchi_dq*dq_de0,               # e0
+             cchi*dexp_dpp(1j*ETOK),        # ei
+             cchi*(2j*p - 2/rpath),         # deltar
+             cchi*(-2*pp - 4j*p/reff),      # sigma2
+             cchi*(-4j*p*pp/3),             # third
+             cchi*(2*pp*pp/3))              # fourth
+    dchi = np.array([d.imag for d in dcchi])
+    dchi[..., 0] = 2*dchi[..., 1] - dchi[..., 2]
+    return dchi
+
+def _valid_paths(pathlist):
+    "paths in pathlist for which chi(k) can be calculated"
+    paths = []
+    for path in pathlist:
+        if path._feffdat.reff < 0.05:
+            path._larch.writer.write('reff is too small to calculate chi(k)')
+        else:
+            paths.append(path)
+    return paths
+
+def _stack_pathparams(paths):
+    """evaluate path parameters for a list of paths, as an array
+    (8, npaths, 1).  This uses the larch interpreter for constraint
+    expressions."""
+    pars = np.zeros((8, len(paths), 1))
+    for i, path in enumerate(paths):
+        pars[:, i, 0] = path._pathparam_values()
+    return pars
+
+def _stack_paths(paths, k, interp='cubic', deriv=False, pars=None):
+    """evaluate path parameters and Feff.dat arrays for a list of paths,
+    stacked as arrays of pars (8, npaths, 1), reff (npaths, 1),
+    q (npaths, nk) and Feff.dat arrays (4, npaths, nk), and, with
+    deriv=True, derivatives of the Feff.dat arrays (4, npaths, nk).
+
+    If pars is given, as from _stack_pathparams(), path parameters are
+    not re-evaluated, and only numpy is used."""
+    npaths, nk = len(paths), len(k)
+    if pars is None:
+        pars = _stack_pathparams(paths)
+    reff  = np.zeros((npaths, 1))
+    q     = np.zeros((npaths, nk))
+    feffarrays = np.zeros((4, npaths, nk))
+    dfeffarrays = np.zeros((4, npaths, nk)) if deriv else None
+    for i, path in enumerate(paths):
+        out = path._chi_inputs(k, interp=interp, deriv=deriv,
+                               pars=pars[:, i, 0])
+        q[i] = out[1]
+        feffarrays[:, i, :] = out[2]
+        if deriv:
+            dfeffarrays[:, i, :] = out[3]
+        reff[i] = path._feffdat.reff
+    return pars, reff, q, feffarrays, dfeffarrays
+
+def _sum_paths_chi(pathlist, k=None, kmax=None, kstep=0.05,
+                   interp='cubic', path_outputs=True):
+    """calculate chi(k) for all paths in a pathlist at once.
+
+    All path parameters and Feff.dat arrays are stacked into 2-D
+    arrays and the XAFS equation is evaluated for all paths together.
+
+    Returns k, the sum of chi(k) for all paths, and the 2-D array of
+    chi(k) for each path (None for path_outputs=False).  With
+    path_outputs=True, k, p, chi, and chi_imag are also written to
+    each path, as for path._calc_chi().
+    """
+    paths = _valid_paths(pathlist)
+    k = pathlist[0]._make_k(k=k, kmax=kmax, kstep=kstep)
+    if len(paths) == 0:
+        return k, np.zeros_like(k), None
+
+    pars, reff, q, feffarrays, _ = _stack_paths(paths, k, interp=interp)
+    pha, amp, rep, lam = feffarrays
+    cchi, p = _xafs_chi(q, reff, pars, pha, amp, rep, lam)
+    chi = cchi.imag
+    if not path_outputs:
+        return k, chi.sum(axis=0), None
+    for i, path in enumerate(paths):
+        path.k = k
+        path.p = p[i]
+        path.chi = chi[i]
+        path.chi_imag = -cchi[i].real
+    return k, chi.sum(axis=0), chi
+
+def _sum_paths_dchi(pathlist, k, interp='cubic', pars=None):
+    """calculate derivatives of chi(k) with respect to path parameters
+    for all paths in a pathlist at once.
+
+    Returns the list of paths used, the array of their path parameter
+    values (npaths, 8), and the array of derivatives of chi(k) with
+    respect to these path parameters (npaths, 8, nk).
+
+    If pars is given, as from _stack_pathparams() for the paths, path
+    parameters are not re-evaluated, and only numpy is used.
+    """
+    paths = _valid_paths(pathlist)
+    if len(paths) == 0:
+        return paths, np.zeros((0, 8)), np.zeros((0, 8, len(k)))
+    pars, reff, q, feffarrays, dfeffarrays = _stack_paths(paths, k,
+                                                          interp=interp,
+                                                          deriv=True,
+                                                          pars=pars)
+    dchi = _xafs_dchi(q, reff, pars, *(tuple(feffarrays) +
+                                       tuple(dfeffarrays)))
+    return paths, pars[:, :, 0].T, dchi.swapaxes(0, 1)
+
 @ValidateLarchPlugin
 def _path2chi(path, paramgroup=None, _larch=None, **kws):
     """calculate chi(k) for a Feff Path,
@@ -432,8 +686,9 @@ def _ff2chi(pathlist, group=None, paramgroup=None, _larch=None,
     ---------
        group contain arrays for k and chi
 
-    This essentially calls path2chi() for each of the paths in the
-    pathlist and writes the resulting arrays to group.k and group.chi.
+    This is equivalent to calling path2chi() for each of the paths in the
+    pathlist, but evaluates all paths together as 2-D arrays, and writes
+    the resulting arrays to group.k and group.chi.
 
     """
     msg = _larch.writer.write
@@ -444,11 +699,7 @@ def _ff2chi(pathlist, group=None, paramgroup=None, _larch=None,
         if not isNamedClass(path, FeffPathGroup):
             msg('%s is not a valid Feff Path' % path)
             return
-        path._calc_chi(k=k, kstep=kstep, kmax=kmax)
-    k = pathlist[0].k[:]
-    out = np.zeros_like(k)
-    for path in pathlist:
-        out += path.chi
+    k, out, _ = _sum_paths_chi(pathlist, k=k, kstep=kstep, kmax=kmax)
 
     if group is None:
         group = Group()
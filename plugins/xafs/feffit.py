@@ -4,6 +4,7 @@
 """
 from collections import Iterable
 from copy import copy
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from numpy import array, arange, interp, pi, zeros, sqrt, concatenate
 
@@ -15,6 +16,9 @@ from larch import (Group, Parameter, isParameter, Minimizer,
 from larch_plugins.math import index_of, realimag, complex_phase
 from larch_plugins.xafs import (xftf_fast, xftr_fast, ftwindow,
                                 set_xafsGroup, FeffPathGroup, _ff2chi)
+from larch_plugins.xafs.feffdat import (_valid_paths, _stack_paths,
+                                        _stack_pathparams, _xafs_chi,
+                                        _sum_paths_dchi)
 
 # use larch's uncertainties package
 from larch.fitting import correlated_values, eval_stderr
@@ -282,13 +286,18 @@ class FeffitDataSet(Group):
         _ff2chi(self.pathlist, k=self.model.k,
                 _larch=self._larch, group=self.model)
 
+        diff  = (self.__chi - self.model.chi)
+        if data_only:  # for extracting transformed data separately from residual
+            diff  = self.__chi
+        return self._apply_transform(diff)
+
+    def _apply_transform(self, diff):
+        """apply the transform (k-weighting, windowing and FFTs, and
+        scaling by uncertainties) to chi(k) on the model k grid"""
         eps_k = self.epsilon_k
         if isinstance(eps_k, np.ndarray):
             eps_k[np.where(eps_k<1.e-12)[0]] = 1.e-12
 
-        diff  = (self.__chi - self.model.chi)
-        if data_only:  # for extracting transformed data separately from residual
-            diff  = self.__chi
         trans = self.transform
         k     = trans.k_[:len(diff)]
 
@@ -325,6 +334,99 @@ class FeffitDataSet(Group):
                     out.append( realimag(chiq_[iqmin:iqmax])[::2])
             return np.concatenate(out)
 
+    def _model_inputs(self, paramgroup=None):
+        """evaluate path parameters for all paths: returns the list of
+        paths and their values, as from _stack_pathparams(), or None if
+        there are no paths.
+
+        This uses the larch interpreter for constraint expressions, and
+        so must be run in the main thread.
+        """
+        if (paramgroup is not None and
+            self._larch.symtable.isgroup(paramgroup)):
+            self._larch.symtable._sys.paramGroup = paramgroup
+        if not self.__prepared:
+            self.prepare_fit()
+        paths = _valid_paths(self.pathlist)
+        if len(paths) == 0:
+            return None
+        return paths, _stack_pathparams(paths)
+
+    def _residual_from_inputs(self, inputs):
+        """return the residual for this data set from the output of
+        _model_inputs():  the Feff.dat interpolation, the XAFS equation
+        for all paths and the transform.  This uses only numpy, and can
+        be run in a worker thread."""
+        chi = np.zeros(len(self.model.k))
+        if inputs is not None:
+            paths, pars = inputs
+            pars, reff, q, feffarrays, _ = _stack_paths(paths, self.model.k,
+                                                        pars=pars)
+            cchi, p = _xafs_chi(q, reff, pars, *feffarrays)
+            chi = cchi.imag.sum(axis=0)
+        self.model.chi = chi
+        return self._apply_transform(self.__chi - chi)
+
+    def _jacobian_inputs(self, paramgroup, var_names):
+        """evaluate path parameters and their derivatives for all paths:
+        returns the list of paths, their values as from _stack_pathparams(),
+        and the derivatives of the path parameters with respect to the
+        named variables (nvars, npaths, 8), or None if there are no paths.
+
+        The derivatives of path parameters with respect to variables are
+        found numerically, re-evaluating only path parameters and
+        constraint expressions.  This uses the larch interpreter, and so
+        must be run in the main thread.
+        """
+        if self._larch.symtable.isgroup(paramgroup):
+            self._larch.symtable._sys.paramGroup = paramgroup
+        if not self.__prepared:
+            self.prepare_fit()
+        paths = _valid_paths(self.pathlist)
+        if len(paths) == 0:
+            return None
+        pars = _stack_pathparams(paths)
+        pvals = pars[:, :, 0].T
+
+        dpars = np.zeros((len(var_names), len(paths), 8))
+        for ivar, name in enumerate(var_names):
+            par = getattr(paramgroup, name)
+            val = par._val
+            step = 1.e-7 * max(abs(val), 1.e-3)
+            if par.max is not None and val + step > par.max:
+                step = -step
+            par._val = val + step
+            for ipath, path in enumerate(paths):
+                dpars[ivar, ipath] = path._pathparam_values()
+            par._val = val
+            dpars[ivar] = (dpars[ivar] - pvals) / step
+        return paths, pars, dpars
+
+    def _jacobian_from_inputs(self, inputs, nvars):
+        """return the Jacobian of the residual for this data set from
+        the output of _jacobian_inputs().
+
+        The derivatives of chi(k) for each path with respect to its path
+        parameters are calculated analytically and chained to the
+        variables, and the transform is applied once for each variable.
+        This uses only numpy, and can be run in a worker thread.
+        """
+        if inputs is None:
+            dmodel = np.zeros((nvars, len(self.model.k)))
+        else:
+            paths, pars, dpars = inputs
+            paths, pvals, dchi = _sum_paths_dchi(paths, self.model.k,
+                                                 pars=pars)
+            dmodel = np.einsum('vpj,pjk->vk', dpars, dchi)
+        out = [-self._apply_transform(dmod) for dmod in dmodel]
+        return np.array(out).transpose()
+
+    def _jacobian(self, paramgroup, var_names):
+        """return the Jacobian of the residual for this data set with
+        respect to the values of the named variable parameters."""
+        return self._jacobian_from_inputs(
+            self._jacobian_inputs(paramgroup, var_names), len(var_names))
+
     def save_ffts(self, rmax_out=10, path_outputs=True):
         "save fft outputs"
         xft = self.transform._xafsft
@@ -334,6 +436,14 @@ class FeffitDataSet(Group):
             for p in self.pathlist:
                 xft(p.chi, group=p, rmax_out=rmax_out)
 
+def _dataset_residual(dataset, inputs):
+    "residual for one dataset from its path parameters, in a worker thread"
+    return dataset._residual_from_inputs(inputs)
+
+def _dataset_jacobian(dataset, inputs, nvars):
+    "Jacobian for one dataset from its path parameters, in a worker thread"
+    return dataset._jacobian_from_inputs(inputs, nvars)
+
 @ValidateLarchPlugin
 def feffit_dataset(data=None, pathlist=None, transform=None,
                    epsilon_k=None, _larch=None):
@@ -384,7 +494,8 @@ def feffit_transform(_larch=None, **kws):
     return TransformGroup(_larch=_larch, **kws)
 
 @ValidateLarchPlugin
-def feffit(params, datasets, _larch=None, rmax_out=10, path_outputs=True, **kws):
+def feffit(params, datasets, _larch=None, rmax_out=10, path_outputs=True,
+           use_jacobian=True, nworkers=1, **kws):
     """execute a Feffit fit: a fit of feff paths to a list of datasets
 
     Parameters:
@@ -393,6 +504,17 @@ def feffit(params, datasets, _larch=None, rmax_out=10, path_outputs=True, **kws)
       datasets:     Feffit Dataset group or list of Feffit Dataset group.
       rmax_out:     maximum R value to calculate output arrays.
       path_output:  Flag to set whether all Path outputs should be written.
+      use_jacobian: Flag to set whether to use the analytic Jacobian of
+                    the XAFS equation, instead of finite differences [True].
+      nworkers:     number of worker threads used to evaluate the datasets
+                    of a multi-dataset fit in parallel [1].  Path
+                    parameters and constraint expressions use the larch
+                    interpreter, and are still evaluated in the calling
+                    thread, one dataset at a time, overlapping with the
+                    worker threads.  Only the Feff.dat interpolation, the
+                    XAFS equation and its derivatives, and the Fourier
+                    transforms run in parallel, so fits dominated by
+                    constraint evaluation will not scale with nworkers.
 
     Returns:
     ---------
@@ -417,7 +539,28 @@ def feffit(params, datasets, _larch=None, rmax_out=10, path_outputs=True, **kws)
 
     def _resid(params, datasets=None, _larch=None, **kwargs):
         """ this is the residual function"""
-        return concatenate([d._residual() for d in datasets])
+        if pool is None:
+            return concatenate([d._residual() for d in datasets])
+        # each dataset is sent to a worker as soon as its path parameters
+        # are evaluated, so the next dataset's parameters are evaluated
+        # while the workers run
+        jobs = [pool.apply_async(_dataset_residual,
+                                 (d, d._model_inputs(params)))
+                for d in datasets]
+        return concatenate([job.get() for job in jobs])
+
+    def _jacob(params, datasets=None, _larch=None, **kwargs):
+        """ this is the Jacobian function"""
+        nvars = len(fit.var_names)
+        if pool is None:
+            return concatenate([d._jacobian(params, fit.var_names)
+                                for d in datasets])
+        jobs = [pool.apply_async(_dataset_jacobian,
+                                 (d, d._jacobian_inputs(params,
+                                                        fit.var_names),
+                                  nvars))
+                for d in datasets]
+        return concatenate([job.get() for job in jobs])
 
     if isNamedClass(datasets, FeffitDataSet):
         datasets = [datasets]
@@ -429,7 +572,20 @@ def feffit(params, datasets, _larch=None, rmax_out=10, path_outputs=True, **kws)
     fit = Minimizer(_resid, params, fcn_kws=fitkws,
                     scale_covar=True,  _larch=_larch, **kws)
 
-    fit.leastsq()
+    # Feff.dat interpolation, numpy and FFT work for each dataset is done
+    # in worker threads, while path parameters are evaluated in this thread.
+    pool = None
+    if nworkers > 1 and len(datasets) > 1:
+        pool = ThreadPool(min(nworkers, len(datasets)))
+    try:
+        if use_jacobian:
+            fit.leastsq(Dfun=_jacob)
+        else:
+            fit.leastsq()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     dat = concatenate([d._residual(data_only=True) for d in datasets])
     params.rfactor = (params.fit_details.fvec**2).sum() / (dat**2).sum()
 
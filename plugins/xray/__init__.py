@@ -14,5 +14,5 @@ from .xraydb_plugin import (atomic_mass, atomic_number,
                             mu_chantler, f1_chantler, f2_chantler,
                             core_width, chantler_data)
 
-from .materials import material_mu, material_get
+from .materials import material_mu, material_get, Material, get_material
 from .cromer_liberman import f1f2
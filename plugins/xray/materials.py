@@ -3,8 +3,12 @@ import numpy as np
 from larch import ValidateLarchPlugin, site_config
 
 from larch_plugins.xray import chemparse, mu_elam, atomic_mass
+from larch_plugins.xray.xraydb_plugin import get_xraydb
 
 MODNAME = '_xray'
+MAX_COMPILED = 256  # number of compiled materials kept for material_mu()
+MU_BLOCKSIZE = 16384 # energies per block when calculating Material.mu
+GRID_OFFSET = 32.0  # shift between log energy grids packed in a Material
 
 def get_materials(_larch):
     """return _materials dictionary, creating it if needed"""
@@ -33,6 +37,168 @@ def get_materials(_larch):
     _larch.symtable.set_symbol(symname, mat)
     return mat
 
+def _resolve_material(name, density, materials):
+    """formula and density for a material name or formula"""
+    formula = None
+    mater = materials.get(name.lower(), None)
+    if mater is not None:
+        formula, density = mater
+    else:
+        for key, val in materials.items():
+            if name.lower() == val[0].lower(): # match formula
+                formula, density = val
+                break
+    # default to using passed in name as a formula
+    if formula is None:
+        formula = name
+    return formula, density
+
+class Material(object):
+    """X-ray attenuation of a compound, compiled for repeated use
+
+    The formula is parsed once, and the Elam tables for all elements
+    are packed together with their mass fractions.  mu(energy) brackets
+    all energies in all tables at once, then sums one vectorized spline
+    per element and cross-section.  The result for the last energies
+    is kept, so repeated calls on one energy grid are very fast.
+
+    Parameters
+    ----------
+    formula   chemical formula
+    density   density in gr/cm^3
+    kind      'photo' or 'total' (default) cross-section
+
+    Example
+    -------
+      >>> water = Material('H2O', 1.0, _larch=_larch)
+      >>> water.mu(np.linspace(5000, 20000, 1501))
+    """
+    def __init__(self, formula, density, kind='total', _larch=None):
+        self.formula = formula
+        self.density = density
+        self.kind = kind
+        xdb = get_xraydb(_larch)
+        kinds = ('photo',)
+        if kind.lower().startswith('tot'):
+            kinds = ('photo', 'coh', 'incoh')
+
+        elements, masses = [], []
+        for elem, frac in chemparse(formula).items():
+            elements.append(elem)
+            masses.append(frac * xdb._getElementData(elem).molar_mass)
+        masses = np.array(masses)
+        self.elements = elements
+        self.mass = masses.sum()
+
+        # Elam tables for all elements are packed into one array of log
+        # energies, with each energy grid shifted by GRID_OFFSET from the
+        # previous one.  Each term (element and cross-section) has its
+        # values and spline coefficients at the positions of its grid.
+        grids, terms = [], []
+        for elem, mass in zip(elements, masses):
+            egrids = []
+            for kind_ in kinds:
+                lne, val, spl = xdb._getElamTable(elem, kind_)
+                for igrid in egrids:
+                    if np.array_equal(grids[igrid], lne):
+                        break
+                else:
+                    egrids.append(len(grids))
+                    igrid = len(grids)
+                    grids.append(lne)
+                terms.append((igrid, density*mass/self.mass, val, spl))
+
+        ngrid = len(grids)
+        lens = [len(g) for g in grids]
+        self._gstart = np.cumsum([0] + lens)[:-1]
+        self._gstop = self._gstart + lens
+        self._gshift = GRID_OFFSET*np.arange(ngrid)
+        self._gmin = np.array([max(np.log(10*int(0.102*np.exp(g[0]))), g[0])
+                               for g in grids])
+        self._gmax = np.array([g[-1] for g in grids])
+        self._lne = np.concatenate([g + s for g, s in zip(grids, self._gshift)])
+
+        self._tgrid = np.array([t[0] for t in terms])
+        self._tweight = np.array([t[1] for t in terms])
+        self._tval = np.zeros((len(terms), len(self._lne)))
+        self._tspl = np.zeros((len(terms), len(self._lne)))
+        for i, (igrid, weight, val, spl) in enumerate(terms):
+            self._tval[i, self._gstart[igrid]:self._gstop[igrid]] = val
+            self._tspl[i, self._gstart[igrid]:self._gstop[igrid]] = spl
+        self._last = (None, None)
+
+    def __repr__(self):
+        return "<Material %s, density=%g, kind='%s'>" % (self.formula,
+                                                        self.density,
+                                                        self.kind)
+
+    def _mu(self, lne):
+        "mu for a 1-d array of log energies"
+        # bracket points in all grids at once
+        x = np.clip(lne[np.newaxis, :], self._gmin[:, np.newaxis],
+                    self._gmax[:, np.newaxis])
+        x += self._gshift[:, np.newaxis]
+        lo = np.searchsorted(self._lne, x, side='left') - 1
+        hi = np.searchsorted(self._lne, x, side='right')
+        lo = np.clip(lo, self._gstart[:, np.newaxis],
+                     self._gstop[:, np.newaxis] - 2)
+        hi = np.clip(hi, self._gstart[:, np.newaxis] + 1,
+                     self._gstop[:, np.newaxis] - 1)
+        diff = self._lne[hi] - self._lne[lo]
+        a = (self._lne[hi] - x) / diff
+        b = (x - self._lne[lo]) / diff
+        diff2 = diff*diff/6
+        sa, sb = diff2*(a*a - 1)*a, diff2*(b*b - 1)*b
+
+        # sum of splines for each term, as elam_spline()
+        out = np.zeros(len(lne))
+        for igrid, weight, val, spl in zip(self._tgrid, self._tweight,
+                                           self._tval, self._tspl):
+            glo, ghi = lo[igrid], hi[igrid]
+            lnmu = a[igrid]*val.take(glo)
+            lnmu += b[igrid]*val.take(ghi)
+            lnmu += sa[igrid]*spl.take(glo)
+            lnmu += sb[igrid]*spl.take(ghi)
+            out += weight*np.exp(lnmu)
+        return out
+
+    def mu(self, energy):
+        """X-ray attenuation (1/cm) at energy or array of energies (eV),
+        which can have any shape"""
+        energy = np.asarray(energy, dtype=np.float64)
+        key = (energy.shape, energy.tobytes())
+        if key == self._last[0]:
+            out = self._last[1].copy()
+        else:
+            lne = np.log(energy.ravel())
+            out = np.zeros(len(lne))
+            for i in range(0, len(lne), MU_BLOCKSIZE):
+                out[i:i+MU_BLOCKSIZE] = self._mu(lne[i:i+MU_BLOCKSIZE])
+            self._last = (key, out.copy())
+        if energy.ndim < 2 and out.size == 1:
+            return out[0]
+        return out.reshape(energy.shape)
+
+def get_material(name, density=None, kind='total', _larch=None):
+    """return a compiled Material for a material name or formula,
+    re-using one made for the same (name, density, kind)"""
+    symname = '%s._compiled_materials' % MODNAME
+    if _larch.symtable.has_symbol(symname):
+        compiled = _larch.symtable.get_symbol(symname)
+    else:
+        compiled = {}
+        _larch.symtable.set_symbol(symname, compiled)
+    key = (name, density, kind)
+    if key not in compiled:
+        formula, density = _resolve_material(name, density,
+                                             get_materials(_larch))
+        if density is None:
+            raise Warning('material_mu(): must give density for unknown materials')
+        if len(compiled) >= MAX_COMPILED:
+            compiled.clear()
+        compiled[key] = Material(formula, density, kind=kind, _larch=_larch)
+    return compiled[key]
+
 @ValidateLarchPlugin
 def material_mu(name, energy, density=None, kind='total', _larch=None):
     """
@@ -50,41 +216,23 @@ def material_mu(name, energy, density=None, kind='total', _larch=None):
                return photo-absorption or total cross-section.
     returns
     -------
-     mu, absorption length in 1/cm
+     mu, absorption length in 1/cm, with the shape of energy
 
     notes
     -----
       1.  material names are not case sensitive,
           chemical compounds are case sensitive.
       2.  mu_elam() is used for mu calculation.
+      3.  the material is compiled (see Material) once for each
+          name, density, and kind.
 
     example
     -------
       >>> print material_mu('H2O', 10000.0)
       5.32986401658495
     """
-    _materials = get_materials(_larch)
-    formula = None
-    mater = _materials.get(name.lower(), None)
-    if mater is not None:
-        formula, density = mater
-    else:
-        for key, val in _materials.items():
-            if name.lower() == val[0].lower(): # match formula
-                formula, density = val
-                break
-    # default to using passed in name as a formula
-    if formula is None:
-        formula = name
-    if density is None:
-        raise Warning('material_mu(): must give density for unknown materials')
-
-    mass_tot, mu = 0.0, 0.0
-    for elem, frac in chemparse(formula).items():
-        mass  = frac * atomic_mass(elem, _larch=_larch)
-        mu   += mass * mu_elam(elem, energy, kind=kind, _larch=_larch)
-        mass_tot += mass
-    return density*mu/mass_tot
+    return get_material(name, density=density, kind=kind,
+                        _larch=_larch).mu(energy)
 
 @ValidateLarchPlugin
 def material_mu_components(name, energy, density=None, kind='total',
@@ -143,6 +291,9 @@ def material_add(name, formula, density, _larch=None):
 
     symname = '%s._materials' % MODNAME
     _larch.symtable.set_symbol(symname, materials)
+    symname = '%s._compiled_materials' % MODNAME
+    if _larch.symtable.has_symbol(symname):
+        _larch.symtable.get_symbol(symname).clear()
 
     fname = os.path.join(larch.site_config.larchdir, 'materials.dat')
     if os.path.exists(fname):
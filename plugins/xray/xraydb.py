@@ -10,6 +10,7 @@ import os
 import time
 import json
 import six
+from collections import namedtuple, OrderedDict
 import numpy as np
 from scipy.interpolate import interp1d, splrep, splev, UnivariateSpline
 from sqlalchemy import MetaData, create_engine
@@ -59,27 +60,53 @@ def json_encode(val):
     return  json.dumps(val)
 
 
-def elam_spline(xin, yin, yspl_in, x):
-    """ interpolate values from Elam photoabsorption and scattering tables,
-    according to Elam, Numerical Recipes.  Calc borrowed from D. Dale.
-    """
-    x = as_ndarray(x)
-    x[np.where(x < min(xin))] =  min(xin)
-    x[np.where(x > max(xin))] =  max(xin)
+ELAM_GRID_CACHE = 32  # number of energy grids with saved spline weights
+CHANTLER_CACHE = 256  # number of Chantler tables and interpolants kept
 
-    lo, hi = np.array([(np.flatnonzero(xin < e)[-1],
-                        np.flatnonzero(xin > e)[0])
-                       for e in x]).transpose()
+def elam_spline_weights(xin, x):
+    """bracketing indices and weights for elam_spline(), for values at x
+    from a table at xin.  These depend only on xin and x, and can be
+    re-used for all tables on the same xin.
+
+    returns tuple (lo, hi, wlo, whi, slo, shi) of arrays for
+       y = wlo*yin[lo] + whi*yin[hi] + slo*yspl_in[lo] + shi*yspl_in[hi]
+    """
+    xin = np.asarray(xin)
+    x = np.clip(as_ndarray(x), xin.min(), xin.max())
+    nin = len(xin)
+    # lo is the last point below x, hi the first point above x
+    lo = np.clip(np.searchsorted(xin, x, side='left') - 1, 0, nin-2)
+    hi = np.clip(np.searchsorted(xin, x, side='right'), 1, nin-1)
 
     diff = xin[hi] - xin[lo]
     if any(diff <= 0):
         raise ValueError('x must be strictly increasing')
     a = (xin[hi] - x) / diff
     b = (x - xin[lo]) / diff
-    return (a * yin[lo] + b * yin[hi] +
-            (diff*diff/6) * ((a*a - 1) * a * yspl_in[lo] +
-                             (b*b - 1) * b * yspl_in[hi] ))
+    diff2 = diff*diff/6
+    return lo, hi, a, b, diff2*(a*a - 1)*a, diff2*(b*b - 1)*b
+
+def elam_spline(xin, yin, yspl_in, x, weights=None):
+    """ interpolate values from Elam photoabsorption and scattering tables,
+    according to Elam, Numerical Recipes.  Calc borrowed from D. Dale.
+
+    weights from elam_spline_weights(xin, x) can be given to skip
+    finding them again.
+    """
+    if weights is None:
+        weights = elam_spline_weights(xin, x)
+    lo, hi, wlo, whi, slo, shi = weights
+    return (wlo*yin[lo] + whi*yin[hi] + slo*yspl_in[lo] + shi*yspl_in[hi])
+
 
+class LogLogInterp(object):
+    """linear interpolation of log(y) vs log(x) for tabulated x, y"""
+    def __init__(self, x, y):
+        self.lnx = np.log(x)
+        self.lny = np.log(y)
+
+    def __call__(self, x):
+        return np.exp(np.interp(np.log(x), self.lnx, self.lny))
 
 class DBException(Exception):
     """DB Access Exception: General Errors"""
@@ -145,9 +172,125 @@ class ChantlerTable(_BaseTable):
      corr_henke, corr_cl35, corr_nucl,
      energy, f1, f2, mu_photo, mu_incoh, mu_total) = [None]*14
 
+ElementData = namedtuple('ElementData', ('atomic_number', 'element',
+                                         'molar_mass', 'density'))
+CoreholeWidth = namedtuple('CoreholeWidth', ('atomic_number', 'element',
+                                             'edge', 'width'))
+
+CHANTLER_COLUMNS = ('energy', 'f1', 'f2', 'mu_photo', 'mu_incoh', 'mu_total')
+ELAM_PHOTO_COLUMNS = ('log_energy', 'log_photoabsorption',
+                      'log_photoabsorption_spline')
+ELAM_SCATTER_COLUMNS = ('log_energy',
+                        'log_coherent_scatter', 'log_coherent_scatter_spline',
+                        'log_incoherent_scatter', 'log_incoherent_scatter_spline')
+
+class _PackedArrays(object):
+    """arrays stored as JSON in columns of a table, decoded once and
+    packed into a single float64 array per column, with offsets
+    for each row.  Rows are found by the values of `keys` attributes.
+    """
+    def __init__(self, rows, columns, keys=('element',)):
+        self.index = {}
+        self.data = {}
+        self.offsets = {}
+        arrays = dict([(col, []) for col in columns])
+        for irow, row in enumerate(rows):
+            for key in keys:
+                self.index[getattr(row, key)] = irow
+            for col in columns:
+                arrays[col].append(np.array(json.loads(getattr(row, col)),
+                                            dtype=np.float64))
+        for col in columns:
+            lens = [len(a) for a in arrays[col]]
+            self.offsets[col] = np.cumsum([0] + lens)
+            if len(lens) > 0:
+                self.data[col] = np.concatenate(arrays[col])
+            else:
+                self.data[col] = np.zeros(0)
+
+    def get(self, key, column):
+        """array for a row and column (a view of the packed array),
+        or None if there is no row for key"""
+        irow = self.index.get(key, None)
+        if irow is None:
+            return None
+        off = self.offsets[column]
+        return self.data[column][off[irow]:off[irow+1]]
+
+    @property
+    def nbytes(self):
+        return sum([a.nbytes for a in self.data.values()] +
+                   [a.nbytes for a in self.offsets.values()])
+
+class XrayDBCache(object):
+    """in-memory copy of the tables of an xrayDB, read once.
+
+    Tabulated energies and values (Chantler f1, f2, and mu, Elam
+    log cross-sections with their spline coefficients) are decoded
+    to packed float64 arrays, other tables are held in dictionaries
+    and lists.  load_time is the time (seconds) taken to read the
+    tables, and nbytes the size of the packed arrays.
+    """
+    def __init__(self, xdb):
+        t0 = time.time()
+        query = xdb.query
+        self.elements = {}
+        for row in query(ElementsTable).all():
+            dat = ElementData(int(row.atomic_number), str(row.element),
+                              row.molar_mass, row.density)
+            self.elements[dat.atomic_number] = dat
+            self.elements[dat.element] = dat
+
+        self.chantler = _PackedArrays(query(ChantlerTable).all(),
+                                      CHANTLER_COLUMNS, keys=('id', 'element'))
+        self.photo = _PackedArrays(query(PhotoAbsorptionTable).all(),
+                                   ELAM_PHOTO_COLUMNS)
+        self.scatter = _PackedArrays(query(ScatteringTable).all(),
+                                     ELAM_SCATTER_COLUMNS)
+
+        self.edges = {}
+        for row in query(XrayLevelsTable).all():
+            edges = self.edges.setdefault(row.element, {})
+            edges[str(row.iupac_symbol)] = (row.absorption_edge,
+                                            row.fluorescence_yield,
+                                            row.jump_ratio)
+        self.lines = {}
+        for row in query(XrayTransitionsTable).all():
+            lines = self.lines.setdefault(row.element, [])
+            lines.append((str(row.siegbahn_symbol), row.emission_energy,
+                          row.intensity, row.initial_level, row.final_level))
+
+        self.waasmaier = []
+        for row in query(WaasmaierTable).all():
+            self.waasmaier.append((row.atomic_number, row.element,
+                                   str(row.ion), row.offset,
+                                   np.array(json.loads(row.scale)),
+                                   np.array(json.loads(row.exponents))))
+        self.coster_kronig = {}
+        for row in query(CosterKronigTable).all():
+            key = (row.element, row.initial_level, row.final_level)
+            self.coster_kronig[key] = (row.transition_probability,
+                                       row.total_transition_probability)
+        self.corehole_widths = []
+        for row in query(KeskiRahkonenKrauseTable).all():
+            self.corehole_widths.append(CoreholeWidth(row.atomic_number,
+                                                      row.element, row.edge,
+                                                      row.width))
+        self.load_time = time.time() - t0
+
+    @property
+    def nbytes(self):
+        return (self.chantler.nbytes + self.photo.nbytes +
+                self.scatter.nbytes +
+                sum([w[4].nbytes + w[5].nbytes for w in self.waasmaier]))
+
 class xrayDB(object):
-    "interface to Xray Data"
-    def __init__(self, dbname='xrayref.db', read_only=True):
+    """interface to Xray Data
+
+    With cache=True, all tables are read into memory (see XrayDBCache)
+    when the database is opened, and all lookups use that copy.
+    """
+    def __init__(self, dbname='xrayref.db', read_only=True, cache=False):
         "connect to an existing database"
         if not os.path.exists(dbname):
             parent, child = os.path.split(__file__)
@@ -186,6 +329,31 @@ class xrayDB(object):
         mapper(PhotoAbsorptionTable,     tables['photoabsorption'])
         mapper(ScatteringTable,          tables['scattering'])
 
+        self.cache = None
+        self._elam_grids = {}
+        self._chantler_interps = OrderedDict()
+        if cache:
+            self.load_cache()
+
+    def load_cache(self, verbose=False):
+        """read all tables into memory, to be used for all later lookups.
+        returns dictionary of load time (seconds) and size (bytes) of
+        the cached arrays"""
+        self.cache = XrayDBCache(self)
+        info = self.cache_info()
+        if verbose:
+            print("xrayDB cache: %.3f sec, %.2f MB" % (info['load_time'],
+                                                       info['nbytes']/2.0**20))
+        return info
+
+    def cache_info(self):
+        """return dictionary of load time (seconds) and size (bytes)
+        of the in-memory cache, or None if not using a cache"""
+        if self.cache is None:
+            return None
+        return {'load_time': self.cache.load_time,
+                'nbytes': self.cache.nbytes}
+
 
     def close(self):
         "close session"
@@ -208,6 +376,14 @@ class xrayDB(object):
         if element is None, all 211 ions are returned.  If element is
         not None, the ions for that element (atomic symbol) are returned
         """
+        if self.cache is not None:
+            rows = self.cache.waasmaier
+            if isinstance(element, int):
+                rows = [r for r in rows if r[0] == element]
+            elif element is not None:
+                rows = [r for r in rows if r[1] == element.title()]
+            return [r[2] for r in rows]
+
         rows = self.query(WaasmaierTable)
         if element is not None:
             if isinstance(element, int):
@@ -232,54 +408,119 @@ class xrayDB(object):
         Z values from 1 to 98 (and symbols 'H' to 'Cf') are supported.
         The list of ionic symbols can be read with the function .f0_ions()
         """
-        tab = WaasmaierTable
+        if self.cache is not None:
+            if isinstance(ion, int):
+                rows = [r for r in self.cache.waasmaier if r[0] == ion]
+            else:
+                rows = [r for r in self.cache.waasmaier if r[2] == ion.title()]
+            if len(rows) < 1:
+                return None
+            offset, scale, exponents = rows[0][3:]
+        else:
+            tab = WaasmaierTable
+            row = self.query(tab)
+            if isinstance(ion, int):
+                row = row.filter(tab.atomic_number==ion).all()
+            else:
+                row = row.filter(tab.ion==ion.title()).all()
+            if len(row) > 0:
+                row = row[0]
+            if not isinstance(row, tab):
+                return None
+            offset = row.offset
+            scale, exponents = json.loads(row.scale), json.loads(row.exponents)
+        q = as_ndarray(q)
+        f0 = offset
+        for s, e in zip(scale, exponents):
+            f0 += s * np.exp(-e*q*q)
+        return f0
+
+    def _getChantlerData(self, element, columns):
+        """return list of arrays of columns from Chantler table,
+        or None if element is not found"""
+        if self.cache is not None:
+            key = element if isinstance(element, int) else element.title()
+            out = [self.cache.chantler.get(key, col) for col in columns]
+            if out[0] is None:
+                return None
+            return out
+        tab = ChantlerTable
         row = self.query(tab)
-        if isinstance(ion, int):
-            row = row.filter(tab.atomic_number==ion).all()
+        if isinstance(element, int):
+            row = row.filter(tab.id==element).all()
         else:
-            row = row.filter(tab.ion==ion.title()).all()
+            row = row.filter(tab.element==element.title()).all()
         if len(row) > 0:
             row = row[0]
-        if isinstance(row, tab):
-            q = as_ndarray(q)
-            f0 = row.offset
-            for s, e in zip(json.loads(row.scale), json.loads(row.exponents)):
-                f0 += s * np.exp(-e*q*q)
-            return f0
+        if not isinstance(row, tab):
+            return None
+        return [np.array(json.loads(getattr(row, col))) for col in columns]
 
     def _getChantler(self, element, energy, column='f1', smoothing=0):
         """return energy-dependent data from Chantler table
         columns: f1, f2, mu_photo, mu_incoh, mu_total
         """
-        tab = ChantlerTable
-        row = self.query(tab)
-        if isinstance(element, int):
-            row = row.filter(tab.id==element).all()
+        out = self.chantler_interp(element, as_ndarray(energy),
+                                   column=column, smoothing=smoothing)
+        if isinstance(out, np.ndarray) and len(out) == 1:
+            return out[0]
+        return out
+
+    def _chantler_cached(self, key, create):
+        """return item from the cache of Chantler tables and interpolants,
+        calling create() to make it if needed, and dropping the least
+        recently used item if the cache is full"""
+        cache = self._chantler_interps
+        if key in cache:
+            val = cache.pop(key)
         else:
-            row = row.filter(tab.element==element.title()).all()
-        if len(row) > 0:
-            row = row[0]
-        if isinstance(row, tab):
-            energy = as_ndarray(energy)
-            emin, emax = min(energy), max(energy)
-            # te = self.chantler_energies(element, emin=emin, emax=emax)
-            te = np.array(json.loads(row.energy))
-            nemin = max(0, -5 + max(np.where(te<=emin)[0]))
-            nemax = min(len(te), 6 + max(np.where(te<=emax)[0]))
-            region = np.arange(nemin, nemax)
-            te = te[region]
-            if column == 'mu':
-                column = 'mu_total'
-            ty = np.array(json.loads(getattr(row, column)))[region]
-            if column == 'f1':
-                out = UnivariateSpline(te, ty, s=smoothing)(energy)
-            else:
-                out = np.exp(np.interp(np.log(energy),
-                                       np.log(te),
-                                       np.log(ty)))
-            if isinstance(out, np.ndarray) and len(out) == 1:
-                return out[0]
-            return out
+            val = create()
+            if val is None:
+                return None
+            while len(cache) >= CHANTLER_CACHE:
+                cache.popitem(last=False)
+        cache[key] = val
+        return val
+
+    def chantler_interp(self, element, energy, column='f1', smoothing=0):
+        """return energy-dependent data from Chantler table, as an
+        array with the shape of energy (array of energies in eV).
+        columns: f1, f2, mu_photo, mu_incoh, mu (or mu_total)
+
+        The interpolants are kept (up to CHANTLER_CACHE of them) for
+        later calls:  log-log interpolation of the whole table for
+        f2 and mu, and for f1 a spline over the table points near the
+        requested energies, which is re-used for energies near the
+        same table points.
+        """
+        if column == 'mu':
+            column = 'mu_total'
+        if not isinstance(element, int):
+            element = element.title()
+
+        def get_column(col):
+            dat = self._getChantlerData(element, (col,))
+            return None if dat is None else dat[0]
+
+        te = self._chantler_cached((element, 'energy'),
+                                   lambda: get_column('energy'))
+        if te is None:
+            return None
+        energy = np.asarray(energy)
+        if column == 'f1':
+            nemin = te.searchsorted(energy.min(), side='right') - 1
+            nemax = te.searchsorted(energy.max(), side='right') - 1
+            nemin = max(0, -5 + nemin)
+            nemax = min(len(te), 6 + nemax)
+            def create():
+                ty = get_column(column)
+                return UnivariateSpline(te[nemin:nemax], ty[nemin:nemax],
+                                        s=smoothing)
+            key = (element, column, smoothing, nemin, nemax)
+        else:
+            create = lambda: LogLogInterp(te, get_column(column))
+            key = (element, column)
+        return self._chantler_cached(key, create)(energy)
 
     def chantler_energies(self, element, emin=0, emax=1.e9):
         """ return array of energies (in eV) at which data is
@@ -292,19 +533,10 @@ class xrayDB(object):
         emin:  lower bound of energies in eV returned (default=0)
         emax:  upper bound of energies in eV returned (default=1.e9)
         """
-        tab = ChantlerTable
-        row = self.query(tab)
-        if isinstance(element, int):
-            row = row.filter(tab.id==element).all()
-        else:
-            row = row.filter(tab.element==element.title()).all()
-        if len(row) > 0:
-            row = row[0]
-        if not isinstance(row, tab):
+        dat = self._getChantlerData(element, ('energy',))
+        if dat is None:
             return None
-        te = np.array(json.loads(row.energy))
-        tf1 = np.array(json.loads(row.f1))
-        tf2 = np.array(json.loads(row.f2))
+        te = dat[0]
 
         if emin <= min(te):
             nemin = 0
@@ -346,6 +578,10 @@ class xrayDB(object):
 
     def _getElementData(self, element):
         "get data from elements table"
+        if self.cache is not None:
+            if not isinstance(element, int):
+                element = element.title()
+            return self.cache.elements.get(element, None)
         tab = ElementsTable
         row = self.query(tab)
         if isinstance(element, int):
@@ -382,6 +618,8 @@ class xrayDB(object):
         """
         if isinstance(element, int):
             element = self.symbol(element)
+        if self.cache is not None:
+            return dict(self.cache.edges.get(element.title(), {}))
         tab = XrayLevelsTable
         out = {}
         for r in self.query(tab).filter(tab.element==element.title()).all():
@@ -412,14 +650,25 @@ class xrayDB(object):
         """
         if isinstance(element, int):
             element = self.symbol(element)
-        tab = XrayTransitionsTable
-        row = self.query(tab).filter(tab.element==element.title())
         if excitation_energy is not None:
             initial_level = []
             for ilevel, dat in self.xray_edges(element).items():
                 if dat[0] < excitation_energy:
                     initial_level.append(ilevel.title())
 
+        if self.cache is not None:
+            rows = self.cache.lines.get(element.title(), [])
+            if initial_level is not None:
+                if not isinstance(initial_level, (list, tuple)):
+                    initial_level = [initial_level.title()]
+                rows = [r for r in rows if r[3] in initial_level]
+            out = {}
+            for r in rows:
+                out[r[0]] = r[1:]
+            return out
+
+        tab = XrayTransitionsTable
+        row = self.query(tab).filter(tab.element==element.title())
         if initial_level is not None:
             if isinstance(initial_level, (list, tuple)):
                 row = row.filter(tab.initial_level.in_(initial_level))
@@ -436,6 +685,12 @@ class xrayDB(object):
         """
         if isinstance(element, int):
             element = self.symbol(element)
+        if self.cache is not None:
+            key = (element.title(), initial.title(), final.title())
+            probs = self.cache.coster_kronig.get(key, None)
+            if probs is not None:
+                return probs[1] if total else probs[0]
+            return None
         tab = CosterKronigTable
         row = self.query(tab).filter(
             tab.element==element.title()
@@ -455,18 +710,28 @@ class xrayDB(object):
         """returns core hole width for an element and edge
         if element is None, values are returned for all elements
         if edge is None, values are return for all edges"""
-        tab = KeskiRahkonenKrauseTable
-        rows = self.query(tab)
         has_elem = element is not None
         has_edge = edge is not None
-        if has_elem:
-            if isinstance(element, int):
-                rows = rows.filter(tab.atomic_number==element)
-            else:
-                rows = rows.filter(tab.element==element.title())
-        if has_edge:
-            rows = rows.filter(tab.edge==edge.title())
-        out = rows.all()
+        if self.cache is not None:
+            out = self.cache.corehole_widths
+            if has_elem:
+                if isinstance(element, int):
+                    out = [r for r in out if r.atomic_number == element]
+                else:
+                    out = [r for r in out if r.element == element.title()]
+            if has_edge:
+                out = [r for r in out if r.edge == edge.title()]
+        else:
+            tab = KeskiRahkonenKrauseTable
+            rows = self.query(tab)
+            if has_elem:
+                if isinstance(element, int):
+                    rows = rows.filter(tab.atomic_number==element)
+                else:
+                    rows = rows.filter(tab.element==element.title())
+            if has_edge:
+                rows = rows.filter(tab.edge==edge.title())
+            out = rows.all()
         if len(out) == 1:
             return(out[0].width)
         elif has_elem:
@@ -476,6 +741,40 @@ class xrayDB(object):
         else:
             return [(r.atomic_number, r.edge, r.width) for r in out]
 
+    def _getElamTable(self, element, kind='photo'):
+        """return (log_energy, log_value, log_value_spline) arrays from
+        the Elam tables for an element (atomic symbol) and kind of
+        cross section ('photo', 'coh', 'incoh'), or None if not found"""
+        if kind.lower().startswith('coh'):
+            columns = ('log_energy', 'log_coherent_scatter',
+                       'log_coherent_scatter_spline')
+        elif kind.lower().startswith('incoh'):
+            columns = ('log_energy', 'log_incoherent_scatter',
+                       'log_incoherent_scatter_spline')
+        else:
+            columns = ELAM_PHOTO_COLUMNS
+
+        if self.cache is not None:
+            packed = self.cache.scatter
+            if kind == 'photo':
+                packed = self.cache.photo
+            if packed.get(element.title(), columns[0]) is None:
+                return None
+            tab_lne, tab_val, tab_spl = [packed.get(element.title(), col)
+                                         for col in columns]
+        else:
+            tab = ScatteringTable
+            if kind == 'photo':
+                tab = PhotoAbsorptionTable
+            row = self.query(tab).filter(tab.element==element.title()).all()
+            if len(row) > 0:
+                row = row[0]
+            if not isinstance(row, tab):
+                return None
+            tab_lne, tab_val, tab_spl = [np.array(json.loads(getattr(row, col)))
+                                         for col in columns]
+        return tab_lne, tab_val, tab_spl
+
     def Elam_CrossSection(self, element, energies, kind='photo'):
         """returns Elam Cross Section values for an element and energies
 
@@ -494,29 +793,24 @@ class xrayDB(object):
             element = self.symbol(element)
         energies = 1.0 * as_ndarray(energies)
 
-        tab = ScatteringTable
-        if kind == 'photo':
-            tab = PhotoAbsorptionTable
-        row = self.query(tab).filter(tab.element==element.title()).all()
-        if len(row) > 0:
-            row = row[0]
-        if not isinstance(row, tab):
+        tabs = self._getElamTable(element, kind)
+        if tabs is None:
             return None
-
-        tab_lne = np.array(json.loads(row.log_energy))
-        if kind.lower().startswith('coh'):
-            tab_val = np.array(json.loads(row.log_coherent_scatter))
-            tab_spl = np.array(json.loads(row.log_coherent_scatter_spline))
-        elif kind.lower().startswith('incoh'):
-            tab_val = np.array(json.loads(row.log_incoherent_scatter))
-            tab_spl = np.array(json.loads(row.log_incoherent_scatter_spline))
-        else:
-            tab_val = np.array(json.loads(row.log_photoabsorption))
-            tab_spl = np.array(json.loads(row.log_photoabsorption_spline))
+        tab_lne, tab_val, tab_spl = tabs
 
         emin_tab = 10*int(0.102*np.exp(tab_lne[0]))
         energies[np.where(energies < emin_tab)] = emin_tab
-        out = np.exp(elam_spline(tab_lne, tab_val, tab_spl, np.log(energies)))
+        # spline weights are saved for each element, table, and energy
+        # grid, to be re-used for the other tables and later calls
+        key = (element.title(), kind == 'photo', energies.tobytes())
+        weights = self._elam_grids.get(key, None)
+        if weights is None:
+            if len(self._elam_grids) >= ELAM_GRID_CACHE:
+                self._elam_grids.clear()
+            weights = elam_spline_weights(tab_lne, np.log(energies))
+            self._elam_grids[key] = weights
+        out = np.exp(elam_spline(tab_lne, tab_val, tab_spl, None,
+                                 weights=weights))
         if len(out) == 1:
             return out[0]
         return out
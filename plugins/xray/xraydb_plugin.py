@@ -26,6 +26,7 @@ mu_elam         X-ray attenuation coefficients from Elam etal
 mu_chantler     X-ray attenuation coefficients from Chantler
 xray_edges      X-ray absorption edges for an element
 xray_lines      X-ray emission lines for an element
+xraydb_cache    use an in-memory copy of the X-ray database
 '''
 
 def get_xraydb(_larch):
@@ -36,6 +37,26 @@ def get_xraydb(_larch):
     _larch.symtable.set_symbol(symname, xraydb)
     return xraydb
 
+@ValidateLarchPlugin
+def xraydb_cache(use=True, verbose=True, _larch=None):
+    """use (or stop using) an in-memory copy of the X-ray database,
+    read once, for all later lookups.
+
+    arguments
+    ---------
+    use:      whether to use the in-memory copy [True]
+    verbose:  whether to print the time to read it and its size [True]
+
+    returns dictionary of load_time (seconds) and nbytes (bytes)
+    for the in-memory copy, or None when not using it.
+    """
+    xdb = get_xraydb(_larch)
+    if not use:
+        xdb.cache = None
+    elif xdb.cache is None:
+        xdb.load_cache(verbose=verbose)
+    return xdb.cache_info()
+
 @ValidateLarchPlugin
 def f0(ion, q, _larch=None):
     """returns elastic x-ray scattering factor, f0(q), for an ion.
@@ -481,6 +502,7 @@ def initializeLarchPlugin(_larch=None):
 
 def registerLarchPlugin():
     return (MODNAME, {'f0': f0, 'f0_ions': f0_ions,
+                      'xraydb_cache': xraydb_cache,
                       'chantler_energies': chantler_energies,
                       'chantler_data': chantler_data,
                       'f1_chantler': f1_chantler,
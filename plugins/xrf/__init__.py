@@ -1,6 +1,6 @@
 from .mca import MCA, isLarchMCAGroup, Environment
 from .roi import ROI, split_roiname
-from .deadtime import calc_icr, correction_factor
+from .deadtime import calc_icr, calc_icr_array, correction_factor
 from .xrf_bgr import xrf_background
 from .xrf_calib import xrf_calib_fitrois, xrf_calib_compute, xrf_calib_apply
 from .xrf_peak import xrf_peak
@@ -179,13 +179,103 @@ def correction_factor(rt, lt, icr=None, ocr=None):
         return (icr/ocr)*(rt/lt)
     return (rt/lt)
 
-def correct_data(data,rt,lt,icr=None,ocr=None):
+def correct_data(data,rt,lt,icr=None,ocr=None,tau=None):
     """
     Apply deatime correction to data
+
+    If icr is None, and ocr and tau are given, icr is calculated
+    with calc_icr_array(ocr, tau).  Points that cannot be corrected
+    use the icr at the top of the deadtime curve.
     """
+    if icr is None and ocr is not None and tau is not None:
+        icr, valid = calc_icr_array(ocr, tau)
     cor = correction_factor(rt, lt, icr, ocr)
     return data * cor
 
+def calc_icr_array(ocr, tau, tol=1.e-10, maxiter=50, lambertw=False):
+    """
+    Calculate the true icr for arrays of ocr and corresponding deadtime
+    factor tau, solving
+
+        ocr = icr * exp(-icr*tau)
+
+    for icr <= 1/tau.  All points are solved at once with Newton-Raphson
+    steps, kept inside a bracket [ocr, 1/tau] by falling back to bisection,
+    until the relative change in icr is below tol.  With lambertw=True,
+    the closed form icr = -W(-ocr*tau)/tau is used instead.
+
+    Parameters:
+    -----------
+    * ocr = output count rate, array or scalar
+    * tau = deadtime, array or scalar (broadcast with ocr)
+    * tol = relative tolerance for icr
+    * maxiter = maximum number of iterations
+    * lambertw = use Lambert W function
+
+    Outputs:
+    -------
+    * icr, valid: arrays of icr, and of whether icr could be calculated.
+      Where tau <= 0, icr = ocr.  Points with ocr > exp(-1)/tau
+      cannot be corrected: these are given icr = 1/tau, the top of the
+      deadtime curve.  Points with ocr < 0 are given icr = 0.
+    """
+    ocr, tau = np.broadcast_arrays(np.asarray(ocr, dtype=float),
+                                   np.asarray(tau, dtype=float))
+    shape = ocr.shape
+    ocr, tau = ocr.flatten(), tau.flatten()
+    icr = ocr.copy()
+    valid = np.isfinite(ocr) & np.isfinite(tau) & (ocr >= 0)
+    icr[np.isfinite(ocr) & (ocr < 0)] = 0.0
+
+    dead = valid & (tau > 0)
+    max_ocr = np.zeros(ocr.shape)
+    max_ocr[dead] = E_INV/tau[dead]
+    over = dead & (ocr > max_ocr)
+    icr[over] = 1.0/tau[over]
+    valid[over] = False
+
+    todo = dead & ~over & (ocr > 0)
+    if not todo.any():
+        return icr.reshape(shape), valid.reshape(shape)
+    y, t = ocr[todo], tau[todo]
+    if lambertw:
+        from scipy.special import lambertw as _lambertw
+        icr[todo] = -_lambertw(-y*t, 0).real/t
+        return icr.reshape(shape), valid.reshape(shape)
+
+    # start from the larger of one fixed-point step from ocr and a
+    # quadratic approximation at the top of the deadtime curve
+    lo, hi = y.copy(), 1.0/t
+    top = (1 - np.sqrt(np.maximum(0, 2*(1 - y*t/E_INV))))/t
+    x = np.clip(np.maximum(y*np.exp(y*t), top), lo, hi)
+    active = np.arange(len(y))
+    for i in range(maxiter):
+        xa, ya, ta = x[active], y[active], t[active]
+        ex = np.exp(-ta*xa)
+        resid = xa*ex - ya
+        # keep the solution bracketed
+        above = resid > 0
+        hi[active] = np.where(above, xa, hi[active])
+        lo[active] = np.where(above, lo[active], xa)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xnew = xa - resid/(ex*(1 - ta*xa))
+        bisect = ~((xnew >= lo[active]) & (xnew <= hi[active]))
+        xnew[bisect] = 0.5*(lo[active][bisect] + hi[active][bisect])
+        x[active] = xnew
+        # near the top of the curve, icr is only known to about
+        # sqrt(machine precision): stop when the residual is negligible
+        done = ((abs(xnew - xa) <= tol*xnew) |
+                (abs(resid) <= 1.e-14*ya) |
+                (hi[active] - lo[active] <= tol*hi[active]))
+        active = active[~done]
+        if len(active) == 0:
+            break
+    converged = np.ones(len(y), dtype=bool)
+    converged[active] = False
+    icr[todo] = x
+    valid[todo] = converged
+    return icr.reshape(shape), valid.reshape(shape)
+
 def calc_icr(ocr, tau):
     """
     Calculate the true icr from a given ocr and corresponding deadtime factor
@@ -195,7 +285,7 @@ def calc_icr(ocr, tau):
 
     Returns None if the loop cannot converge
 
-    Note below could be improved!
+    See calc_icr_array() for arrays of ocr.
     """
     # error checks
     if ocr is None or tau is None or ocr <= 0:
@@ -214,26 +304,11 @@ def calc_icr(ocr, tau):
         print( 'ocr exceeds maximum correctible value of %g cps' % max_ocr)
         return None
 
-    # Newton loop
-    icr0 = ocr
-    cnt = 0
-    while cnt < 100:
-        cnt += 1
-        delta = (ocr*np.exp(icr0*tau) - icr0) / (icr0*tau - 1)
-        if  abs(delta) < 0.01:
-            icr = icr0
-            break
-        else:
-            icr0 = icr0 - delta
-            if icr0 > max_icr:
-                # went over the top, we assume that
-                # the icr is less than 1/tau
-                icr0 = 1.1 * ocr
-
-    if cnt >= 100:
+    icr, valid = calc_icr_array(ocr, tau)
+    if not valid:
         print( 'Warning: icr calculation failed to converge')
-        icr = None
-    return icr
+        return None
+    return float(icr)
 
 ##############################################################################
 def fit_deadtime(mon, ocr, offset=True):
@@ -75,11 +75,9 @@ Input Parameter Fields:
         is constrained to never be larger than the data itself. If the
         spectrum has negative noise spikes they will cause the fit to be
         too low. Compression will smooth out such noise spikes.
-        Second, the algorithm requires about 3*N**2 operations, so the time
-        required grows rapidly with the size of the input spectrum. On a
-        200 MHz Pentium it takes about 3 seconds to fit a 2048 channel
-        spectrum with COMPRESS=1 (no compression), but only 0.2 seconds
-        with COMPRESS=4 (the default).
+        Second, the time required grows with the number of channels
+        times the width (in channels) of the polynomials, so it grows
+        rapidly with the size of the input spectrum.
 
         Note - compress needs a data array that integer divisible.
 
@@ -114,20 +112,24 @@ REFERENCE_AMPL=100.
 TINY = 1.E-20
 HUGE = 1.E20
 MAX_TANGENT=2
+BLOCKSIZE = 256   # number of spectra fitted at a time
+PRUNE_STEP = 8    # offsets fitted between checks for whether to stop
 
 def compress_array(array, compress):
-   """Compresses an 1-D array by the integer factor "compress".
-   near equivalent of IDL's 'rebin'....
+   """Compresses an array by the integer factor "compress" along its
+   last axis.  near equivalent of IDL's 'rebin'....
    """
-   if len(array) % compress != 0:
+   array = np.asarray(array)
+   nchans = array.shape[-1]
+   if nchans % compress != 0:
       print( 'Warning compress must be integer divisor of array length')
       return None
 
-   temp = np.resize(array, (len(array)/compress, compress))
-   return np.sum(temp, 1)/compress
+   temp = array.reshape(array.shape[:-1] + (nchans//compress, compress))
+   return np.sum(temp, -1)/compress
 
 def expand_array(array, expand, sample=0):
-   """Expands an 1-D array by the integer factor "expand".
+   """Expands an array by the integer factor "expand" along its last axis.
 
    if 'sample' is 1 the new array is created with sampling,
    if 0 then the new array is created via interpolation (default)
@@ -135,18 +137,138 @@ def expand_array(array, expand, sample=0):
    """
    if expand == 1:
        return array
+   array = np.asarray(array)
+   temp = np.repeat(array, expand, axis=-1)
    if sample == 1:
-       return np.repeat(array, expand)
-
-   kernel = np.ones(expand)/expand
-   # The following mimic the behavior of IDL's rebin when expanding
-   temp = np.convolve(np.repeat(array, expand), kernel, mode=2)
-   # Discard the first "expand-1" entries
-   temp = temp[expand-1:]
-   # Replace the last "expand" entries with the last entry of original
-   for i in range(1,expand):
-       temp[-i]=array[-1]
-   return temp
+       return temp
+
+   # The following mimic the behavior of IDL's rebin when expanding:
+   # a running mean over "expand" entries
+   kernel = 1.0/expand
+   out = temp*kernel
+   for i in range(1, expand):
+       out[..., :-i] += temp[..., i:]*kernel
+   # Replace the last "expand-1" entries with the last entry of original
+   out[..., 1-expand:] = array[..., -1:]
+   return out
+
+def _fit_power_functions(scratch, slope, width=4, exponent=2, tangent=False):
+    """fit background to a 2-D array (nspectra, nchans) of spectra,
+    returning the background as floats, as for XRFBackground.calc.
+
+    At each channel, the height of the largest power function that is
+    never above the spectrum is a sliding-window minimum of the spectrum
+    plus the power function, and the background is a sliding-window
+    maximum of those heights minus the power function.  Both are found
+    by looping over the offsets from the apex of the power function,
+    with all channels and spectra at once.  The window for each spectrum
+    is that of the per-channel fit:  offsets for which the power function
+    is not larger than the maximum counts.  For even exponents and no
+    tangent, the loop stops once the power function is too large to
+    change the result, usually well inside that window.
+    """
+    nspec, nchans = scratch.shape
+    bckgnd = np.zeros((nspec, nchans)) + (np.arange(nchans, dtype=float) - HUGE)
+    if nchans < 2:
+        return bckgnd
+    nfit = nchans - 1
+
+    # power function at offsets 0, 1, ..., nchans, and the part of the
+    # power function used for each spectrum, kstart <= offset <= kstop
+    denom = max(TINY, (width / (2. * slope)**exponent))
+    power = np.arange(nchans+1, dtype=float)**exponent * (REFERENCE_AMPL / denom)
+    kstop = np.searchsorted(power, scratch.max(axis=1), side='right') - 1
+    is_int = float(exponent) == int(exponent)
+    is_even = is_int and int(exponent) % 2 == 0
+    is_odd = is_int and not is_even
+    if is_even:
+        kstart = -kstop
+    elif is_odd:
+        kstart = -nchans * np.ones(nspec, dtype=int)
+    else:
+        kstart = np.zeros(nspec, dtype=int)
+    max_index = (kstop - kstart + 1)//2 - 1
+    max_index[kstop < 0] = -2    # no power function fits: no background
+    kshift = max_index + kstart
+
+    def power_funct(offset):
+        "power function for an offset of channel from apex, for each spectrum"
+        k = offset + kshift
+        out = power[np.clip(abs(k), 0, nchans)]
+        if is_odd:
+            out = np.where(k < 0, -out, out)
+        return out
+
+    def in_window(offset):
+        "whether an offset is in the fit window, for each spectrum"
+        return (abs(offset) <= max_index) | ((max_index == -1) & (offset == 1))
+
+    chans = np.arange(nfit)
+    if tangent:
+        # slope of tangent to spectrum at each channel
+        denom = np.maximum(chans, 1).astype(float)
+        tan_slope = np.zeros((nspec, nfit))
+        for off in range(-MAX_TANGENT, MAX_TANGENT+1):
+            c0, c1 = max(0, -off), min(nfit, nchans-off)
+            tan_slope[:, c0:c1] += ((scratch[:, c0:c1] - scratch[:, c0+off:c1+off])
+                                    / denom[c0:c1])
+        tan_slope /= (np.minimum(chans + MAX_TANGENT, nchans-1) -
+                      np.maximum(chans - MAX_TANGENT, 0))
+        # channel at which each linear offset is scratch[chan]
+        mindex = max_index[:, None]
+        chan0 = np.maximum(chans - mindex, 0)
+        chan1 = np.maximum(np.minimum(chans + mindex, nchans-1), chan0)
+        lin_center = chan0 + (chan1 - chan0 + 1)//2
+
+    def lin_offset(offset, c0, c1):
+        "linear offsets at channels chan+offset for chan = c0, ..., c1-1"
+        if not tangent:
+            return scratch[:, c0:c1]
+        return scratch[:, c0:c1] + ((chans[c0:c1] + offset - lin_center[:, c0:c1])
+                                    * tan_slope[:, c0:c1])
+
+    dmax = min(max(max_index.max(), 1), nfit)
+    offsets = sorted(range(-dmax, dmax+1), key=lambda d: abs(d-1))
+    prune = is_even and not tangent
+    smin = scratch.min(axis=1)[:, None]
+
+    # Find the maximum height of a function centered on each channel
+    # such that it is never higher than the counts in any channel
+    height = np.zeros((nspec, nfit)) + np.inf
+    for i, off in enumerate(offsets):
+        if prune and i > 0 and i % PRUNE_STEP == 0:
+            pf = power_funct(off)[:, None]
+            if np.all((smin - scratch[:, :nfit]) + pf >= height):
+                break
+        use = in_window(off)
+        c0, c1 = max(0, -off), min(nfit, nchans-off)
+        if c1 <= c0 or not use.any():
+            continue
+        test = (scratch[:, c0+off:c1+off] - lin_offset(off, c0, c1)
+                + power_funct(off)[:, None])
+        test[~use] = np.inf
+        np.minimum(height[:, c0:c1], test, out=height[:, c0:c1])
+
+    # Set the background to the height of the maximum function
+    # amplitude at each channel
+    if prune:
+        top = (height + scratch[:, :nfit]).max(axis=1)[:, None]
+    for i, off in enumerate(offsets):
+        if prune and i > 0 and i % PRUNE_STEP == 0:
+            fitted = np.where(bckgnd > -HUGE/2, bckgnd, np.inf)
+            low = fitted.min(axis=1)[:, None]
+            if np.all(top - power_funct(off)[:, None] <= low):
+                break
+        use = in_window(off)
+        c0, c1 = max(0, -off), min(nfit, nchans-off)
+        if c1 <= c0 or not use.any():
+            continue
+        test = (height[:, c0:c1] + lin_offset(off, c0, c1)
+                - power_funct(off)[:, None])
+        test[~use] = -np.inf
+        sub = bckgnd[:, c0+off:c1+off]
+        np.maximum(sub, test, out=sub)
+    return bckgnd
 
 class XRFBackground:
     """
@@ -181,23 +303,29 @@ class XRFBackground:
 
         Parameters:
         -----------
-        * data is the spectrum
+        * data is the spectrum, or an array of spectra with channels
+          along the last axis, such as (nspectra, nchans) or
+          (nrows, npts, nchans) for the spectra of a map.
         * slope is the slope of conversion channels to energy
+
+        Notes:
+        ------
+        bgr will have the same shape as data.
         """
 
         if data is None:
             data = self.data
+        data = np.asarray(data)
 
         width    = self.width
         exponent = self.exponent
         tangent  = self.tangent
         compress = self.compress
 
-        nchans   = len(data)
-        self.bgr = np.zeros(nchans, dtype=np.int)
-        scratch  = data[:]
+        nchans   = data.shape[-1]
+        scratch  = data.reshape((-1, nchans)).astype(float)
 
-        # Compress scratch spectrum
+        # Compress scratch spectra
         if compress > 1:
             tmp = compress_array(scratch, compress)
             if tmp is None:
@@ -205,66 +333,21 @@ class XRFBackground:
             else:
                 scratch = tmp
                 slope = slope * compress
-                nchans = nchans / compress
-
-        # Copy scratch spectrum to background spectrum
-        bckgnd = scratch[:]
-
-        # Find maximum counts in input spectrum. This information is used to
-        # limit the size of the function lookup table
-        max_counts = max(scratch)
 
         # Fit functions which come up from below
-        bckgnd = np.arange(nchans, dtype=np.float) - HUGE
-
-        denom = max(TINY, (width / (2. * slope)**exponent))
-
-        indices     = np.arange(nchans*2+1, dtype=np.float) - nchans
-        power_funct = indices**exponent  * (REFERENCE_AMPL / denom)
-        power_funct = np.compress((power_funct <= max_counts), power_funct)
-        max_index   = len(power_funct)/2 - 1
-        # print( "NCHANS: ", nchans, denom, min(indices), max(indices), max_index)
-        for chan in range(nchans-1):
-            tan_slope = 0.
-            if tangent:
-                # Find slope of tangent to spectrum at this channel
-                chan0  = max((chan - MAX_TANGENT), 0)
-                chan1  = min((chan + MAX_TANGENT), (nchans-1))
-                denom  = chan - np.arange(chan1 - chan0 + 1, dtype=np.float)
-                # is this correct?
-                denom   = max(max(denom), 1)
-                tan_slope = (scratch[chan] - scratch[chan0:chan1+1]) / denom
-                tan_slope = np.sum(tan_slope) / (chan1 - chan0)
-
-            chan0 = max((chan - max_index), 0)
-            chan1 = min((chan + max_index), (nchans-1))
-            chan1 = max(chan1, chan0)
-            nc    = chan1 - chan0 + 1
-            lin_offset = scratch[chan] + (np.arange(float(nc)) - nc/2) * tan_slope
-
-            # Find the maximum height of a function centered on this channel
-            # such that it is never higher than the counts in any channel
-            f      = chan0 - chan + max_index
-            l      = chan1 - chan + max_index
-            test   = scratch[chan0:chan1+1] - lin_offset + power_funct[f:l+1]
-            height = min(test)
-
-            # We now have the function height. Set the background to the
-            # height of the maximum function amplitude at each channel
-
-            test = height + lin_offset - power_funct[f:l+1]
-            sub  = bckgnd[chan0:chan1+1]
-            bckgnd[chan0:chan1+1] = np.maximum(sub, test)
-
-        # Expand spectrum
+        bckgnd = np.zeros(scratch.shape)
+        for i in range(0, len(scratch), BLOCKSIZE):
+            bckgnd[i:i+BLOCKSIZE] = _fit_power_functions(
+                scratch[i:i+BLOCKSIZE], slope, width=width,
+                exponent=exponent, tangent=tangent)
+
+        # Expand spectra
         if compress > 1:
             bckgnd = expand_array(bckgnd, compress)
 
         # Bgr should be positive integers??
-        bgr = bckgnd.astype(int)
-        idx = np.where(bgr <= 0)
-        bgr[idx] = 0
-        self.bgr = bgr
+        bgr = np.where(bckgnd > 0, bckgnd, 0).astype(int)
+        self.bgr = bgr.reshape(data.shape)
 
 @ValidateLarchPlugin
 def xrf_background(energy, counts=None, group=None, width=4,
@@ -279,7 +362,9 @@ def xrf_background(energy, counts=None, group=None, width=4,
     ---------
     energy     array of energies OR an MCA group.  If an MCA group,
                it will be used to give ``counts`` and ``mca`` arguments
-    counts     array of XRF counts (or MCA.counts)
+    counts     array of XRF counts (or MCA.counts), or an array of
+               spectra with channels along the last axis, such as
+               the (nrows, npts, nchans) counts of a map
     group      group for outputs
 
     width      full width (in keV) of the concave down polynomials
@@ -293,7 +378,7 @@ def xrf_background(energy, counts=None, group=None, width=4,
 
     outputs (written to group)
     -------
-    bgr       background array
+    bgr       background array, with the shape of counts
     bgr_info  dictionary of parameters used to calculate background
     """
     if isLarchMCAGroup(energy):
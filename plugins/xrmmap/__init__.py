@@ -1,4 +1,7 @@
 from .configfile import FastMapConfig
+from .storage import (StoragePolicy, get_storage_policy, available_compression,
+                      benchmark_storage, STORAGE_PRESETS)
+from .folderwatch import MapFolderWatcher
 from .xsp3_hdf5 import read_xsp3_hdf5
 from .xrf_netcdf import read_xrf_netcdf
 from .xrd_netcdf import read_xrd_netcdf
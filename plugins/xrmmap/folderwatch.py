@@ -0,0 +1,158 @@
+#!/usr/bin/python
+"""
+watch a Map Folder for raw data files that are completely written.
+
+Changes to the folder are signalled with inotify on Linux, and found by
+polling the files with os.stat() elsewhere.  A file is taken to be
+complete once it is not empty and its size and modification time are
+the same in two observations at least `settle` seconds apart.
+"""
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+SETTLE_TIME = 0.25   # seconds a file must be unchanged to be complete
+POLL_TIME = 0.10     # seconds between checks of the folder
+
+# inotify flags, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+IN_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+IN_EVENT_HEADER = struct.Struct('iIII')
+
+class _Inotify(object):
+    """minimal inotify watch of a single folder, using libc"""
+    def __init__(self, folder):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if not isinstance(folder, bytes):
+            folder = folder.encode(sys.getfilesystemencoding())
+        if libc.inotify_add_watch(self.fd, folder, IN_WATCH_MASK) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, 'inotify_add_watch failed')
+
+    def read(self, timeout):
+        """wait up to timeout seconds for events, returning
+        the set of names of the files changed"""
+        names = set()
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except (OSError, select.error):
+            return names
+        if not ready:
+            return names
+        try:
+            buff = os.read(self.fd, 65536)
+        except OSError as exc:
+            if exc.errno in (errno.EAGAIN, errno.EINTR):
+                return names
+            raise
+        pos = 0
+        while pos + IN_EVENT_HEADER.size <= len(buff):
+            wd, mask, cookie, nlen = IN_EVENT_HEADER.unpack_from(buff, pos)
+            pos += IN_EVENT_HEADER.size
+            name = buff[pos:pos+nlen].rstrip(b'\0')
+            pos += nlen
+            if len(name) > 0:
+                names.add(name.decode(sys.getfilesystemencoding()))
+        return names
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class MapFolderWatcher(object):
+    """watch a Map Folder for completely written raw data files
+
+    Parameters
+    ----------
+    folder       name of Map Folder
+    settle       time (seconds) a file must be unchanged to be complete [0.25]
+    poll_time    maximum time (seconds) for wait() [0.1]
+    use_inotify  whether to use inotify if available [True]
+
+    Notes
+    -----
+    only the local clock is used to time the settling: the modification
+    time of a file is compared between observations but never with the
+    local time, as clocks of file servers may be skewed.  So a file is
+    never complete when first seen, even if it was written long ago.
+    """
+    def __init__(self, folder, settle=SETTLE_TIME, poll_time=POLL_TIME,
+                 use_inotify=True):
+        self.folder = folder
+        self.settle = settle
+        self.poll_time = poll_time
+        self._files = {}
+        self._seen = {}
+        self.inotify = None
+        if use_inotify and sys.platform.startswith('linux'):
+            try:
+                self.inotify = _Inotify(folder)
+            except (OSError, AttributeError):
+                self.inotify = None
+
+    def _signature(self, fname):
+        "size and modification time of a file, or None if missing"
+        try:
+            stat = os.stat(os.path.join(self.folder, fname))
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime)
+
+    def wait(self, timeout=None):
+        """wait for a change in the folder, for at most timeout seconds
+        (default poll_time).  Returns the set of names of changed files,
+        or None if the folder is polled."""
+        if timeout is None:
+            timeout = self.poll_time
+        if self.inotify is not None:
+            return self.inotify.read(timeout)
+        time.sleep(timeout)
+        return None
+
+    def is_complete(self, fname):
+        """return whether a file is complete: not empty, and with the same
+        size and modification time as when first seen with them, at least
+        `settle` seconds ago"""
+        now = time.time()
+        sig = self._signature(fname)
+        if sig is None or sig[0] < 1:
+            self._files.pop(fname, None)
+            return False
+        last = self._files.get(fname, None)
+        if last is None or last[0] != sig:
+            self._files[fname] = last = (sig, now)
+        return now - last[1] >= self.settle
+
+    def all_complete(self, fnames):
+        """return whether all files are complete.  All files are
+        checked, so each is observed even if an earlier one is not
+        complete"""
+        return all([self.is_complete(f) for f in fnames if len(f) > 0])
+
+    def has_changed(self, fname):
+        """return whether a file has changed since the last call
+        for it (True for the first call for a file that exists)"""
+        sig = self._signature(fname)
+        changed = sig is not None and sig != self._seen.get(fname, None)
+        self._seen[fname] = sig
+        return changed
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
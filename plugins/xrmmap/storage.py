@@ -0,0 +1,273 @@
+#!/usr/bin/python
+"""
+storage policies for the HDF5 datasets of XRM map files:
+compression filter, chunk shapes and chunk-cache size.
+
+The chunk shapes of the MCA counts are chosen for the way a map will
+mostly be read:
+
+  'rows'      whole rows at a time, as when a map is being collected
+              and converted (the default).
+  'spectra'   spectra for single pixels or small areas.
+  'channels'  narrow slabs of channels over the whole map, as when
+              (re-)calculating ROI maps.
+"""
+import os
+import time
+import tempfile
+import h5py
+import numpy as np
+
+HAS_hdf5plugin = False
+try:
+    import hdf5plugin
+    HAS_hdf5plugin = True
+except ImportError:
+    pass
+
+ACCESS_PATTERNS = ('rows', 'spectra', 'channels')
+CHUNK_NELEM = 65536    # target number of elements in a counts chunk
+CHANNEL_NROWS = 4      # rows in a counts chunk for 'channels' access
+NFLUSH = 16            # rows written between flushes of the HDF5 file
+
+# filters from hdf5plugin, used if it is installed
+PLUGIN_FILTERS = {'lz4': 'LZ4', 'zstd': 'Zstd', 'blosc': 'Blosc'}
+
+def available_compression():
+    """list of compression filter names usable for StoragePolicy"""
+    out = [None]
+    for name in ('lzf', 'gzip', 'szip'):
+        if name in h5py.filters.encode:
+            out.append(name)
+    if HAS_hdf5plugin:
+        for name, cname in PLUGIN_FILTERS.items():
+            if hasattr(hdf5plugin, cname):
+                out.append(name)
+    return out
+
+class StoragePolicy(object):
+    """storage policy for HDF5 datasets of an XRM map file
+
+    Parameters
+    ----------
+    compression   name of compression filter, one of available_compression()
+                  ['lzf'].  None for no compression, as for scratch files.
+    compression_opts  options for the compression filter, such as the
+                  level for 'gzip' [None]
+    shuffle       whether to use the shuffle filter before compression [False]
+    access        dominant access pattern of MCA counts, one of
+                  'rows', 'spectra', 'channels' ['rows']
+    counts_dtype  data type of MCA counts ['int16']
+    chunk_cache   size of the HDF5 chunk cache in bytes, or None for the
+                  HDF5 default of 1 MB [None]
+    flush_every   number of rows written between flushes of the file [16]
+    name          name of the policy [None]
+
+    Notes
+    -----
+    A compression filter that is not available is replaced by 'lzf',
+    with a warning.
+    """
+    def __init__(self, compression='lzf', compression_opts=None,
+                 shuffle=False, access='rows', counts_dtype='int16',
+                 chunk_cache=None, flush_every=NFLUSH, name=None):
+        if access not in ACCESS_PATTERNS:
+            raise ValueError("access must be one of %s" % repr(ACCESS_PATTERNS))
+        if compression not in available_compression():
+            print("Warning: compression '%s' not available, using 'lzf'" %
+                  compression)
+            compression, compression_opts = 'lzf', None
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.shuffle = shuffle
+        self.access = access
+        self.counts_dtype = np.dtype(counts_dtype)
+        self.chunk_cache = chunk_cache
+        self.flush_every = max(1, int(flush_every))
+        self.name = name
+
+    def __repr__(self):
+        name = '' if self.name is None else "'%s', " % self.name
+        return "<StoragePolicy %scompression=%s, access='%s', counts=%s>" % (
+            name, repr(self.compression), self.access, self.counts_dtype.name)
+
+    def filter_kws(self):
+        """keyword arguments for the filters of h5py create_dataset()"""
+        if self.compression is None:
+            return {}
+        if self.compression in PLUGIN_FILTERS:
+            kws = dict(getattr(hdf5plugin, PLUGIN_FILTERS[self.compression])())
+        else:
+            kws = {'compression': self.compression}
+            if self.compression_opts is not None:
+                kws['compression_opts'] = self.compression_opts
+        if self.shuffle:
+            kws['shuffle'] = True
+        return kws
+
+    def file_kws(self):
+        """keyword arguments for h5py.File(), setting the chunk cache"""
+        if self.chunk_cache is None:
+            return {}
+        return {'rdcc_nbytes': int(self.chunk_cache), 'rdcc_nslots': 10007}
+
+    def open(self, filename, mode=None):
+        """open an HDF5 file with the chunk cache for this policy"""
+        if mode is None:
+            return h5py.File(filename, **self.file_kws())
+        return h5py.File(filename, mode, **self.file_kws())
+
+    def counts_chunks(self, npts, nchan):
+        """chunk shape for MCA counts of (nrow, npts, nchan)"""
+        npts, nchan = max(1, npts), max(1, nchan)
+        if self.access == 'spectra':
+            return (1, max(1, min(npts, CHUNK_NELEM//nchan)), nchan)
+        elif self.access == 'channels':
+            nch = CHUNK_NELEM // (CHANNEL_NROWS*npts)
+            nch = 2**int(np.log2(max(16, nch)))
+            return (CHANNEL_NROWS, npts, min(nchan, nch))
+        # rows
+        if npts < 10: npts = 10
+        nxx = min(npts-1, 2**int(np.log2(npts)))
+        nxm = 1024
+        if nxx > 256:
+            nxm = min(1024, int(65536*1.0/ nxx))
+        return (1, nxx, min(nchan, nxm))
+
+    def roimap_chunks(self, npts, ncol):
+        """chunk shape for ROI maps of (nrow, npts, ncol)"""
+        if self.access == 'channels':
+            return (8, npts, min(ncol, 4))
+        return (2, npts, ncol)
+
+    def xrd_chunks(self, xpixx, xpixy):
+        """chunk shape for XRD frames of (nrow, npts, xpixx, xpixy)"""
+        return (1, 1, xpixx, xpixy)
+
+    def create_dataset(self, group, name, shape=None, dtype=None, data=None,
+                       **kws):
+        """create an HDF5 dataset with the filters for this policy.
+        other keyword arguments (chunks, maxshape, ...) are passed
+        to h5py create_dataset()"""
+        kwargs = self.filter_kws()
+        kwargs.update(kws)
+        if data is not None:
+            return group.create_dataset(name, data=data, **kwargs)
+        return group.create_dataset(name, shape, dtype, **kwargs)
+
+STORAGE_PRESETS = {
+    'default':  dict(compression='lzf'),
+    'archive':  dict(compression='gzip', compression_opts=4, shuffle=True),
+    'scratch':  dict(compression=None, flush_every=64),
+    'spectra':  dict(compression='lzf', access='spectra',
+                     chunk_cache=32*2**20),
+    'channels': dict(compression='lzf', access='channels',
+                     chunk_cache=64*2**20),
+    }
+
+def get_storage_policy(policy=None, **kws):
+    """return a StoragePolicy from a policy, the name of a preset in
+    STORAGE_PRESETS, or None for the 'default' preset.  Keyword
+    arguments override those of the preset."""
+    if isinstance(policy, StoragePolicy):
+        return policy
+    if policy is None:
+        policy = 'default'
+    if policy not in STORAGE_PRESETS:
+        raise ValueError("unknown storage policy '%s'" % policy)
+    opts = dict(STORAGE_PRESETS[policy])
+    opts.update(kws)
+    opts.setdefault('name', policy)
+    return StoragePolicy(**opts)
+
+def _synthetic_counts(npts, nchan, seed=0):
+    "a row of MCA spectra that compresses roughly like real data"
+    rng = np.random.RandomState(seed)
+    en = np.arange(nchan)
+    spec = 2.0 + 50*np.exp(-(en-0.35*nchan)**2/(0.0002*nchan**2))
+    spec += 20*np.exp(-(en-0.6*nchan)**2/(0.0005*nchan**2))
+    scale = rng.uniform(0.5, 2.0, size=(npts, 1))
+    return rng.poisson(scale*spec).astype(np.int16)
+
+def benchmark_storage(policies=None, nrow=32, npts=500, nchan=2048,
+                      nread=16, folder=None, verbose=True):
+    """benchmark writing and reading MCA counts for storage policies
+
+    Parameters
+    ----------
+    policies  list of StoragePolicy or preset names [all presets]
+    nrow      number of rows in synthetic map [32]
+    npts      number of pixels per row [500]
+    nchan     number of MCA channels [2048]
+    nread     number of reads timed for each access pattern [16]
+    folder    folder for temporary HDF5 files [system temp folder]
+    verbose   whether to print a table of results [True]
+
+    Returns
+    -------
+    list of dictionaries with policy, write_mbps, file_mb,
+    and read times in ms for 'row', 'spectrum', and 'channels'
+
+    Notes
+    -----
+    rows are written one at a time, as when converting a map.  Reads
+    are of a whole row, a 3x3 pixel spectrum, and a 20 channel slab of
+    the whole map, each read from a newly opened file.
+    """
+    if policies is None:
+        policies = sorted(STORAGE_PRESETS.keys())
+    policies = [get_storage_policy(p) for p in policies]
+    rng = np.random.RandomState(1)
+    rows = [_synthetic_counts(npts, nchan, seed=i) for i in range(nrow)]
+    mbytes = nrow*rows[0].nbytes/2.0**20
+
+    results = []
+    for policy in policies:
+        fd, fname = tempfile.mkstemp(suffix='.h5', dir=folder)
+        os.close(fd)
+        try:
+            t0 = time.time()
+            fh = policy.open(fname, 'w')
+            dset = policy.create_dataset(fh, 'counts', (nrow, npts, nchan),
+                                         policy.counts_dtype,
+                                         chunks=policy.counts_chunks(npts, nchan))
+            for irow, row in enumerate(rows):
+                dset[irow] = row
+                if (irow+1) % policy.flush_every == 0:
+                    fh.flush()
+            fh.close()
+            out = {'policy': policy, 'write_mbps': mbytes/(time.time()-t0),
+                   'file_mb': os.stat(fname).st_size/2.0**20}
+
+            reads = {'row': lambda d, i: d[i % nrow],
+                     'spectrum': lambda d, i: d[i % (nrow-2):i % (nrow-2)+3,
+                                                i % (npts-2):i % (npts-2)+3].sum(axis=(0, 1)),
+                     'channels': lambda d, i: d[:, :, (i*97) % (nchan-20):
+                                                (i*97) % (nchan-20)+20].sum(axis=2)}
+            for rname, reader in reads.items():
+                tsum = 0.0
+                for i in rng.randint(0, 2**20, size=nread):
+                    fh = policy.open(fname, 'r')
+                    t0 = time.time()
+                    reader(fh['counts'], i)
+                    tsum += time.time() - t0
+                    fh.close()
+                out[rname] = 1000.0*tsum/nread
+            results.append(out)
+        finally:
+            os.unlink(fname)
+
+    if verbose:
+        print('Storage benchmark: (%i, %i, %i) counts, %.1f MB' % (nrow, npts,
+                                                                 nchan, mbytes))
+        print(' %-10s %10s %8s %8s %11s %11s' % ('policy', 'write MB/s',
+                                                 'file MB', 'row ms',
+                                                 'spectrum ms', 'channels ms'))
+        for out in results:
+            print(' %-10s %10.1f %8.2f %8.2f %11.2f %11.2f' % (
+                out['policy'].name, out['write_mbps'], out['file_mb'],
+                out['row'], out['spectrum'], out['channels']))
+    return results
+
+if __name__ == '__main__':
+    benchmark_storage()
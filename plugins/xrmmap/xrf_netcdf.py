@@ -89,7 +89,9 @@ def read_xrf_netcdf(fname, npixels=None, verbose=False):
             fh.close()
         return None
     
-    array_data = fh.variables['array_data']
+    # array_data is used as a (memory-mapped) array of big-endian int16,
+    # with all buffers decoded at once
+    array_data = fh.variables['array_data'][:]
     t1 = time.time()
 
     # array_data will normally be 3d:
@@ -100,54 +102,63 @@ def read_xrf_netcdf(fname, npixels=None, verbose=False):
     # here we force the data to be 3d
     shape = array_data.shape
     if len(shape) == 1:
-        array_data.shape = (1, 1, shape[0])
+        array_data = array_data.reshape((1, 1, shape[0]))
     elif len(shape) == 2:
-        array_data.shape = (1, shape[0], shape[1])
+        array_data = array_data.reshape((1, shape[0], shape[1]))
 
     narrays, nmodules, buffersize = array_data.shape
     modpixs    = max(124, array_data[0, 0, 8])
-    npix_total = 0
-    # real / live times are returned in microseconds.
-    for array in range(narrays):
-        for module in range(nmodules):
-            d   = array_data[array,module, :]
-            bh  = xMAPBufferHeader(d)
-            #if verbose and array==0:
-            dat = d[256:].reshape(modpixs, (d.size-256)/modpixs )
-
-            npix = bh.numPixels
-            if module == 0:
-                npix_total += npix
-                if array == 0:
-                    # first time through, (array,module)=(0,0) we
-                    # read mapping mode, set up how to slice the
-                    # data, and build data arrays in xmapdat
-                    mapmode = dat[0, 3]
-                    if mapmode == 1:  # mapping, full spectra
-                        nchans = d[20]
-                        data_slice = slice(256, 8448)
-                    elif mapmode == 2:  # ROI mode
-                        # Note:  nchans = number of ROIS !!
-                        nchans     = max(d[264:268])
-                        data_slice = slice(64, 64+8*nchans)
-                    xmapdat = xMAPData(narrays*modpixs, nmodules, nchans)
-                    xmapdat.firstPixel = bh.startingPixel
-
-            # acquistion times and i/o counts data are stored
-            # as longs in locations 32:64
-            t_times = aslong(dat[:npix, 32:64]).reshape(npix, 4, 4)
-            p1 = npix_total - npix
-            p2 = npix_total
-            xmapdat.realTime[p1:p2, :]     = t_times[:, :, 0]
-            xmapdat.liveTime[p1:p2, :]     = t_times[:, :, 1]
-            xmapdat.inputCounts[p1:p2, :]  = t_times[:, :, 2]
-            xmapdat.outputCounts[p1:p2, :] = t_times[:, :, 3]
-
-            # the data, extracted as per data_slice and mapmode
-            t_data = dat[:npix, data_slice]
-            if mapmode == 2:
-                t_data = aslong(t_data)
-            xmapdat.counts[p1:p2, :, :] = t_data.reshape(npix, 4, nchans)
+    blocksize  = int((buffersize-256)/modpixs)
+    ndet       = 4*nmodules
+
+    # buffer header for (array, module)=(0,0) gives the mapping mode,
+    # how to slice the data, and the first pixel
+    head = array_data[0, 0, :256+blocksize].astype(np.int16)
+    mapmode = head[256+3]
+    if mapmode == 1:  # mapping, full spectra
+        nchans = int(head[20])
+        data_slice = slice(256, 256+4*nchans)
+    elif mapmode == 2:  # ROI mode
+        # Note:  nchans = number of ROIS !!
+        nchans     = int(max(head[264:268]))
+        data_slice = slice(64, 64+8*nchans)
+
+    # view of pixel blocks of all buffers, ordered by array, pixel, module
+    pixels = array_data[:, :, 256:256+modpixs*blocksize]
+    pixels = pixels.reshape(narrays, nmodules, modpixs, blocksize)
+    pixels = pixels.transpose(0, 2, 1, 3)
+
+    def extract(sl, nout):
+        "copy one slice of all pixel blocks to (npixels, ndet, nout) int16"
+        out = np.empty((narrays, modpixs, nmodules, sl.stop-sl.start),
+                       dtype=np.int16)
+        out[:] = pixels[:, :, :, sl]
+        return out.reshape(narrays*modpixs, ndet, nout)
+
+    # use the number of pixels (from module 0) in each array
+    npix  = array_data[:, 0, 8].astype(int)
+    valid = (np.arange(modpixs)[np.newaxis, :] < npix[:, np.newaxis]).ravel()
+    npix_total = int(valid.sum())
+    if valid[:npix_total].all():
+        valid = slice(0, npix_total)
+
+    xmapdat = xMAPData(0, nmodules, nchans)
+    xmapdat.firstPixel = aslong(head[9:11])[0]
+
+    # acquistion times and i/o counts data are stored
+    # as longs in locations 32:64
+    t_times = extract(slice(32, 64), 8).view(np.int32)[valid]
+    xmapdat.realTime     = t_times[:, :, 0].astype('i8')
+    xmapdat.liveTime     = t_times[:, :, 1].astype('i8')
+    xmapdat.inputCounts  = t_times[:, :, 2]
+    xmapdat.outputCounts = t_times[:, :, 3]
+
+    # the data, extracted as per data_slice and mapmode
+    if mapmode == 2:
+        t_data = extract(data_slice, 2*nchans).view(np.int32)
+        xmapdat.counts = t_data[valid].astype('i2')
+    else:
+        xmapdat.counts = extract(data_slice, nchans)[valid]
 
     t2 = time.time()
     xmapdat.numPixels = npix_total
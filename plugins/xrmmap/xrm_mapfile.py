@@ -3,13 +3,17 @@ import os
 import socket
 import time
 import datetime
+import threading
+import six
 import h5py
 import numpy as np
+from multiprocessing.pool import ThreadPool
 from scipy import constants
 import scipy.stats as stats
 import json
 import larch
 from larch.utils.debugtime import debugtime
+from six.moves import queue
 
 from larch_plugins.io import nativepath, new_filename
 from larch_plugins.xrf import MCA, ROI
@@ -18,6 +22,7 @@ from larch_plugins.xrmmap import (FastMapConfig, read_xrf_netcdf,
                                   read_xsp3_hdf5, readASCII,
                                   readMasterFile, readROIFile,
                                   readEnvironFile, parseEnviron,
+                                  get_storage_policy, MapFolderWatcher,
                                   read_xrd_netcdf) #, read_xrd_hdf5)
                             
 from larch_plugins.xrd import XRD
@@ -31,8 +36,13 @@ except ImportError:
     pass
 
 NINIT = 32
-#COMPRESSION_LEVEL = 4
-COMPRESSION_LEVEL = 'lzf' ## faster but larger files;mkak 2016.08.19
+NWORKERS = 2     # threads reading raw row data ahead of the writer
+NREADAHEAD = 8   # maximum number of rows read but not yet written
+NROI_WORKERS = 4 # threads summing ROIs from existing MCA data
+ROI_BLOCKSIZE = 2**26  # approximate size in bytes of MCA data per ROI block
+NTILE = 32       # pixels on each side of tiles for the MCA counts index
+PYRAMID_MINSIZE = 64   # minimum width of the coarsest pyramid level
+PYRAMID_MAPS = ('det_raw', 'det_cor', 'sum_raw', 'sum_cor')
 DEFAULT_ROOTNAME = 'xrmmap'
 
 class GSEXRM_FileStatus:
@@ -195,6 +205,102 @@ class GSEXRM_NotOwner(Exception):
     def __str__(self):
         return self.msg
 
+def roi_integrate(counts, limits, out=None, work=None):
+    """sum MCA counts over channel ranges for several detectors,
+    using one cumulative sum over channels
+
+    Parameters
+    ----------
+    counts :  array (N, npts, nchan) of counts for N detectors
+    limits :  int array (NROI, N, 2) of [left, right) channel limits
+    out :     optional array (N, npts, NROI) to hold the sums
+    work :    optional array (N, npts, nchan+1) for the cumulative sum,
+              int64 for integer counts, float64 otherwise
+
+    Returns
+    -------
+    array (N, npts, NROI) of sums (out, if given)
+    """
+    ndet, npts, nchan = counts.shape
+    dtype = np.int64
+    if counts.dtype.kind not in 'iub':
+        dtype = np.float64
+    csum = work
+    if csum is None:
+        csum = np.zeros((ndet, npts, nchan+1), dtype=dtype)
+    csum[:, :, 0] = 0
+    np.cumsum(counts, axis=2, dtype=dtype, out=csum[:, :, 1:])
+    lims = np.clip(np.asarray(limits, dtype=int).reshape(-1, ndet, 2), 0, nchan)
+    left = lims[:, :, 0].transpose()[:, np.newaxis, :]
+    right = np.maximum(lims[:, :, 1].transpose()[:, np.newaxis, :], left)
+    idet = np.arange(ndet)[:, np.newaxis, np.newaxis]
+    ipts = np.arange(npts)[np.newaxis, :, np.newaxis]
+    return np.subtract(csum[idet, ipts, right], csum[idet, ipts, left],
+                       out=out)
+
+def pixel_xvals(xpos, npts):
+    """x positions for npts pixels, as midpoints of the gathered
+    positions at the pixel boundaries.
+
+    xpos normally holds npts+1 boundary positions.  If it holds only npts,
+    the end of the last pixel is taken one step past the last position.
+    """
+    xpos = np.asarray(xpos, dtype='float64')[:npts+1]
+    if len(xpos) < npts+1:
+        step = 0.0
+        if len(xpos) > 1:
+            step = xpos[-1] - xpos[-2]
+        xpos = np.append(xpos, xpos[-1] + step)
+    return (xpos[1:] + xpos[:-1])/2.0
+
+def roi_sums(dets, limits, row0, row1):
+    """sum MCA counts over channel ranges for rows row0:row1 of mca
+    detector groups, in a single pass over each detector's counts
+
+    Parameters
+    ----------
+    dets :    list of N mca detector groups ('det1', 'det2', ...)
+    limits :  int array (NROI, N, 2) of [left, right) channel limits
+    row0 :    first row
+    row1 :    last row (not included)
+
+    Returns
+    -------
+    raw, cor : arrays (nrows, npts, NROI, N) of raw and dead-time
+               corrected sums
+    """
+    limits = np.asarray(limits, dtype=int)
+    nroi = limits.shape[0]
+    raw = cor = None
+    for idet, grp in enumerate(dets):
+        counts = grp['counts'][row0:row1]
+        dtfactor = grp['dtfactor'][row0:row1]
+        nrows, npts, nchan = counts.shape
+        if raw is None:
+            raw = np.zeros((nrows, npts, nroi, len(dets)), dtype=np.int64)
+            cor = np.zeros((nrows, npts, nroi, len(dets)))
+        isum = roi_integrate(counts.reshape(1, nrows*npts, nchan),
+                             limits[:, idet:idet+1, :])
+        raw[:, :, :, idet] = isum.reshape(nrows, npts, nroi)
+        cor[:, :, :, idet] = raw[:, :, :, idet]*dtfactor[:, :, np.newaxis]
+    return raw, cor
+
+def bin_columns(data, factor, npts=None):
+    """sum map data (nrows, npts, n) over rows and over bins of factor
+    columns, leaving out the first and last (hot) columns of a map npts
+    columns wide (default: data.shape[1]).  Columns missing from data,
+    as for a short row, are taken as 0.
+    returns array (nbins, n)
+    """
+    data = np.asarray(data)
+    if npts is None:
+        npts = data.shape[1]
+    data = data[:, 1:npts-1].sum(axis=0, dtype=np.float64)
+    if data.shape[0] < npts-2:
+        data = np.concatenate((data, np.zeros((npts-2-data.shape[0],
+                                               data.shape[1]))))
+    return np.add.reduceat(data, np.arange(0, data.shape[0], factor), axis=0)
+
 class GSEXRM_MapRow:
     """
     read one row worth of data:
@@ -223,7 +329,7 @@ class GSEXRM_MapRow:
         if FLAGxrf:
             xrf_reader = read_xsp3_hdf5
             if not xrffile.startswith('xsp'):
-                xrf_reader = read_xmap_netcdf
+                xrf_reader = read_xrf_netcdf
         
         if FLAGxrd:
             xrd_reader = read_xrd_netcdf
@@ -293,9 +399,11 @@ class GSEXRM_MapRow:
 
         ## SPECIFIC TO XRF data
         if FLAGxrf: 
-            self.counts    = xrfdat.counts # [:]
-            self.inpcounts = xrfdat.inputCounts[:]
-            self.outcounts = xrfdat.outputCounts[:]
+            # counts are kept as read: slicing, reversing and transposing
+            # below only make views of them
+            self.counts    = xrfdat.counts
+            self.inpcounts = xrfdat.inputCounts
+            self.outcounts = xrfdat.outputCounts
             
             # times are extracted from the netcdf file as floats of ms
             # here we truncate to nearest ms (clock tick is 0.32 ms)
@@ -303,8 +411,9 @@ class GSEXRM_MapRow:
             self.realtime  = (xrfdat.realTime[:]).astype('int')
 
             dt_denom = xrfdat.outputCounts*xrfdat.liveTime
-            dt_denom[np.where(dt_denom < 1)] = 1.0
+            dt_denom[dt_denom < 1] = 1.0
             self.dtfactor  = xrfdat.inputCounts*xrfdat.realTime/dt_denom
+            self.dtfactor  = self.dtfactor.astype('float32')
                
         ## SPECIFIC TO XRD data
         if FLAGxrd:
@@ -336,9 +445,7 @@ class GSEXRM_MapRow:
             if FLAGxrd:
                 self.xrd2d = self.xrd2d[:self.npts]
 
-        points = range(1, self.npts+1)
         if reverse:
-            points.reverse()
             self.sisdata  = self.sisdata[::-1]
             if FLAGxrf:
                 self.counts  = self.counts[::-1]
@@ -352,24 +459,24 @@ class GSEXRM_MapRow:
 
 
         if FLAGxrf:
-            xvals = [(gdata[i, ixaddr] + gdata[i-1, ixaddr])/2.0 for i in points]
+            xvals = pixel_xvals(gdata[:, ixaddr], self.npts)
+            if reverse:
+                xvals = xvals[::-1]
 
-            self.posvals = [np.array(xvals)]
+            self.posvals = [xvals]
             if dimension == 2:
-                self.posvals.append(np.array([float(yvalue) for i in points]))
+                self.posvals.append(np.full(len(xvals), float(yvalue)))
             self.posvals.append(self.realtime.sum(axis=1).astype('float32') / nmca)
             self.posvals.append(self.livetime.sum(axis=1).astype('float32') / nmca)
 
-            total = None
-            for imca in range(nmca):
-                dtcorr = self.dtfactor[:, imca].astype('float32')
-                cor   = dtcorr.reshape((dtcorr.shape[0], 1))
-                if total is None:
-                    total = self.counts[:, imca, :] * cor
-                else:
-                    total = total + self.counts[:, imca, :] * cor
-            self.total = total.astype('int16')
-            self.dtfactor = self.dtfactor.astype('float32')
+            # dead-time corrected sum over detectors, accumulated
+            # into a single (npts, nchan) buffer.  This is kept as float32:
+            # it is converted to the counts data type of the storage
+            # policy when written to the detsum counts dataset.
+            self.total = np.empty((self.counts.shape[0], nchan),
+                                  dtype='float32')
+            np.einsum('ijk,ij->ik', self.counts, self.dtfactor,
+                      out=self.total, casting='unsafe')
             self.dtfactor = self.dtfactor.transpose()
             self.inpcounts= self.inpcounts.transpose()
             self.outcounts= self.outcounts.transpose()
@@ -524,12 +631,14 @@ class GSEXRM_MapFile(object):
 
     def __init__(self, filename=None, folder=None, root=None, chunksize=None,
                  calibration=None, mask=None, bkgd=None,
-                 FLAGxrf=False, FLAGxrd=False, xchannels=5001, xwedge=1):
+                 FLAGxrf=False, FLAGxrd=False, xchannels=5001, xwedge=1,
+                 storage=None):
 
         self.filename         = filename
         self.folder           = folder
         self.root             = root
         self.chunksize        = chunksize
+        self.storage          = get_storage_policy(storage)
         self.status           = GSEXRM_FileStatus.err_notfound
         self.dimension        = None
         self.ndet             = None
@@ -539,7 +648,8 @@ class GSEXRM_MapFile(object):
         self.last_row         = -1
         self.rowdata          = []
         self.npts             = None
-        self.roi_slices       = None
+        self.roi_limits       = None
+        self.roi_buffers      = None
         self.pixeltime        = None
         self.dt               = debugtime()
         self.masterfile       = None
@@ -606,7 +716,7 @@ class GSEXRM_MapFile(object):
                 cfile.Read(os.path.join(self.folder, self.ScanFile))
                 cfile.config['scan']['filename'] = self.filename
                 cfile.Save(os.path.join(self.folder, self.ScanFile))
-            self.h5root = h5py.File(self.filename)
+            self.h5root = self.storage.open(self.filename)
             
             if self.dimension is None and isGSEXRM_MapFolder(self.folder):
                 self.read_master()
@@ -637,9 +747,6 @@ class GSEXRM_MapFile(object):
         if 'data2D' in xrdgrp:
             if 'data1D' not in xrdgrp:
                 print('shape of data2D: ',xrdgrp['data2D'].shape) ## mkak 2016.09.15
-#                xrdgrp.create_dataset('data1D', data=integrate_xrd(xrdgrp['data2D'], 
-#                                                    unit='q', AI = xrdgrp, save=False),
-#                                                    compression=COMPRESSION_LEVEL)
             xrdgrp.__delitem__('data2D')
             newh5root.flush()
         newh5root.close()
@@ -691,7 +798,7 @@ class GSEXRM_MapFile(object):
                     "'%s' is not a valid GSEXRM HDF5 file" % self.filename)
         self.filename = filename
         if self.h5root is None:
-            self.h5root = h5py.File(self.filename)
+            self.h5root = self.storage.open(self.filename)
         self.xrmmap = self.h5root[root]
         if self.folder is None:
             self.folder = self.xrmmap.attrs['Map_Folder']
@@ -781,9 +888,7 @@ class GSEXRM_MapFile(object):
         """ creata an hdf5 dataset"""
         if not self.check_hostid():
             raise GSEXRM_NotOwner(self.filename)
-        kwargs = {'compression': COMPRESSION_LEVEL}
-        kwargs.update(kws)
-        d = group.create_dataset(name, data=data, **kwargs)
+        d = self.storage.create_dataset(group, name, data=data, **kws)
         if isinstance(attrs, dict):
             for key, val in attrs.items():
                 d.attrs[key] = val
@@ -811,12 +916,10 @@ class GSEXRM_MapFile(object):
         self.ndet = len(calib['slope'])
         self.xrmmap.attrs['N_Detectors'] = self.ndet
         roi_desc, roi_addr, roi_lim = [], [], []
-        roi_slices = []
         for iroi, label, lims in roidat:
             roi_desc.append(label)
             roi_addr.append("%smca%%i.R%i" % (config['xrf']['prefix'], iroi))
             roi_lim.append([lims[i] for i in range(self.ndet)])
-            roi_slices.append([slice(lims[i][0], lims[i][1]) for i in range(self.ndet)])
         roi_lim = np.array(roi_lim)
 
         self.add_data(group['rois'], 'name',     roi_desc)
@@ -831,7 +934,7 @@ class GSEXRM_MapFile(object):
 
         self.roi_desc = roi_desc
         self.roi_addr = roi_addr
-        self.roi_slices = roi_slices
+        self.roi_limits = roi_lim
         self.calib = calib
         # add env data
         envdat = readEnvironFile(os.path.join(self.folder, self.EnvFile))
@@ -871,9 +974,16 @@ class GSEXRM_MapFile(object):
         
         self.status = GSEXRM_FileStatus.hasdata
 
-    def process(self, maxrow=None, force=False, callback=None, verbose=True):
-        "look for more data from raw folder, process if needed"
+    def process(self, maxrow=None, force=False, callback=None, verbose=True,
+                nworkers=NWORKERS, readahead=NREADAHEAD, flush_every=None):
+        """look for more data from raw folder, process if needed
 
+        Rows are read by `nworkers` threads, at most `readahead` rows
+        ahead of the rows being written, and are added to the HDF5 file
+        in order, flushing the file every `flush_every` rows (default
+        from the storage policy).
+        Use nworkers=0 to read and write each row in turn.
+        """
         if not self.check_hostid():
             raise GSEXRM_NotOwner(self.filename)
 
@@ -887,23 +997,32 @@ class GSEXRM_MapFile(object):
             nrows = min(nrows, maxrow)
         if force or self.folder_has_newdata():
             irow = self.last_row + 1
-            while irow < nrows:
-                # self.dt.add('=>PROCESS %i' % irow)
-                if hasattr(callback, '__call__'):
-                    callback(row=irow, maxrow=nrows,
-                             filename=self.filename, status='reading')
-                row = self.read_rowdata(irow)
-                # self.dt.add('  == read row data')
-                if hasattr(callback, '__call__'):
-                    callback(row=irow, maxrow=nrows,
-                             filename=self.filename, status='complete')
-
-                if row.read_ok:
-                    self.add_rowdata(row, verbose=verbose)
-                    irow  = irow + 1
-                else:
-                    print("==Warning: Read failed at row %i" % irow)
-                    break
+            if flush_every is None:
+                flush_every = self.storage.flush_every
+            flush_every = max(1, flush_every)
+            rows = self.iter_rowdata(irow, nrows, nworkers=nworkers,
+                                     readahead=readahead)
+            try:
+                while irow < nrows:
+                    # self.dt.add('=>PROCESS %i' % irow)
+                    if hasattr(callback, '__call__'):
+                        callback(row=irow, maxrow=nrows,
+                                 filename=self.filename, status='reading')
+                    row = next(rows)
+                    # self.dt.add('  == read row data')
+                    if hasattr(callback, '__call__'):
+                        callback(row=irow, maxrow=nrows,
+                                 filename=self.filename, status='complete')
+
+                    if row.read_ok:
+                        irow  = irow + 1
+                        self.add_rowdata(row, verbose=verbose,
+                                         flush=(irow % flush_every == 0))
+                    else:
+                        print("==Warning: Read failed at row %i" % irow)
+                        break
+            finally:
+                rows.close()
             # self.dt.show()
         self.resize_arrays(self.last_row+1)
         self.h5root.flush()
@@ -911,6 +1030,152 @@ class GSEXRM_MapFile(object):
             self.calc_pixeltime()
         print(datetime.datetime.fromtimestamp(time.time()).strftime('End: %Y-%m-%d %H:%M:%S'))
 
+    def watch(self, maxrow=None, callback=None, verbose=True, timeout=30.0,
+              settle=None, use_inotify=True):
+        """process rows from the raw folder as they are completed,
+        until all expected rows are added or no new rows are completed
+        within `timeout` seconds.
+
+        The folder is watched with a MapFolderWatcher (inotify on Linux,
+        polling otherwise), and a row is read only once all of its raw
+        data files are complete: not empty, and with the same size and
+        modification time in two checks at least `settle` seconds apart
+        (default folderwatch.SETTLE_TIME).
+        """
+        if not self.check_hostid():
+            raise GSEXRM_NotOwner(self.filename)
+        if not isGSEXRM_MapFolder(self.folder):
+            return
+        opts = {'use_inotify': use_inotify}
+        if settle is not None:
+            opts['settle'] = settle
+        watcher = MapFolderWatcher(self.folder, **opts)
+        flush_every = self.storage.flush_every
+        tlast = time.time()
+        try:
+            while True:
+                new_rows = watcher.has_changed(self.MasterFile)
+                if new_rows:
+                    self.read_master()
+                nrows = len(self.rowdata)
+                if maxrow is not None:
+                    nrows = min(nrows, maxrow)
+                irow = self.last_row + 1
+                if new_rows:
+                    # observe the files of all pending rows now, so that
+                    # files already written settle together, not row by row
+                    for rowdat in self.rowdata[irow:nrows]:
+                        watcher.all_complete(rowdat[1:-1])
+                while (irow < nrows and
+                       watcher.all_complete(self.rowdata[irow][1:-1])):
+                    if self.status == GSEXRM_FileStatus.created:
+                        self.initialize_xrmmap()
+                        irow = self.last_row + 1
+                        tlast = time.time()
+                        continue
+                    if hasattr(callback, '__call__'):
+                        callback(row=irow, maxrow=nrows,
+                                 filename=self.filename, status='reading')
+                    row = self.read_rowdata(irow)
+                    if row is None or not row.read_ok:
+                        print("==Warning: Read failed at row %i" % irow)
+                        break
+                    irow = irow + 1
+                    self.add_rowdata(row, verbose=verbose,
+                                     flush=(irow % flush_every == 0))
+                    if hasattr(callback, '__call__'):
+                        callback(row=irow-1, maxrow=nrows,
+                                 filename=self.filename, status='complete')
+                    tlast = time.time()
+                nexpected = self.nrows_expected
+                if maxrow is not None:
+                    nexpected = maxrow
+                if nexpected is not None and self.last_row+1 >= nexpected:
+                    break
+                if time.time() - tlast > timeout:
+                    break
+                watcher.wait()
+        finally:
+            watcher.close()
+            if self.status == GSEXRM_FileStatus.hasdata:
+                self.resize_arrays(self.last_row+1)
+                self.h5root.flush()
+                if self.pixeltime is None:
+                    self.calc_pixeltime()
+
+    def iter_rowdata(self, first, last, nworkers=NWORKERS, readahead=NREADAHEAD):
+        """generate rows of raw data (from read_rowdata) for rows
+        first through last-1, in order.
+
+        With nworkers > 0, the rows are read by that many threads,
+        at most `readahead` rows ahead of the row last generated.
+        Errors raised while reading a row are re-raised when that
+        row would be generated.
+        """
+        if nworkers < 1 or last - first < 2:
+            for irow in range(first, last):
+                yield self.read_rowdata(irow)
+            return
+
+        # make sure the Master file and flags are read before
+        # starting the readers
+        if self.dimension is None or last > len(self.rowdata):
+            self.read_master()
+        try:
+            self.flag_xrf
+        except:
+            self.reset_flags()
+
+        rowq = queue.Queue()
+        for irow in range(first, last):
+            rowq.put(irow)
+        slots = threading.Semaphore(max(1, readahead))
+        done = threading.Event()
+        ready = threading.Condition()
+        results = {}
+
+        def reader():
+            while not done.is_set():
+                slots.acquire()
+                if done.is_set():
+                    return
+                try:
+                    irow = rowq.get_nowait()
+                except queue.Empty:
+                    slots.release()
+                    return
+                try:
+                    out = (self.read_rowdata(irow), None)
+                except:
+                    out = (None, sys.exc_info())
+                with ready:
+                    results[irow] = out
+                    ready.notify_all()
+
+        threads = []
+        for i in range(min(nworkers, last - first)):
+            thread = threading.Thread(target=reader, name='xrm_reader%i' % i)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            for irow in range(first, last):
+                with ready:
+                    while irow not in results:
+                        ready.wait(0.5)
+                    row, exc_info = results.pop(irow)
+                slots.release()
+                if exc_info is not None:
+                    six.reraise(*exc_info)
+                yield row
+        finally:
+            # stop the readers, freeing any that are waiting for a slot
+            done.set()
+            for thread in threads:
+                slots.release()
+            for thread in threads:
+                thread.join()
+
     def calc_pixeltime(self):
         scanconf = self.xrmmap['config/scan']
         rowtime = float(scanconf['time1'].value)
@@ -954,8 +1219,31 @@ class GSEXRM_MapFile(object):
                              FLAGxrf = self.flag_xrf, FLAGxrd = self.flag_xrd)
 
        
-    def add_rowdata(self, row, verbose=True):
-        """adds a row worth of real data"""
+    def _roi_row_buffers(self, npts, nsis, nrois, nmca, nchan, dtype):
+        """work arrays for the ROI sums of one row, allocated once per map
+        (and again only if the ROIs or detector layout change), and
+        re-used for each row added by add_rowdata()"""
+        wtype = np.int64
+        if np.dtype(dtype).kind not in 'iub':
+            wtype = np.float64
+        key = (npts, nsis, nrois, nmca, nchan, wtype)
+        if self.roi_buffers is None or self.roi_buffers['key'] != key:
+            bufs = {'key': key,
+                    'work': np.zeros((nmca, npts, nchan+1), dtype=wtype)}
+            for name, ncols in (('det_raw', nsis + nrois*nmca),
+                                ('det_cor', nsis + nrois*nmca),
+                                ('sum_raw', nsis + nrois),
+                                ('sum_cor', nsis + nrois)):
+                bufs[name] = np.zeros((npts, ncols))
+            for name in ('det_raw', 'det_cor'):
+                rois = bufs[name][:, nsis:].view()
+                rois.shape = (npts, nrois, nmca)
+                bufs['%s_rois' % name] = rois.transpose(2, 0, 1)
+            self.roi_buffers = bufs
+        return self.roi_buffers
+
+    def add_rowdata(self, row, verbose=True, flush=True):
+        """adds a row worth of real data, flushing the HDF5 file if flush=True"""
         if not self.check_hostid():
             raise GSEXRM_NotOwner(self.filename)
             
@@ -997,7 +1285,8 @@ class GSEXRM_MapFile(object):
                 grp['outcounts'][thisrow, :npts] = row.outcounts[idet, :npts]
                 grp['counts'][thisrow, :npts, :] = row.counts[idet, :npts, :]
 
-            # here, we add the total dead-time-corrected data to detsum.
+            # here, we add the total dead-time-corrected data to detsum,
+            # truncated (and clipped) to the counts data type by HDF5.
             self.xrmmap['detsum']['counts'][thisrow, :npts, :nchan] = row.total[:npts, :nchan]
 
             pos    = self.xrmmap['positions/pos']
@@ -1014,36 +1303,44 @@ class GSEXRM_MapFile(object):
             sum_raw = roimap['sum_raw']
             sum_cor = roimap['sum_cor']
 
-            detraw = list(row.sisdata[:npts].transpose())
-
-            detcor = detraw[:]
-            sumraw = detraw[:]
-            sumcor = detraw[:]
-
-            if self.roi_slices is None:
-                lims = self.xrmmap['config/rois/limits'].value
-                nrois, nmca, nx = lims.shape
-        
-                self.roi_slices = []
-                for iroi in range(nrois):
-                    x = [slice(lims[iroi, i, 0],
-                               lims[iroi, i, 1]) for i in range(nmca)]
-                    self.roi_slices.append(x)
-
-            for slices in self.roi_slices:
-                iraw = [row.counts[i, :npts, slices[i]].sum(axis=1)
-                        for i in range(nmca)]
-                icor = [row.counts[i, :npts, slices[i]].sum(axis=1)*row.dtfactor[i, :npts]
-                        for i in range(nmca)]
-                detraw.extend(iraw)
-                detcor.extend(icor)
-                sumraw.append(np.array(iraw).sum(axis=0))
-                sumcor.append(np.array(icor).sum(axis=0))
-
-            det_raw[thisrow, :npts, :] = np.array(detraw).transpose()
-            det_cor[thisrow, :npts, :] = np.array(detcor).transpose()
-            sum_raw[thisrow, :npts, :] = np.array(sumraw).transpose()
-            sum_cor[thisrow, :npts, :] = np.array(sumcor).transpose()
+            if self.roi_limits is None:
+                self.roi_limits = self.xrmmap['config/rois/limits'].value
+            nrois = len(self.roi_limits)
+            sisdata = row.sisdata[:npts]
+            nsis = sisdata.shape[1]
+
+            # columns are scalers, then ROIs for each detector
+            bufs = self._roi_row_buffers(det_raw.shape[1], nsis, nrois,
+                                         nmca, row.counts.shape[2],
+                                         row.counts.dtype)
+            detraw = bufs['det_raw'][:npts]
+            detcor = bufs['det_cor'][:npts]
+            sumraw = bufs['sum_raw'][:npts]
+            sumcor = bufs['sum_cor'][:npts]
+            for arr in (detraw, detcor, sumraw, sumcor):
+                arr[:, :nsis] = sisdata
+            # views of the ROI columns as (detector, pixel, roi)
+            raw = bufs['det_raw_rois'][:, :npts, :]
+            cor = bufs['det_cor_rois'][:, :npts, :]
+            roi_integrate(row.counts[:, :npts, :], self.roi_limits,
+                          out=raw, work=bufs['work'][:, :npts, :])
+            np.multiply(raw, row.dtfactor[:, :npts, np.newaxis], out=cor)
+            np.sum(raw, axis=0, out=sumraw[:, nsis:])
+            np.sum(cor, axis=0, out=sumcor[:, nsis:])
+
+            det_raw[thisrow, :npts, :] = detraw
+            det_cor[thisrow, :npts, :] = detcor
+            sum_raw[thisrow, :npts, :] = sumraw
+            sum_cor[thisrow, :npts, :] = sumcor
+
+            if 'pyramid' in self.xrmmap:
+                # add this row to the pyramid levels from the data in memory,
+                # as stored in the roimap datasets
+                rowdata = {'counts': row.total[np.newaxis, :npts, :nchan]}
+                for name, dat in (('det_raw', detraw), ('det_cor', detcor),
+                                  ('sum_raw', sumraw), ('sum_cor', sumcor)):
+                    rowdata[name] = dat.astype(roimap[name].dtype)[np.newaxis]
+                self._pyramid_add(thisrow, rowdata)
 
         t1 = time.time()
         
@@ -1101,7 +1398,8 @@ class GSEXRM_MapFile(object):
                 
         self.last_row = thisrow
         self.xrmmap.attrs['Last_Row'] = thisrow
-        self.h5root.flush()
+        if flush:
+            self.h5root.flush()
 
     def build_schema(self, row, verbose=False):
         """build schema for detector and scan data"""
@@ -1128,12 +1426,7 @@ class GSEXRM_MapFile(object):
                 print(prtxt % (npts, row.npts, nmca, nchan))
                 
             if self.chunksize is None:
-                if xnpts < 10: xnpts=10
-                nxx = min(xnpts-1, 2**int(np.log2(xnpts)))
-                nxm = 1024
-                if nxx > 256:
-                    nxm = min(1024, int(65536*1.0/ nxx))
-                self.chunksize = (1, nxx, nxm)
+                self.chunksize = self.storage.counts_chunks(xnpts, nchan)
             en_index = np.arange(nchan)
 
             offset = conf['mca_calib/offset'].value
@@ -1155,17 +1448,16 @@ class GSEXRM_MapFile(object):
                 self.add_data(dgrp, 'roi_address', [s % (imca+1) for s in roi_addrs])
                 self.add_data(dgrp, 'roi_limits',  roi_limits[:,imca,:])
 
-                dgrp.create_dataset('counts', (NINIT, npts, nchan), np.int16,
-                                    compression=COMPRESSION_LEVEL,
-                                    chunks=self.chunksize,
-                                    maxshape=(None, npts, nchan))
+                self.storage.create_dataset(dgrp, 'counts', (NINIT, npts, nchan),
+                                            self.storage.counts_dtype,
+                                            chunks=self.chunksize,
+                                            maxshape=(None, npts, nchan))
                 for name, dtype in (('realtime', np.int),  ('livetime', np.int),
                                     ('dtfactor', np.float32),
                                     ('inpcounts', np.float32),
                                     ('outcounts', np.float32)):
-                    dgrp.create_dataset(name, (NINIT, npts), dtype,
-                                        compression=COMPRESSION_LEVEL,
-                                        maxshape=(None, npts))
+                    self.storage.create_dataset(dgrp, name, (NINIT, npts), dtype,
+                                                maxshape=(None, npts))
 
             # add 'virtual detector' for corrected sum:
             dgrp = xrmmap.create_group('detsum')
@@ -1177,10 +1469,10 @@ class GSEXRM_MapFile(object):
             self.add_data(dgrp, 'roi_name',    roi_names)
             self.add_data(dgrp, 'roi_address', [s % 1 for s in roi_addrs])
             self.add_data(dgrp, 'roi_limits',  roi_limits[: ,0, :])
-            dgrp.create_dataset('counts', (NINIT, npts, nchan), np.int16,
-                                compression=COMPRESSION_LEVEL,
-                                chunks=self.chunksize,
-                                maxshape=(None, npts, nchan))
+            self.storage.create_dataset(dgrp, 'counts', (NINIT, npts, nchan),
+                                        self.storage.counts_dtype,
+                                        chunks=self.chunksize,
+                                        maxshape=(None, npts, nchan))
             # roi map data
             scan = xrmmap['roimap']
             det_addr = [i.strip() for i in row.sishead[-2][1:].split('|')]
@@ -1226,10 +1518,9 @@ class GSEXRM_MapFile(object):
                                     ('det_cor', nsca, np.float32),
                                     ('sum_raw', nsum, np.int32),
                                     ('sum_cor', nsum, np.float32)):
-                scan.create_dataset(name, (NINIT, npts, nx), dtype,
-                                    compression=COMPRESSION_LEVEL,
-                                    chunks=(2, npts, nx),
-                                    maxshape=(None, npts, nx))
+                self.storage.create_dataset(scan, name, (NINIT, npts, nx), dtype,
+                                            chunks=self.storage.roimap_chunks(npts, nx),
+                                            maxshape=(None, npts, nx))
         
             # positions
             pos = xrmmap['positions']
@@ -1239,9 +1530,8 @@ class GSEXRM_MapFile(object):
             npos = len(self.pos_desc)
             self.add_data(pos, 'name',     self.pos_desc)
             self.add_data(pos, 'address',  self.pos_addr)
-            pos.create_dataset('pos', (NINIT, npts, npos), dtype,
-                               compression=COMPRESSION_LEVEL,
-                               maxshape=(None, npts, npos))
+            self.storage.create_dataset(pos, 'pos', (NINIT, npts, npos), dtype,
+                                        maxshape=(None, npts, npos))
 
         if self.flag_xrd:
 
@@ -1249,26 +1539,18 @@ class GSEXRM_MapFile(object):
                 self.add_calibration()
 
             xrdpts, xpixx, xpixy = row.xrd2d.shape
-            self.chunksize_2DXRD    = (1, 1, xpixx, xpixy)
+            self.chunksize_2DXRD    = self.storage.xrd_chunks(xpixx, xpixy)
 
             if verbose:
                 prtxt = '--- Build XRD Schema: %i, %i ---- 2D:  (%i, %i)'
                 print(prtxt % (npts, row.npts, xpixx, xpixy))
 
-            xrmmap['xrd'].create_dataset('data2D',(xrdpts, xrdpts, xpixx, xpixy), np.uint16,
-                                   chunks = self.chunksize_2DXRD,
-                                   compression=COMPRESSION_LEVEL)
+            self.storage.create_dataset(xrmmap['xrd'], 'data2D',
+                                        (xrdpts, xrdpts, xpixx, xpixy), np.uint16,
+                                        chunks=self.chunksize_2DXRD)
 ## temporary test:
 ## don't calculate 1D until stripping 2D or when plotting
 ## mkak 2016.09.09
-#            xchan = self.xchan
-#            xwedge = self.xwedge
-#            self.chunksize_1DXRD    = (1, 1, xwedge+1, xchan)             
-#            ## what resolution should be used for q/2th integration?
-#            ## how many wedges for 1D integration?
-#            xrmmap['xrd'].create_dataset('data1D',(xrdpts, xrdpts, xwedge+1, xchan), 
-#                                   np.int16, chunks = self.chunksize_1DXRD,
-#                                   compression=COMPRESSION_LEVEL)
 
         print(datetime.datetime.fromtimestamp(time.time()).strftime('\nStart: %Y-%m-%d %H:%M:%S'))      
         
@@ -1597,6 +1879,158 @@ class GSEXRM_MapFile(object):
         ny, nx, npos = self.xrmmap['positions/pos'].shape
         return ny, nx
 
+    def _counts_index_name(self, det=None, dtcorrect=True):
+        "name of counts index for det, dtcorrect, or None if not supported"
+        if self.ndet is None:
+            self.ndet =  self.xrmmap.attrs['N_Detectors']
+        if det is None:
+            name = 'sum'
+        elif det in range(1, self.ndet+1):
+            name = 'det%i' % det
+        else:
+            return None
+        return '%s_%s' % (name, 'cor' if dtcorrect else 'raw')
+
+    def get_counts_index(self, det=None, dtcorrect=True):
+        """return the MCA counts index dataset for det, dtcorrect
+        (see build_counts_index), or None if it has not been built"""
+        name = self._counts_index_name(det=det, dtcorrect=dtcorrect)
+        if name is None or 'counts_index' not in self.xrmmap:
+            return None
+        group = self.xrmmap['counts_index']
+        if name in group:
+            return group[name]
+        return None
+
+    def build_counts_index(self, det=None, dtcorrect=True, tilesize=NTILE):
+        """build or extend an index of MCA spectra summed over the map,
+        used by get_counts_rect() and get_mca_area() to extract the
+        spectra for large rectangles and areas with few reads.
+
+        Parameters
+        ---------
+        det :        optional, None or int  index of detector
+        dtcorrect :  optional, bool [True]  dead-time correct data
+        tilesize :   optional, int          pixels on each side of tiles
+
+        Notes
+        -----
+        The map is divided into square tiles of tilesize pixels, and
+        the index holds the summed-area table of the tile spectra: the
+        spectrum summed over all tiles above and to the left of each tile
+        corner, with shape (NTY+1, NTX+1, NCHAN).  The spectrum for any
+        block of tiles then takes 4 corners of the index, and only the
+        pixels of partial tiles are read from the counts arrays.
+
+        Only complete rows of tiles are indexed, so that the index
+        can be extended as more rows are added to the map.
+        """
+        if not self.check_hostid():
+            raise GSEXRM_NotOwner(self.filename)
+        name = self._counts_index_name(det=det, dtcorrect=dtcorrect)
+        if name is None:
+            raise GSEXRM_Exception("cannot index counts for detector '%s'" % det)
+
+        if det is None:
+            dets = self._mca_dets()
+        else:
+            dets = [self._det_group(det)]
+        nrow, npts, nchan = dets[0]['counts'].shape
+        nrow = min(nrow, self.last_row + 1)
+        nty, ntx = int(nrow/tilesize), int(npts/tilesize)
+        nx = ntx*tilesize
+
+        if 'counts_index' not in self.xrmmap:
+            self.xrmmap.create_group('counts_index')
+        group = self.xrmmap['counts_index']
+        index = group.get(name, None)
+        if index is not None and (index.attrs['tilesize'] != tilesize or
+                                  index.shape[1:] != (ntx+1, nchan)):
+            del group[name]
+            index = None
+        if index is None:
+            index = self.storage.create_dataset(group, name, (1, ntx+1, nchan),
+                                                np.float64,
+                                                chunks=(1, min(ntx+1, 16), nchan),
+                                                maxshape=(None, ntx+1, nchan))
+            index.attrs['tilesize'] = tilesize
+        ty0 = index.shape[0] - 1
+        if nty <= ty0:
+            return index
+        index.resize((nty+1, ntx+1, nchan))
+        last = index[ty0]
+        for ty in range(ty0, nty):
+            tiles = np.zeros((ntx, nchan))
+            for irow in range(ty*tilesize, (ty+1)*tilesize):
+                for grp in dets:
+                    counts = grp['counts'][irow, :nx, :]
+                    if dtcorrect:
+                        dtfactor = grp['dtfactor'][irow, :nx]
+                        counts = counts*dtfactor[:, np.newaxis]
+                    tiles += counts.reshape(ntx, tilesize, nchan).sum(axis=1)
+            last = last.copy()
+            last[1:] += tiles.cumsum(axis=0)
+            index[ty+1] = last
+        self.h5root.flush()
+        return index
+
+    def _counts_rect_indexed(self, index, ymin, ymax, xmin, xmax, det=None,
+                             area=None, dtcorrect=True):
+        """return counts for a map rectangle using a counts index,
+        as for get_counts_rect(), or None if the index does not help"""
+        tsize = int(index.attrs['tilesize'])
+        nty, ntx = index.shape[0]-1, index.shape[1]-1
+        ty0 = int((ymin + tsize - 1)/tsize)
+        tx0 = int((xmin + tsize - 1)/tsize)
+        ty1 = min(nty, int(ymax/tsize))
+        tx1 = min(ntx, int(xmax/tsize))
+        if ty1 <= ty0 or tx1 <= tx0:
+            return None
+
+        def tilesum(ty0, ty1, tx0, tx1):
+            left = index[[ty0, ty1], tx0, :]
+            right = index[[ty0, ty1], tx1, :]
+            return right[1] - right[0] - left[1] + left[0]
+
+        def pixelsum(y0, y1, x0, x1):
+            if y1 <= y0 or x1 <= x0:
+                return 0
+            return self.get_counts_rect(y0, y1, x0, x1, det=det, area=area,
+                                        dtcorrect=dtcorrect, use_index=False)
+
+        ylo, yhi = ty0*tsize, ty1*tsize
+        xlo, xhi = tx0*tsize, tx1*tsize
+        # pixels outside the tiles
+        counts = np.zeros(index.shape[2])
+        counts += (pixelsum(ymin, ylo, xmin, xmax) +
+                  pixelsum(yhi, ymax, xmin, xmax) +
+                  pixelsum(ylo, yhi, xmin, xlo) +
+                  pixelsum(ylo, yhi, xhi, xmax))
+        if area is None:
+            counts += tilesum(ty0, ty1, tx0, tx1)
+        else:
+            # runs of tiles in each row of tiles that are entirely
+            # inside the area use the index, partial tiles are read.
+            for ty in range(ty0, ty1):
+                y0, y1 = ty*tsize, (ty+1)*tsize
+                tmask = area[y0:y1, xlo:xhi].reshape(tsize, tx1-tx0, tsize)
+                npix = tmask.sum(axis=(0, 2))
+                kind = np.where(npix == tsize*tsize, 2, np.where(npix > 0, 1, 0))
+                tx = 0
+                while tx < len(kind):
+                    run = tx
+                    while run < len(kind) and kind[run] == kind[tx]:
+                        run += 1
+                    x0, x1 = tx0 + tx, tx0 + run
+                    if kind[tx] == 2:
+                        counts += tilesum(ty, ty+1, x0, x1)
+                    elif kind[tx] == 1:
+                        counts += pixelsum(y0, y1, x0*tsize, x1*tsize)
+                    tx = run
+        if not dtcorrect:
+            counts = np.round(counts).astype(int)
+        return counts
+
     def get_mca_area(self, areaname, det=None, dtcorrect=True, callback = None):
         """return XRF spectra as MCA() instance for
         spectra summed over a pre-defined area
@@ -1629,6 +2063,8 @@ class GSEXRM_MapFile(object):
         nx, ny = (xmax-xmin), (ymax-ymin)
         NCHUNKSIZE = 16384 # 8192
         use_chunks = nx*ny > NCHUNKSIZE
+        if self.get_counts_index(det=det, dtcorrect=dtcorrect) is not None:
+            use_chunks = False
         step = int((nx*ny)/NCHUNKSIZE)
 
         if not use_chunks:
@@ -1699,7 +2135,7 @@ class GSEXRM_MapFile(object):
 
 
     def get_counts_rect(self, ymin, ymax, xmin, xmax, mapdat=None, det=None,
-                     area=None, dtcorrect=True):
+                     area=None, dtcorrect=True, use_index=True):
         """return counts for a map rectangle, optionally
         applying area mask and deadtime correction
 
@@ -1713,6 +2149,7 @@ class GSEXRM_MapFile(object):
         det :        optional, None or int         index of detector
         dtcorrect :  optional, bool [True]         dead-time correct data
         area :       optional, None or area object  area for mask
+        use_index :  optional, bool [True]         use counts index, if built
 
         Returns
         -------
@@ -1725,6 +2162,15 @@ class GSEXRM_MapFile(object):
         if mapdat is None:
             mapdat = self._det_group(det)
 
+        if use_index:
+            index = self.get_counts_index(det=det, dtcorrect=dtcorrect)
+            if index is not None:
+                counts = self._counts_rect_indexed(index, ymin, ymax, xmin, xmax,
+                                                   det=det, area=area,
+                                                   dtcorrect=dtcorrect)
+                if counts is not None:
+                    return counts
+
         nx, ny = (xmax-xmin, ymax-ymin)
         sx = slice(xmin, xmax)
         sy = slice(ymin, ymax)
@@ -2105,7 +2551,194 @@ class GSEXRM_MapFile(object):
             pos = pos.sum(axis=index)/pos.shape[index]
         return pos
 
-    def get_roimap(self, name, det=None, no_hotcols=True, dtcorrect=True):
+    def _pyramid_sources(self):
+        "full resolution datasets for pyramid levels"
+        out = {'counts': self.xrmmap['detsum/counts']}
+        for name in PYRAMID_MAPS:
+            out[name] = self.xrmmap['roimap/%s' % name]
+        return out
+
+    def _pyramid_rows(self, names, row0, row1):
+        """full resolution data for pyramid levels for rows row0:row1, as a
+        dict of arrays (nrows, npts, n).  'counts' is the dead-time corrected
+        sum of the detector counts (as GSEXRM_MapRow.total), not the
+        detsum counts, which are truncated to integers."""
+        out = {}
+        for name in names:
+            if name != 'counts':
+                out[name] = self.xrmmap['roimap/%s' % name][row0:row1]
+                continue
+            total = None
+            for grp in self._mca_dets():
+                counts = grp['counts'][row0:row1]
+                if total is None:
+                    total = np.zeros(counts.shape, dtype='float32')
+                total += counts*grp['dtfactor'][row0:row1][:, :, np.newaxis]
+            out[name] = total
+        return out
+
+    def _pyramid_add_level(self, grp, factor, irow, data):
+        """add full resolution rows starting at irow to the bins of one
+        pyramid level, adding to the bins already holding earlier rows"""
+        npts = self.xrmmap['detsum/counts'].shape[1]
+        for name, arr in data.items():
+            dset = grp[name]
+            nrows = arr.shape[0]
+            row = irow
+            while row < irow + nrows:
+                ibin = int(row/factor)
+                row1 = min(irow + nrows, (ibin+1)*factor)
+                binned = bin_columns(arr[row-irow:row1-irow], factor, npts)
+                nbin, ncol = binned.shape
+                if dset.shape[0] <= ibin or dset.shape[2] < ncol:
+                    dset.resize((max(ibin+1, dset.shape[0]), dset.shape[1],
+                                 max(ncol, dset.shape[2])))
+                if row > ibin*factor:
+                    binned += dset[ibin, :nbin, :ncol]
+                dset[ibin, :nbin, :ncol] = binned
+                row = row1
+
+    def _pyramid_add(self, irow, data):
+        """add full resolution rows starting at irow to the pyramid levels.
+        data is a dict of arrays (nrows, npts, n) for each dataset name,
+        holding the values of _pyramid_rows() for these rows.
+
+        New rows are added to the sums of their bins.  A row added before
+        replaces the earlier one: the bins holding it are summed again
+        from the full resolution data, which must already hold the row."""
+        pyr = self.xrmmap['pyramid']
+        nrows = list(data.values())[0].shape[0]
+        nadded = int(pyr.attrs['nrows'])
+        for level in range(1, pyr.attrs['nlevels']+1):
+            factor = 2**level
+            row0, rowdata = irow, data
+            if irow < nadded:
+                row0 = factor*int(irow/factor)
+                row1 = min(max(nadded, irow + nrows),
+                           factor*(1 + int((irow + nrows - 1)/factor)))
+                rowdata = self._pyramid_rows(list(data.keys()), row0, row1)
+            self._pyramid_add_level(pyr['level%i' % level], factor,
+                                    row0, rowdata)
+        pyr.attrs['nrows'] = max(nadded, irow + nrows)
+
+    def build_pyramid(self, nlevels=None, names=None):
+        """build multi-resolution levels of the detsum counts and roimap
+        arrays, binning 2, 4, 8, ... map pixels in each direction.
+
+        Parameters
+        ---------
+        nlevels :    optional, int   number of levels [None: enough levels
+                                     for the coarsest to be about
+                                     PYRAMID_MINSIZE pixels wide]
+        names :      optional, list  names of arrays to rebuild
+                                     ['counts', 'det_raw', 'det_cor',
+                                     'sum_raw', 'sum_cor'], only for
+                                     existing levels.
+
+        Notes
+        -----
+        Once built, the levels are updated as rows are added.
+        Each level holds sums over the pixels in each bin, leaving out
+        the first and last (hot) columns.  The 'counts' levels hold the
+        dead-time corrected sum of the detector counts, without the
+        truncation to integers of the detsum counts.  Use get_roimap(),
+        get_rgbmap(), and get_mca_erange() with size=(NY, NX) to read
+        the coarsest level with at least that many pixels.
+        """
+        if not self.check_hostid():
+            raise GSEXRM_NotOwner(self.filename)
+        sources = self._pyramid_sources()
+        nrow, npts, nchan = sources['counts'].shape
+        nrow = min(nrow, self.last_row + 1)
+        if names is None or 'pyramid' not in self.xrmmap:
+            names = list(sources.keys())
+            if nlevels is None:
+                nlevels = int(np.log2(max(1.0, (npts-2.0)/PYRAMID_MINSIZE)))
+            if 'pyramid' in self.xrmmap:
+                del self.xrmmap['pyramid']
+            pyr = self.xrmmap.create_group('pyramid')
+            pyr.attrs['nlevels'] = max(1, nlevels)
+            pyr.attrs['nrows'] = 0
+            for level in range(1, pyr.attrs['nlevels']+1):
+                grp = pyr.create_group('level%i' % level)
+                grp.attrs['binning'] = 2**level
+        pyr = self.xrmmap['pyramid']
+        nx = npts - 2
+        for level in range(1, pyr.attrs['nlevels']+1):
+            grp = pyr['level%i' % level]
+            nbin = int((nx + 2**level - 1)/2**level)
+            for name in names:
+                if name in grp:
+                    del grp[name]
+                ncol = sources[name].shape[2]
+                dtype = np.float32 if name == 'counts' else np.float64
+                self.storage.create_dataset(grp, name, (0, nbin, ncol), dtype,
+                                            chunks=(1, nbin, min(ncol, 1024)),
+                                            maxshape=(None, nbin, None))
+
+        itemsize = 0
+        for name in names:
+            nbytes = sources[name].shape[2]*sources[name].dtype.itemsize
+            if name == 'counts':
+                # detector counts and their float32 sum
+                nbytes = sources[name].shape[2]*(4 + sum(
+                    [g['counts'].dtype.itemsize for g in self._mca_dets()]))
+            itemsize += nbytes
+        step = max(1, int(ROI_BLOCKSIZE/(npts*itemsize)))
+        for row in range(0, nrow, step):
+            data = self._pyramid_rows(names, row, min(nrow, row+step))
+            for level in range(1, pyr.attrs['nlevels']+1):
+                self._pyramid_add_level(pyr['level%i' % level], 2**level,
+                                        row, data)
+        pyr.attrs['nrows'] = nrow
+        self.h5root.flush()
+
+    def get_pyramid_level(self, size=None):
+        """return the coarsest pyramid level with at least size=(NY, NX)
+        pixels, or 0 for full resolution"""
+        if size is None or 'pyramid' not in self.xrmmap:
+            return 0
+        if isinstance(size, int):
+            size = (size, size)
+        pyr = self.xrmmap['pyramid']
+        out = 0
+        for level in range(1, pyr.attrs['nlevels']+1):
+            ny, nx, n = pyr['level%i/counts' % level].shape
+            if ny >= size[0] and nx >= size[1]:
+                out = level
+        return out
+
+    def get_pyramid_map(self, level, name, index=None, mean=True):
+        """return map from a pyramid level (see build_pyramid),
+        as the mean value of the pixels in each bin, or their sum
+
+        Parameters
+        ---------
+        level :      int    pyramid level
+        name :       str    name of array ('counts', 'det_raw', ...)
+        index :      optional, int or slice for the last axis [None: all]
+        mean :       optional, bool [True]  return the mean of the pixels
+                                            in each bin, not their sum
+        """
+        pyr = self.xrmmap['pyramid']
+        dset = pyr['level%i/%s' % (level, name)]
+        if index is None:
+            index = slice(None)
+        out = dset[:, :, index]
+        if not mean:
+            return out
+        nbin, nx, n = dset.shape
+        factor = 2**level
+        npts = self.xrmmap['detsum/counts'].shape[1] - 2
+        nrows = np.minimum(factor, int(pyr.attrs['nrows']) - factor*np.arange(nbin))
+        ncols = np.minimum(factor, npts - factor*np.arange(nx))
+        npix = np.outer(np.maximum(nrows, 1), ncols)
+        if out.ndim == 3:
+            npix = npix[:, :, np.newaxis]
+        return out/(1.0*npix)
+
+    def get_roimap(self, name, det=None, no_hotcols=True, dtcorrect=True,
+                   size=None):
         """extract roi map for a pre-defined roi by name
 
         Parameters
@@ -2114,19 +2747,30 @@ class GSEXRM_MapFile(object):
         det  :       optional, None or int [None]  index for detector
         dtcorrect :  optional, bool [True]         dead-time correct data
         no_hotcols   optional, bool [True]         suprress hot columns
+        size :       optional, None or (NY, NX)    smallest size of map: use
+                                                   a coarser pyramid level
+                                                   if available, for
+                                                   no_hotcols=True
 
         Returns
         -------
-        ndarray for ROI data
+        ndarray for ROI data, with the value for each map pixel, or with
+        size, the sum of the values for the map pixels in each bin of a
+        pyramid level (see build_pyramid)
         """
         imap = -1
         roi_names = [r.lower() for r in self.xrmmap['config/rois/name']]
         det_names = [r.lower() for r in self.xrmmap['roimap/sum_name']]
         dat = 'roimap/sum_raw'
+        level = 0
+        if no_hotcols:
+            level = self.get_pyramid_level(size)
 
         # scaler, non-roi data
         if name.lower() in det_names and name.lower() not in roi_names:
             imap = det_names.index(name.lower())
+            if level > 0:
+                return self.get_pyramid_map(level, 'sum_raw', imap, mean=False)
             if no_hotcols:
                 return self.xrmmap[dat][:, 1:-1, imap]
             else:
@@ -2150,21 +2794,135 @@ class GSEXRM_MapFile(object):
         if imap < 0:
             raise GSEXRM_Exception("Could not find ROI '%s'" % name)
 
+        if level > 0:
+            return self.get_pyramid_map(level, dat.split('/')[-1], imap,
+                                        mean=False)
         if no_hotcols:
             return self.xrmmap[dat][:, 1:-1, imap]
         else:
             return self.xrmmap[dat][:, :, imap]
 
+    def _mca_dets(self, det=None):
+        "list of real mca detector groups, or the one for det"
+        if self.ndet is None:
+            self.ndet =  self.xrmmap.attrs['N_Detectors']
+        if det in range(1, self.ndet+1):
+            return [self.xrmmap['det%i' % det]]
+        return [self.xrmmap['det%i' % (i+1)] for i in range(self.ndet)]
+
+    def _roi_limits(self, dets, low, high, by_energy=True):
+        "[left, right) channel limits for each detector for a range"
+        low, high = min(low, high), max(low, high)
+        limits = []
+        for grp in dets:
+            if by_energy:
+                energy = grp['energy'].value
+                limits.append((np.searchsorted(energy, low),
+                               np.searchsorted(energy, high, side='right')))
+            else:
+                limits.append((int(low), int(high)+1))
+        return limits
+
+    def iter_roi_sums(self, dets, limits, nworkers=NROI_WORKERS):
+        """generate ROI sums (see roi_sums) from the MCA counts of
+        detector groups, in blocks of rows aligned with the HDF5 chunks
+        of the counts datasets.
+
+        Blocks are read and summed by up to nworkers threads, and are
+        generated as (row0, row1, raw, cor), not necessarily in order.
+        """
+        counts = dets[0]['counts']
+        nrow, npts, nchan = counts.shape
+        nchunk = 1
+        if counts.chunks is not None:
+            nchunk = counts.chunks[0]
+        rowsize = len(dets)*npts*nchan*counts.dtype.itemsize
+        step = nchunk*max(1, int(ROI_BLOCKSIZE/(nchunk*rowsize)))
+        blocks = [(r, min(nrow, r+step)) for r in range(0, nrow, step)]
+
+        def work(block):
+            return block + roi_sums(dets, limits, *block)
+
+        nworkers = min(nworkers, len(blocks))
+        if nworkers < 2:
+            for block in blocks:
+                yield work(block)
+            return
+
+        # limit the number of blocks summed but not yet used
+        slots = threading.Semaphore(2*nworkers)
+        done = threading.Event()
+        def feed():
+            for block in blocks:
+                slots.acquire()
+                if done.is_set():
+                    return
+                yield block
+
+        pool = ThreadPool(nworkers)
+        try:
+            for out in pool.imap_unordered(work, feed()):
+                slots.release()
+                yield out
+        finally:
+            done.set()
+            slots.release()
+            pool.terminate()
+
     def get_mca_erange(self, det=None, dtcorrect=True,
-                       emin=None, emax=None, by_energy=True):
-        """extract map for an ROI set here, by energy range:
+                       emin=None, emax=None, by_energy=True,
+                       no_hotcols=True, nworkers=NROI_WORKERS, size=None):
+        """extract map for an ROI set here, by energy range,
+        from the MCA counts in the map file
+
+        Parameters
+        ---------
+        det  :       optional, None or int [None]  index for detector
+        dtcorrect :  optional, bool [True]         dead-time correct data
+        emin :       optional, float [None]        low energy (or channel)
+        emax :       optional, float [None]        high energy (or channel)
+        by_energy :  optional, bool [True]         emin, emax are energies,
+                                                   not channel indices
+        no_hotcols   optional, bool [True]         suprress hot columns
+        nworkers :   optional, int                 number of threads reading
+                                                   full resolution counts
+        size :       optional, None or (NY, NX)    smallest size of map: use
+                                                   a coarser pyramid level
+                                                   if available, for
+                                                   det=None, dtcorrect=True,
+                                                   no_hotcols=True
 
-        not implemented
+        Returns
+        -------
+        ndarray of counts in the energy range, summed over detectors if det
+        is None, for each map pixel.  With size, the counts are summed over
+        the map pixels in each bin of a pyramid level (see build_pyramid),
+        using the channel limits of the detsum energies for all detectors.
         """
-        pass
+        dets = self._mca_dets(det)
+        nrow, npts, nchan = dets[0]['counts'].shape
+        if emin is None:
+            emin = dets[0]['energy'][0] if by_energy else 0
+        if emax is None:
+            emax = dets[0]['energy'][-1] if by_energy else nchan-1
+        level = self.get_pyramid_level(size)
+        if level > 0 and det is None and dtcorrect and no_hotcols:
+            dsum = self.xrmmap['detsum']
+            lo, hi = self._roi_limits([dsum], emin, emax, by_energy=by_energy)[0]
+            return self.get_pyramid_map(level, 'counts', slice(lo, hi),
+                                        mean=False).sum(axis=2)
+        limits = [self._roi_limits(dets, emin, emax, by_energy=by_energy)]
+        out = np.zeros((nrow, npts))
+        for row0, row1, raw, cor in self.iter_roi_sums(dets, limits,
+                                                       nworkers=nworkers):
+            dat = cor if dtcorrect else raw
+            out[row0:row1] = dat[:, :, 0, :].sum(axis=2)
+        if no_hotcols:
+            return out[:, 1:-1]
+        return out
 
     def get_rgbmap(self, rroi, groi, broi, det=None, no_hotcols=True,
-                   dtcorrect=True, scale_each=True, scales=None):
+                   dtcorrect=True, scale_each=True, scales=None, size=None):
         """return a (NxMx3) array for Red, Green, Blue from named
         ROIs (using get_roimap).
 
@@ -2180,6 +2938,8 @@ class GSEXRM_MapFile(object):
                      scale each map separately to span the full color range.
         scales :     optional, None or 3 element tuple [None]
                      multiplicative scale for each map.
+        size :       optional, None or (NY, NX) smallest size of map:
+                     use a coarser pyramid level if available.
 
         By default (scales_each=True, scales=None), each map is scaled by
         1.0/map.max() -- that is 1 of the max value for that map.
@@ -2189,11 +2949,11 @@ class GSEXRM_MapFile(object):
 
         """
         rmap = self.get_roimap(rroi, det=det, no_hotcols=no_hotcols,
-                               dtcorrect=dtcorrect)
+                               dtcorrect=dtcorrect, size=size)
         gmap = self.get_roimap(groi, det=det, no_hotcols=no_hotcols,
-                               dtcorrect=dtcorrect)
+                               dtcorrect=dtcorrect, size=size)
         bmap = self.get_roimap(broi, det=det, no_hotcols=no_hotcols,
-                               dtcorrect=dtcorrect)
+                               dtcorrect=dtcorrect, size=size)
 
         if scales is None or len(scales) != 3:
             scales = (1./rmap.max(), 1./gmap.max(), 1./bmap.max())
@@ -2209,12 +2969,79 @@ class GSEXRM_MapFile(object):
 
         return np.array([rmap, gmap, bmap]).swapaxes(0, 2).swapaxes(0, 1)
 
+    def _replace_data(self, group, names, data):
+        "replace a dataset, named by the first of names found in group"
+        for name in names:
+            if name in group:
+                break
+        else:
+            name = names[0]
+        if name in group:
+            del group[name]
+        return self.add_data(group, name, data)
+
+    def _resize_roimap(self, name, nx):
+        """resize an roimap array to have nx columns, copying
+        to a new dataset if it cannot be extended"""
+        group = self.xrmmap['roimap']
+        dset = group[name]
+        nrow, npts, nx0 = dset.shape
+        if nx <= nx0:
+            return
+        if dset.maxshape[2] is None:
+            dset.resize((nrow, npts, nx))
+            return
+        tmpname = '%s_resize' % name
+        if tmpname in group:
+            del group[tmpname]
+        out = self.storage.create_dataset(group, tmpname, (nrow, npts, nx),
+                                          dset.dtype,
+                                          chunks=self.storage.roimap_chunks(npts, nx),
+                                          maxshape=(None, npts, None))
+        step = 256
+        for row in range(0, nrow, step):
+            out[row:row+step, :, :nx0] = dset[row:row+step]
+        del group[name]
+        group.move(tmpname, name)
+
     def add_roi(self, name, high, low,  address='', det=1,
-                overwrite=False, **kws):
+                overwrite=False, by_energy=True, nworkers=NROI_WORKERS,
+                **kws):
         """add named ROI to an XRMMap file.
         These settings will be propogated through the
         ROI maps and all detectors.
 
+        Parameters
+        ---------
+        name :       str    ROI name
+        high :       float  high energy (or channel)
+        low  :       float  low energy (or channel)
+        address :    optional, str [''] address (may include '%i' for
+                                        the detector index)
+        det  :       ignored: the ROI is added for all detectors
+        overwrite :  optional, bool [False]  overwrite an existing ROI
+        by_energy :  optional, bool [True]   high, low are energies,
+                                             not channel indices
+        nworkers :   optional, int           number of reading threads
+
+        See add_rois() to add several ROIs at once.
+        """
+        self.add_rois([(name, low, high, address)], overwrite=overwrite,
+                      by_energy=by_energy, nworkers=nworkers)
+
+    def add_rois(self, rois, overwrite=False, by_energy=True,
+                 nworkers=NROI_WORKERS):
+        """add several named ROIs to an XRMMap file, with the ROI maps
+        computed from the MCA counts already in the file in a single
+        pass over the data.
+
+        Parameters
+        ---------
+        rois :       list of (name, low, high) or (name, low, high, address)
+        overwrite :  optional, bool [False]  overwrite existing ROIs
+        by_energy :  optional, bool [True]   low, high are energies,
+                                             not channel indices
+        nworkers :   optional, int           number of reading threads
         """
         # data structures affected:
         #   config/rois/address
@@ -2234,15 +3061,101 @@ class GSEXRM_MapFile(object):
         #   detsum/roi_address      for I = 1, N_detectors (xrmmap attribute)
         #   detsum/roi_name         for I = 1, N_detectors (xrmmap attribute)
         #   detsum/roi_limits       for I = 1, N_detectors (xrmmap attribute)
+        if not self.check_hostid():
+            raise GSEXRM_NotOwner(self.filename)
 
-        roi_names = [i.lower().strip() for i in self.xrmmap['config/rois/name']]
-        if name.lower().strip() in roi_name:
-            if overwrite:
-                self.del_roi(name)
+        dets = self._mca_dets()
+        ndet = len(dets)
+        conf = self.xrmmap['config/rois']
+        roimap = self.xrmmap['roimap']
+        roi_names = list(conf['name'])
+        roi_addrs = list(conf['address'])
+        roi_limits = list(conf['limits'].value)
+        det_names = list(roimap['det_name'])
+        det_addrs = list(roimap['det_address'])
+        sum_names = list(roimap['sum_name'])
+        sum_list = [list(s) for s in roimap['sum_list'].value]
+        nscalers = len(det_names) - ndet*len(roi_names)
+
+        iroi_new, limits = [], []
+        for roi in rois:
+            name, low, high = roi[:3]
+            address = roi[3] if len(roi) > 3 else ''
+            lnames = [r.lower().strip() for r in roi_names]
+            lims = self._roi_limits(dets, low, high, by_energy=by_energy)
+            if name.lower().strip() in lnames:
+                if not overwrite:
+                    print("An ROI named '%s' exists, use overwrite=True to overwrite" % name)
+                    continue
+                iroi = lnames.index(name.lower().strip())
+                roi_limits[iroi] = lims
             else:
-                print("An ROI named '%s' exists, use overwrite=True to overwrite" % name)
-                return
-        #
+                iroi = len(roi_names)
+                roi_names.append(name)
+                roi_addrs.append(address)
+                roi_limits.append(lims)
+                for i in range(ndet):
+                    det_names.append('%s (mca%i)' % (name, i+1))
+                    det_addrs.append(address % (i+1) if '%' in address
+                                     else address)
+                sum_names.append(name)
+                sum_list.append([nscalers + iroi*ndet + i
+                                 for i in range(ndet)])
+            iroi_new.append(iroi)
+            limits.append(lims)
+        if len(iroi_new) == 0:
+            return
+
+        # update ROI settings and names
+        roi_limits = np.array(roi_limits, dtype=int)
+        nsum = max([len(s) for s in sum_list])
+        sum_list = np.array([s + [-1]*(nsum-len(s)) for s in sum_list])
+        self._replace_data(conf, ('name',), roi_names)
+        self._replace_data(conf, ('address',), roi_addrs)
+        self._replace_data(conf, ('limits',), roi_limits)
+        for idet, grp in enumerate(dets):
+            self._replace_data(grp, ('roi_name', 'roi_names'), roi_names)
+            self._replace_data(grp, ('roi_address', 'roi_addrs'),
+                               [a % (idet+1) if '%' in a else a
+                                for a in roi_addrs])
+            self._replace_data(grp, ('roi_limits',), roi_limits[:, idet, :])
+        if 'detsum' in self.xrmmap:
+            grp = self.xrmmap['detsum']
+            self._replace_data(grp, ('roi_name', 'roi_names'), roi_names)
+            self._replace_data(grp, ('roi_address', 'roi_addrs'),
+                               [a % 1 if '%' in a else a for a in roi_addrs])
+            self._replace_data(grp, ('roi_limits',), roi_limits[:, 0, :])
+        self._replace_data(roimap, ('det_name',), det_names)
+        self._replace_data(roimap, ('det_address',), det_addrs)
+        self._replace_data(roimap, ('sum_name',), sum_names)
+        self._replace_data(roimap, ('sum_list',), sum_list)
+        for name, nx in (('det_raw', len(det_names)),
+                         ('det_cor', len(det_names)),
+                         ('sum_raw', len(sum_names)),
+                         ('sum_cor', len(sum_names))):
+            self._resize_roimap(name, nx)
+        self.roi_limits = None
+        self.roi_buffers = None
+
+        # compute the ROI maps
+        det_raw = roimap['det_raw']
+        det_cor = roimap['det_cor']
+        sum_raw = roimap['sum_raw']
+        sum_cor = roimap['sum_cor']
+        lsums = [s.lower() for s in sum_names]
+        for row0, row1, raw, cor in self.iter_roi_sums(dets, limits,
+                                                       nworkers=nworkers):
+            for i, iroi in enumerate(iroi_new):
+                icol = nscalers + iroi*ndet
+                # ROI sums follow any scaler with the same name
+                isum = len(lsums) - 1 - lsums[::-1].index(roi_names[iroi].lower())
+                det_raw[row0:row1, :, icol:icol+ndet] = raw[:, :, i, :]
+                det_cor[row0:row1, :, icol:icol+ndet] = cor[:, :, i, :]
+                sum_raw[row0:row1, :, isum] = raw[:, :, i, :].sum(axis=2)
+                sum_cor[row0:row1, :, isum] = cor[:, :, i, :].sum(axis=2)
+        if 'pyramid' in self.xrmmap:
+            self.build_pyramid(names=PYRAMID_MAPS)
+        self.h5root.flush()
 
     def del_roi(self, name):
         """ delete an ROI"""
@@ -10,25 +10,17 @@ import sys
 import os
 
 from larch import Group, ValidateLarchPlugin
+from larch_plugins.xrf import calc_icr_array
 
 # Default tau values for xspress3
 
 XSPRESS3_TAUS = [109.e-9, 91.e-9, 99.e-9, 98.e-9]
 
 def estimate_icr(ocr, tau, niter=3):
-    "estimate icr from ocr and tau"
-    maxicr = 1.0/tau
-    maxocr = 1/(tau*np.exp(1.0))
-    ocr[np.where(ocr>2*maxocr)[0]] = 2*maxocr
-    icr = 1.0*ocr
-    for c in range(niter):
-        delta = (icr - ocr*np.exp(icr*tau))/(icr*tau - 1)
-        delta[np.where(delta < 0)[0]] = 0.0
-        icr = icr + delta
-        icr[np.where(icr>5*maxicr)[0]] = 5*maxicr
-    #endfor
+    """estimate icr from ocr and tau, using at most niter iterations
+    (see calc_icr_array).  ocr too large to correct give icr=1/tau"""
+    icr, valid = calc_icr_array(ocr, tau, maxiter=niter)
     return icr
-#enddef
 
 
 class XSP3Data(object):
@@ -41,10 +33,84 @@ class XSP3Data(object):
         self.inputCounts  = np.zeros((npix, ndet), dtype='f8')
         # self.counts       = np.zeros((npix, ndet, nchan), dtype='f4')
 
+    def close(self):
+        "close the HDF5 file for lazily read counts"
+        if isinstance(getattr(self, 'counts', None), XSP3Counts):
+            self.counts.close()
+
+class XSP3Counts(object):
+    """lazy view of Xspress3 MCA counts (npix, ndet, nchan) in an
+    HDF5 file:  data is read, in its native dtype, when sliced or
+    converted to an array.  Pixels beyond those in the file are 0.
+    """
+    def __init__(self, h5file, dset, npix):
+        self.h5file = h5file
+        self.dset = dset
+        self.ndpix = min(npix, dset.shape[0])
+        self.shape = (npix, ) + dset.shape[1:]
+        self.dtype = dset.dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _read(self, lo, hi):
+        "read pixels lo:hi, zero-padded"
+        out = np.zeros((hi-lo, ) + self.shape[1:], dtype=self.dtype)
+        nread = min(hi, self.ndpix) - lo
+        if nread > 0:
+            self.dset.read_direct(out, source_sel=np.s_[lo:lo+nread],
+                                  dest_sel=np.s_[:nread])
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, )
+        if len(key) == 0 or key[0] is Ellipsis:
+            return self._read(0, self.shape[0])[key]
+        rows, rest = key[0], key[1:]
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(self.shape[0])
+            index = range(start, stop, step)
+            if len(index) == 0:
+                return self._read(0, 0)[(slice(None), ) + rest]
+            lo = min(index[0], index[-1])
+            hi = max(index[0], index[-1]) + 1
+            stop = stop - lo
+            if stop < 0:
+                stop = None
+            return self._read(lo, hi)[(slice(start-lo, stop, step), ) + rest]
+        if isinstance(rows, (int, np.integer)):
+            if rows < 0:
+                rows += self.shape[0]
+            return self._read(rows, rows+1)[(0, ) + rest]
+        return self._read(0, self.shape[0])[key]
+
+    def __array__(self, dtype=None):
+        out = self._read(0, self.shape[0])
+        if dtype is not None:
+            out = out.astype(dtype)
+        return out
+
+    def close(self):
+        "close the HDF5 file"
+        try:
+            self.h5file.close()
+        except:
+            pass
+
+XSP3_BLOCKSIZE = 2**24   # approximate size in bytes of blocks of pixels
+
 def read_xsp3_hdf5(fname, npixels=None, verbose=False,
-                   estimate_dtc=True, _larch=None):
-    # Reads a HDF5 file created with the DXP xMAP driver
-    # with the netCDF plugin buffers
+                   estimate_dtc=True, lazy=False, _larch=None):
+    """read Xspress3 HDF5 file
+
+    The MCA counts are read in blocks of pixels (aligned with the HDF5
+    chunks), in their native dtype, computing output counts as each
+    block is read.  With lazy=True, the counts are only read to compute
+    output counts, and out.counts is an XSP3Counts object that reads
+    the counts as needed: the file remains open until out.close().
+    """
     npixels = None
     clocktick = 12.5e-3
     t0 = time.time()
@@ -80,33 +146,51 @@ def read_xsp3_hdf5(fname, npixels=None, verbose=False,
     out = XSP3Data(npixels, ndet, nchan)
     out.numPixels = npixels
     t1 = time.time()
-    if ndpix < npix:
-        out.counts = np.zeros((npix, ndet, nchan), dtype='f8')
-        out.counts[:ndpix, :, :]  = counts[:]
+    if lazy:
+        out.counts = XSP3Counts(h5file, counts, npix)
+    elif ndpix < npix:
+        out.counts = np.zeros((npix, ndet, nchan), dtype=counts.dtype)
     else:
-        out.counts = counts[:]
+        out.counts = np.empty((ndpix, ndet, nchan), dtype=counts.dtype)
+
+    # read blocks of pixels, summing all but the end channels for
+    # output counts
+    ocounts = np.zeros((npix, ndet))
+    nblock = 1
+    if counts.chunks is not None:
+        nblock = counts.chunks[0]
+    step = nblock*max(1, int(XSP3_BLOCKSIZE/(nblock*ndet*nchan*counts.dtype.itemsize)))
+    for p0 in range(0, min(ndpix, npix), step):
+        p1 = min(ndpix, npix, p0+step)
+        if lazy:
+            block = counts[p0:p1]
+        else:
+            counts.read_direct(out.counts, source_sel=np.s_[p0:p1],
+                               dest_sel=np.s_[p0:p1])
+            block = out.counts[p0:p1]
+        ocounts[p0:p1] = block[:, :, 1:-1].sum(axis=2)
 
     if estimate_dtc:
         dtc_taus = XSPRESS3_TAUS
         if _larch is not None and _larch.symtable.has_symbol('_sys.gsecars.xspress3_taus'):
             dtc_taus = _larch.symtable._sys.gsecars.xspress3_taus
 
+    ocounts[np.where(ocounts<0.1)] = 0.1
     for i in range(ndet):
         rtime = clocktick * ndattr['CHAN%iSCA0' % (i+1)].value
         rtime[np.where(rtime<0.1)] = 0.1
         out.realTime[:, i] = rtime
         out.liveTime[:, i] = rtime
-        ocounts = out.counts[:, i, 1:-1].sum(axis=1)
-        ocounts[np.where(ocounts<0.1)] = 0.1
-        out.outputCounts[:, i] = ocounts
+        out.outputCounts[:, i] = ocounts[:, i]
         if estimate_dtc:
-            ocr = ocounts/(rtime*1.e-6)
-            icr = estimate_icr(ocr, dtc_taus[i], niter=3)
+            ocr = ocounts[:, i]/(rtime*1.e-6)
+            icr, valid = calc_icr_array(ocr, dtc_taus[i])
             out.inputCounts[:, i]  = icr * (rtime*1.e-6)
         else:
-            out.inputCounts[:, i]  = ocounts
+            out.inputCounts[:, i]  = ocounts[:, i]
 
-    h5file.close()
+    if not lazy:
+        h5file.close()
     t2 = time.time()
     if verbose:
         print('   time to read file    = %5.1f ms' % ((t1-t0)*1000))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+""" Tests of autobk background removal """
+import os
+import unittest
+import numpy as np
+from scipy.interpolate import splrep
+
+from utils import TestCase
+from larch import Group, Parameter, Minimizer
+
+DATADIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'examples', 'xafsdata')
+
+def read_xmu(fname):
+    "energy and mu from a 2-column xmu file in examples/xafsdata"
+    dat = np.loadtxt(os.path.join(DATADIR, fname))
+    return dat[:, 0], dat[:, 1]
+
+def reference_autobk(energy, mu, e0, edge_step, rbkg=1, kweight=1,
+                     nclamp=4, clamp_lo=1, clamp_hi=1, _larch=None):
+    """autobk fit with the original residual (splev, resampling with
+    UnivariateSpline, and FFT for each evaluation), and finite-difference
+    derivatives.  returns bkg, chi, chi_square"""
+    from larch_plugins.math import realimag
+    from larch_plugins.xafs import xftf_fast
+    from larch_plugins.xafs.autobk import (FMT_COEF, _autobk_grid,
+                                           spline_eval)
+    def resid(pars, ncoefs=1, knots=None, order=3, irbkg=1, kraw=None,
+              mu=None, kout=None, ftwin=1):
+        coefs = [getattr(pars, FMT_COEF % i) for i in range(ncoefs)]
+        bkg, chi = spline_eval(kraw, mu, knots, coefs, order, kout)
+        out = realimag(xftf_fast(chi*ftwin, nfft=2048)[:irbkg])
+        if nclamp == 0:
+            return out
+        scale = (1.0 + 100*(out*out).sum())/(len(out)*nclamp)
+        scaled_chik = scale * chi * kout**kweight
+        return np.concatenate((out,
+                               abs(clamp_lo)*scaled_chik[:nclamp],
+                               abs(clamp_hi)*scaled_chik[-nclamp:]))
+
+    grid = _autobk_grid(energy, e0, rbkg=rbkg, kweight=kweight)
+    ie0, iemax, kraw = grid.ie0, grid.iemax, grid.kraw
+    spl_y = []
+    for ik in grid.iknots:
+        i1 = min(len(kraw)-1, ik + 5)
+        i2 = max(0, ik - 5)
+        spl_y.append((2*mu[ik+ie0] + mu[i1+ie0] + mu[i2+ie0]) / 4.0)
+    knots, coefs, order = splrep(kraw[grid.iknots], spl_y)
+
+    params = Group()
+    for i in range(len(coefs)):
+        name = FMT_COEF % i
+        setattr(params, name, Parameter(coefs[i], name=name,
+                                        vary=i<len(spl_y)))
+    fit_kws = dict(ncoefs=len(coefs), knots=knots, order=order,
+                   irbkg=grid.irbkg, kraw=kraw[:iemax-ie0+1],
+                   mu=mu[ie0:iemax+1], kout=grid.kout, ftwin=grid.ftwin)
+    fit = Minimizer(resid, params, fcn_kws=fit_kws, toler=1.e-4,
+                    _larch=_larch)
+    fit.leastsq()
+    coefs = [getattr(params, FMT_COEF % i) for i in range(len(coefs))]
+    bkg, chi = spline_eval(fit_kws['kraw'], fit_kws['mu'], knots, coefs,
+                           order, grid.kout)
+    obkg = np.copy(mu)
+    obkg[ie0:ie0+len(bkg)] = bkg
+    return obkg, chi/edge_step, params.chi_square
+
+class TestAutobk(TestCase):
+    '''testing of autobk'''
+    def setUp(self):
+        TestCase.setUp(self)
+        self._larch = self.session._larch
+
+    def test_autobk_reference(self):
+        "autobk agrees with the original residual calculation"
+        from larch_plugins.xafs import autobk
+        energy, mu = read_xmu('cu_rt01.xmu')
+        out = Group()
+        autobk(energy, mu, group=out, rbkg=1.0, _larch=self._larch)
+        self.assertTrue(np.all(np.isfinite(out.chi)))
+
+        bkg, chi, chisqr = reference_autobk(energy, mu, out.e0,
+                                            out.edge_step, rbkg=1.0,
+                                            _larch=self._larch)
+        self.assertEqual(len(out.chi), len(chi))
+        self.assertTrue(np.allclose(out.bkg, bkg, rtol=0, atol=1.e-4))
+        self.assertTrue(np.allclose(out.chi, chi, rtol=0, atol=1.e-4))
+        self.assertTrue(out.autobk_details.chi_square < 1.001*chisqr)
+
+    def test_autobk_noclamp(self):
+        "autobk without clamps agrees with the original residual calculation"
+        from larch_plugins.xafs import autobk
+        energy, mu = read_xmu('fe2o3_rt1.xmu')
+        out = Group()
+        autobk(energy, mu, group=out, rbkg=1.0, nclamp=0, _larch=self._larch)
+
+        bkg, chi, chisqr = reference_autobk(energy, mu, out.e0,
+                                            out.edge_step, rbkg=1.0,
+                                            nclamp=0, _larch=self._larch)
+        # without clamps, the ends of the spline are poorly determined,
+        # so compare the fit quality more closely than chi(k) itself
+        self.assertTrue(np.allclose(out.chi, chi, rtol=0, atol=1.e-2))
+        self.assertAlmostEqual(out.autobk_details.chi_square/chisqr, 1.0,
+                               places=6)
+
+    def check_batch(self, nworkers=1, **kws):
+        """autobk_batch agrees with autobk on each spectrum, for three
+        Cu spectra on a shared energy grid"""
+        from larch_plugins.xafs import autobk, autobk_batch
+        energy, mu = read_xmu('cu_10k.xmu')
+        mus = [mu]
+        for fname in ('cu_50k.xmu', 'cu_150k.xmu'):
+            en, mu = read_xmu(fname)
+            mus.append(np.interp(energy, en, mu))
+        mus = np.array(mus)
+        batch = Group()
+        autobk_batch(energy, mus, group=batch, rbkg=1.0, nworkers=nworkers,
+                     _larch=self._larch, **kws)
+        self.assertEqual(batch.chi.shape[0], 3)
+        self.assertTrue(batch.autobk_details.converged.all())
+        for i in range(3):
+            out = Group()
+            autobk(energy, mus[i], group=out, rbkg=1.0, e0=batch.e0,
+                   edge_step=batch.edge_step[i], _larch=self._larch, **kws)
+            self.assertTrue(np.allclose(out.k, batch.k))
+            self.assertTrue(np.allclose(out.bkg, batch.bkg[i],
+                                        rtol=0, atol=1.e-3))
+            self.assertTrue(np.allclose(out.chi, batch.chi[i],
+                                        rtol=0, atol=5.e-4))
+
+    def test_batch(self):
+        "autobk_batch with clamps agrees with autobk"
+        self.check_batch()
+
+    def test_batch_clamp_hi(self):
+        "autobk_batch with a strong clamp agrees with autobk"
+        self.check_batch(clamp_hi=10, kweight=2, nworkers=2)
+
+    def test_batch_noclamp(self):
+        "autobk_batch without clamps agrees with autobk"
+        self.check_batch(nclamp=0)
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestAutobk,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
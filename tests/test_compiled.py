@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+""" Larch Tests Version 1 """
+import unittest
+import numpy as np
+
+from utils import TestCase
+
+class TestCompiled(TestCase):
+    '''testing of compiled execution mode'''
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.session._larch.symtable._sys.use_compiler = True
+
+    def test_for_loop(self):
+        "for loop with if/elif/else"
+        self.trytext("""
+total = 0
+out = []
+for i in range(100):
+    if i % 3 == 0:
+        total = total + i
+    elif i % 3 == 1:
+        total -= 1
+    else:
+        out.append(i)
+    endif
+endfor
+""")
+        self.NoExceptionRaised()
+        self.isValue('total', 1683 - 33)
+        self.isTrue('len(out) == 33')
+        self.isValue('i', 99)
+
+    def test_while_break(self):
+        "while loop with break"
+        self.trytext("""
+n = 0
+while n < 100:
+    n += 7
+    if n > 50:
+        break
+    endif
+endwhile
+""")
+        self.NoExceptionRaised()
+        self.isValue('n', 56)
+
+    def test_groups_and_arrays(self):
+        "group members and arrays"
+        self.trytext("""
+g = group(x=arange(10))
+g.y = g.x * 2.0
+g.y[3] = -1
+g.z = [j*2 for j in range(5) if j > 1]
+""")
+        self.NoExceptionRaised()
+        self.isValue('g.y', np.array([0, 2, 4, -1, 8, 10, 12, 14, 16, 18.]))
+        self.isValue('g.z', [4, 6, 8])
+        self.isNear('sum(g.y)', 83.0)
+
+    def test_procedure_call(self):
+        "procedures are interpreted, but can be called from compiled code"
+        self.trytext("""
+def fcn(x, scale=2):
+    return x*scale
+enddef
+a = 0
+for i in range(4):
+    a = a + fcn(i, scale=3)
+endfor
+""")
+        self.NoExceptionRaised()
+        self.isValue('a', 18)
+
+    def test_errors(self):
+        "errors stop compiled code"
+        out, err = self.trytext("""
+a = 1
+b = undefined_name + 2
+c = 3
+""")
+        self.ExceptionRaised()
+        errtype, errmsg = err[0].get_error()
+        self.assertTrue(errtype == 'NameError')
+        self.assertFalse(self.symtable.has_symbol('c'))
+
+    def test_procedure_errors(self):
+        "errors in procedures stop compiled code"
+        self.trytext("""
+def fcn(x):
+    return x/undefined_name
+enddef
+""")
+        out, err = self.trytext("""
+y = 1
+z = fcn(y)
+w = 2
+""")
+        self.ExceptionRaised()
+        self.assertFalse(self.symtable.has_symbol('w'))
+
+    def test_cache(self):
+        "compiled blocks are cached"
+        larch = self.session._larch
+        self.trytext("x = 1")
+        ncache = len(larch.compiled_blocks)
+        self.trytext("x = 1")
+        self.assertTrue(len(larch.compiled_blocks) == ncache)
+        self.trytext("x = 2")
+        self.assertTrue(len(larch.compiled_blocks) == ncache + 1)
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestCompiled,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=13).run(suite)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+""" Tests of feffit """
+import os
+import unittest
+import numpy as np
+
+from utils import TestCase
+from larch import Group, Parameter, Minimizer
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        '..', 'examples')
+FEFFDAT = os.path.join(EXAMPLES, 'feffit', 'feff0001.dat')
+VARS = ('amp', 'del_e0', 'dr_off', 'alpha', 'ss_10', 'ss_150')
+
+class TestFeffit(TestCase):
+    '''testing of feffit'''
+    def setUp(self):
+        TestCase.setUp(self)
+        self._larch = self.session._larch
+        from larch_plugins.xafs import autobk
+        self.data = []
+        for fname in ('cu_10k.xmu', 'cu_150k.xmu'):
+            dat = np.loadtxt(os.path.join(EXAMPLES, 'xafsdata', fname))
+            group = Group()
+            autobk(dat[:, 0], dat[:, 1], group=group, rbkg=1.0, kweight=2,
+                   _larch=self._larch)
+            self.data.append(group)
+
+    def make_fit(self, bounded=False):
+        """parameters and datasets for a fit of the first Cu shell at two
+        temperatures, sharing amp, e0 and deltar.  With bounded=True,
+        amp has lower and upper bounds and the sigma2 values lower bounds"""
+        from larch_plugins.xafs.feffdat import feffpath
+        from larch_plugins.xafs.feffit import feffit_transform, feffit_dataset
+        _larch = self._larch
+        amp_min, amp_max, ss_min = None, None, None
+        if bounded:
+            amp_min, amp_max, ss_min = 0.5, 1.5, 0.0005
+        pars = Group(amp=Parameter(1, min=amp_min, max=amp_max, vary=True,
+                                   _larch=_larch),
+                     del_e0=Parameter(2.0, vary=True, _larch=_larch),
+                     dr_off=Parameter(0, vary=True, _larch=_larch),
+                     alpha=Parameter(0, vary=True, _larch=_larch),
+                     ss_10=Parameter(0.003, min=ss_min, vary=True,
+                                     _larch=_larch),
+                     ss_150=Parameter(0.006, min=ss_min, vary=True,
+                                      _larch=_larch))
+        trans = feffit_transform(kmin=3, kmax=17, kw=2, dk=4,
+                                 window='kaiser', rmin=1.4, rmax=3.4,
+                                 _larch=_larch)
+        dsets = []
+        for dat, ss, dr in ((self.data[0], 'ss_10', 'dr_off + alpha*reff'),
+                            (self.data[1], 'ss_150', 'dr_off - alpha*reff')):
+            path = feffpath(FEFFDAT, s02='amp', e0='del_e0', deltar=dr,
+                            sigma2=ss, _larch=_larch)
+            dsets.append(feffit_dataset(data=dat, pathlist=[path],
+                                        transform=trans, _larch=_larch))
+        return pars, dsets
+
+    def test_nworkers(self):
+        "fit with worker threads gives the same result as the serial fit"
+        from larch_plugins.xafs import feffit
+        pars1, dsets1 = self.make_fit(bounded=True)
+        feffit(pars1, dsets1, _larch=self._larch)
+        pars2, dsets2 = self.make_fit(bounded=True)
+        feffit(pars2, dsets2, nworkers=2, _larch=self._larch)
+
+        self.assertEqual(len(self._larch.error), 0)
+        self.assertAlmostEqual(pars1.chi_square, pars2.chi_square, places=8)
+        for name in VARS:
+            par1, par2 = getattr(pars1, name), getattr(pars2, name)
+            self.assertAlmostEqual(par1.value, par2.value, places=10)
+            self.assertAlmostEqual(par1.stderr, par2.stderr, places=10)
+        for ds1, ds2 in zip(dsets1, dsets2):
+            self.assertTrue(np.allclose(ds1.model.chi, ds2.model.chi,
+                                        rtol=0, atol=1.e-12))
+
+    def check_jacobian(self, bounded=False):
+        """compare the analytic Jacobian of the feffit residual, as seen by
+        leastsq (in the internal, bounds-transformed variables), with
+        central finite differences"""
+        pars, dsets = self.make_fit(bounded=bounded)
+        def resid(params, datasets=None):
+            return np.concatenate([d._residual(params) for d in datasets])
+        def jacob(params, datasets=None):
+            return np.concatenate([d._jacobian(params, fit.var_names)
+                                   for d in datasets])
+        fit = Minimizer(resid, pars, fcn_kws=dict(datasets=dsets),
+                        jacfcn=jacob, _larch=self._larch)
+        fvars = np.array(fit.vars, dtype='float64')
+        jac = fit._Minimizer__jacobian(fvars)
+
+        fdjac = np.zeros(jac.shape)
+        for i in range(len(fvars)):
+            step = 1.e-5 * max(abs(fvars[i]), 1.e-3)
+            xhi, xlo = fvars.copy(), fvars.copy()
+            xhi[i] += step
+            xlo[i] -= step
+            fdjac[:, i] = (fit._Minimizer__residual(xhi) -
+                           fit._Minimizer__residual(xlo)) / (2*step)
+        self.assertEqual(jac.shape, (len(resid(pars, dsets)), len(VARS)))
+        for i in range(len(fvars)):
+            scale = abs(fdjac[:, i]).max()
+            self.assertTrue(scale > 0)
+            self.assertTrue(np.allclose(jac[:, i], fdjac[:, i], rtol=0,
+                                        atol=1.e-4*scale))
+
+    def test_jacobian(self):
+        "analytic Jacobian matches finite differences"
+        self.check_jacobian(bounded=False)
+
+    def test_jacobian_bounded(self):
+        "analytic Jacobian matches finite differences with bounded parameters"
+        self.check_jacobian(bounded=True)
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestFeffit,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
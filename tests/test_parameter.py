@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+""" Tests of Parameter constraint expressions """
+import unittest
+import numpy as np
+
+from utils import TestCase
+from larch import Parameter
+
+class TestParameterExpr(TestCase):
+    '''testing of compiled Parameter constraint expressions'''
+    def setUp(self):
+        TestCase.setUp(self)
+        self._larch = self.session._larch
+        self.symtable.set_symbol('a', Parameter(-2.0, vary=True,
+                                                _larch=self._larch))
+        self.symtable.set_symbol('width', 1.0)
+        self.symtable.set_symbol('gauss', np.random.normal)
+
+    def constraint(self, expr):
+        par = Parameter(expr=expr, _larch=self._larch)
+        par.value
+        self.assertTrue(par._compiled is not None)
+        return par
+
+    def test_pure_cached(self):
+        "results of expressions of pure functions are kept"
+        for expr in ('abs(a)', 'max(a, width)', 'sqrt(width) + sin(a)'):
+            par = self.constraint(expr)
+            self.assertTrue(par._compiled._inputs is not None)
+        self.assertAlmostEqual(par.value, 1 + np.sin(-2.0))
+        self.symtable.a.value = 1.0
+        self.assertAlmostEqual(par.value, 1 + np.sin(1.0))
+
+    def test_random_not_cached(self):
+        "expressions calling non-deterministic builtins are re-evaluated"
+        par = self.constraint('gauss(a, width)')
+        self.assertTrue(par._compiled._inputs is None)
+        values = set([par.value for i in range(5)])
+        self.assertTrue(len(values) > 1)
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestParameterExpr,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+""" Tests of symbol lookup in the symbol table """
+import unittest
+import numpy as np
+
+from utils import TestCase
+
+class TestSymbolLookup(TestCase):
+    '''testing of symbol lookup and its cache'''
+    def setUp(self):
+        TestCase.setUp(self)
+        self._larch = self.session._larch
+
+    def lookup(self, name):
+        "evaluate a name, as a Larch statement"
+        out = self._larch.eval(name)
+        self.assertEqual(len(self._larch.error), 0)
+        return out
+
+    def test_import_shadows(self):
+        "a name bound by import hides a name found earlier"
+        self.assertTrue(self.lookup('sin') is np.sin)
+        self._larch.eval('from numpy import cos as sin')
+        self.assertTrue(self.lookup('sin') is np.cos)
+        self._larch.eval('del sin')
+        self.assertTrue(self.lookup('sin') is np.sin)
+
+    def test_attribute_shadows(self):
+        "a name bound by attribute assignment hides a name found earlier"
+        self.assertTrue(self.lookup('sin') is np.sin)
+        self._larch.eval('_main.sin = cos')
+        self.assertTrue(self.lookup('sin') is np.cos)
+
+    def test_python_setattr_shadows(self):
+        "a name bound with setattr() from Python hides a name found earlier"
+        self.assertTrue(self.lookup('cos') is np.cos)
+        setattr(self.symtable, 'cos', np.tan)
+        self.assertTrue(self.lookup('cos') is np.tan)
+        delattr(self.symtable, 'cos')
+        self.assertTrue(self.lookup('cos') is np.cos)
+
+    def test_cache_hits(self):
+        "repeated lookups of unchanged names are served from the cache"
+        self.lookup('sin(pi)*cos(pi)')
+        self.symtable.get_lookup_stats(reset=True)
+        for i in range(10):
+            self.lookup('sin(pi)*cos(pi)')
+        stats = self.symtable.get_lookup_stats()
+        self.assertEqual(stats['misses'], 0)
+        self.assertEqual(stats['hits'], 40)
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestSymbolLookup,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+""" Tests of the X-ray database and its in-memory cache """
+import os
+import unittest
+import numpy as np
+
+from utils import TestCase
+
+ELEMENTS = ('O', 'Fe', 26, 'Ag', 'Pb')
+# energies away from absorption edges of ELEMENTS
+ENERGIES = np.array([1800., 5000.5, 9000., 20000., 50000., 120000.])
+
+class TestElamSpline(TestCase):
+    '''testing of Elam spline interpolation'''
+    def setUp(self):
+        TestCase.setUp(self)
+        self._larch = self.session._larch
+        import larch_plugins.xray.xraydb
+        self.xraydb = larch_plugins.xray.xraydb
+
+    def test_natural_spline(self):
+        "values inside the table are those of a natural cubic spline"
+        from scipy.interpolate import CubicSpline
+        xin = np.log(np.array([1.e3, 1.5e3, 2.2e3, 4.e3, 7.e3, 1.e4, 3.e4]))
+        yin = np.sin(xin) + 0.1*xin**2
+        spline = CubicSpline(xin, yin, bc_type='natural')
+        yspl = spline(xin, 2)
+        x = np.linspace(xin[0], xin[-1], 41)
+        out = self.xraydb.elam_spline(xin, yin, yspl, x)
+        self.assertTrue(np.allclose(out, spline(x), rtol=1.e-12))
+        weights = self.xraydb.elam_spline_weights(xin, x)
+        self.assertTrue(np.allclose(self.xraydb.elam_spline(xin, yin, yspl, None,
+                                                            weights=weights),
+                                    out, rtol=1.e-14))
+
+    def test_end_points(self):
+        "table end points and values outside the table give the end values"
+        xin = np.array([1.0, 2.0, 4.0, 5.0])
+        yin = np.array([3.0, 1.0, 2.0, 7.0])
+        yspl = np.array([0.0, 1.5, -2.0, 0.0])
+        x = np.array([-1.0, 0.0, 1.0, 5.0, 9.0])
+        out = self.xraydb.elam_spline(xin, yin, yspl, x)
+        self.assertTrue(np.allclose(out, [3.0, 3.0, 3.0, 7.0, 7.0]))
+        self.assertAlmostEqual(self.xraydb.elam_spline(xin, yin, yspl, 5.0)[0], 7.0)
+
+        # inside the table, points are bracketed by the last table point
+        # below and the first above, as by the earlier per-point search
+        x = np.array([1.5, 2.0, 2.5, 4.0, 4.99])
+        lo = np.array([np.flatnonzero(xin < e)[-1] for e in x])
+        hi = np.array([np.flatnonzero(xin > e)[0] for e in x])
+        diff = xin[hi] - xin[lo]
+        a, b = (xin[hi] - x)/diff, (x - xin[lo])/diff
+        ref = (a*yin[lo] + b*yin[hi] + (diff*diff/6)*((a*a - 1)*a*yspl[lo] +
+                                                      (b*b - 1)*b*yspl[hi]))
+        self.assertTrue(np.allclose(self.xraydb.elam_spline(xin, yin, yspl, x),
+                                    ref, rtol=1.e-14))
+
+class TestXrayDB(TestCase):
+    '''testing of X-ray database lookups, with and without a cache'''
+    def setUp(self):
+        TestCase.setUp(self)
+        self._larch = self.session._larch
+        import larch_plugins.xray.xraydb
+        self.xraydb = larch_plugins.xray.xraydb
+        dbname = os.path.join(os.path.dirname(self.xraydb.__file__),
+                              'xrayref.db')
+        if not os.path.exists(dbname):
+            self.skipTest('X-ray database %s not found' % dbname)
+        self.xdb = self.xraydb.xrayDB(dbname)
+        self.cdb = self.xraydb.xrayDB(dbname, cache=True)
+
+    def assertSame(self, val1, val2):
+        "values from two databases are the same"
+        if isinstance(val1, dict):
+            self.assertEqual(sorted(val1.keys()), sorted(val2.keys()))
+            for key in val1:
+                self.assertSame(val1[key], val2[key])
+        elif isinstance(val1, (list, tuple)):
+            self.assertEqual(len(val1), len(val2))
+            for v1, v2 in zip(val1, val2):
+                self.assertSame(v1, v2)
+        elif isinstance(val1, (float, np.ndarray)):
+            self.assertTrue(np.allclose(val1, val2, rtol=1.e-14))
+        else:
+            self.assertEqual(val1, val2)
+
+    def test_cached_lookups(self):
+        "lookups with the in-memory cache match those from the database"
+        xdb, cdb = self.xdb, self.cdb
+        info = cdb.cache_info()
+        self.assertTrue(info['nbytes'] > 0 and info['load_time'] > 0)
+        self.assertTrue(xdb.cache_info() is None)
+        q = np.linspace(0, 2, 11)
+        self.assertSame(xdb.f0_ions(), cdb.f0_ions())
+        for elem in ELEMENTS:
+            sym = elem if not isinstance(elem, int) else xdb.symbol(elem)
+            for method in ('zofsym', 'molar_mass', 'density', 'xray_edges',
+                           'xray_lines', 'f0_ions', 'chantler_energies'):
+                self.assertSame(getattr(xdb, method)(elem),
+                                getattr(cdb, method)(elem))
+            self.assertSame(xdb.f0(sym, q), cdb.f0(sym, q))
+            self.assertSame(xdb.xray_lines(elem, initial_level='K'),
+                            cdb.xray_lines(elem, initial_level='K'))
+            self.assertSame(xdb.xray_lines(elem, excitation_energy=12000),
+                            cdb.xray_lines(elem, excitation_energy=12000))
+            for initial, final in (('L1', 'L3'), ('L2', 'L3'), ('K', 'L1')):
+                for total in (True, False):
+                    self.assertSame(xdb.CK_probability(elem, initial, final,
+                                                       total=total),
+                                    cdb.CK_probability(elem, initial, final,
+                                                       total=total))
+            self.assertSame(xdb.corehole_width(elem),
+                            cdb.corehole_width(elem))
+            self.assertSame(xdb.corehole_width(elem, 'K'),
+                            cdb.corehole_width(elem, 'K'))
+            for method in ('f1_chantler', 'f2_chantler', 'mu_chantler',
+                           'mu_elam', 'coherent_cross_section_elam',
+                           'incoherent_cross_section_elam'):
+                self.assertSame(getattr(xdb, method)(elem, ENERGIES),
+                                getattr(cdb, method)(elem, ENERGIES))
+            self.assertSame(xdb.mu_elam(elem, ENERGIES, kind='photo'),
+                            cdb.mu_elam(elem, ENERGIES, kind='photo'))
+        self.assertSame(xdb.f0(26, q), cdb.f0(26, q))
+        self.assertSame(xdb.corehole_width(edge='K'),
+                        cdb.corehole_width(edge='K'))
+        self.assertSame(xdb.corehole_width(), cdb.corehole_width())
+        self.assertTrue(cdb.f0('Xx', q) is None)
+        self.assertTrue(cdb.f1_chantler('Xx', ENERGIES) is None)
+
+    def test_chantler_interp(self):
+        "Chantler values have the shape of the energies and match the tables"
+        xdb = self.cdb
+        energy = np.linspace(8000, 11000, 6)
+        for column in ('f1', 'f2', 'mu', 'mu_photo', 'mu_incoh'):
+            flat = xdb.chantler_interp('Fe', energy, column=column)
+            self.assertEqual(flat.shape, (6,))
+            out = xdb.chantler_interp('Fe', energy.reshape((2, 3)),
+                                      column=column)
+            self.assertEqual(out.shape, (2, 3))
+            self.assertTrue(np.allclose(out.ravel(), flat, rtol=1.e-12))
+        self.assertTrue(np.isscalar(xdb.f1_chantler('Fe', 9000.0)))
+        # values at table energies are the tabulated values
+        te, f1, f2 = xdb._getChantlerData('Fe', ('energy', 'f1', 'f2'))
+        sel = np.where((te > 10000) & (te < 20000))[0]
+        self.assertTrue(np.allclose(xdb.chantler_interp('Fe', te[sel], 'f2'),
+                                    f2[sel], rtol=1.e-10))
+        self.assertTrue(np.allclose(xdb.chantler_interp('Fe', te[sel], 'f1'),
+                                    f1[sel], rtol=1.e-8))
+
+    def test_chantler_lru(self):
+        "the least recently used Chantler interpolants are dropped"
+        xdb = self.xdb
+        ref = dict([(elem, xdb.f2_chantler(elem, ENERGIES))
+                    for elem in ('Fe', 'Cu', 'Zn')])
+        nkeep = self.xraydb.CHANTLER_CACHE
+        try:
+            self.xraydb.CHANTLER_CACHE = 3
+            xdb._chantler_interps.clear()
+            for elem in ('Fe', 'Cu'):
+                xdb.f2_chantler(elem, ENERGIES)
+            self.assertEqual(list(xdb._chantler_interps.keys()),
+                             [('Fe', 'f2'), ('Cu', 'energy'), ('Cu', 'f2')])
+            # a hit moves an item to the end
+            xdb.f2_chantler('Cu', ENERGIES)
+            self.assertEqual(list(xdb._chantler_interps.keys()),
+                             [('Fe', 'f2'), ('Cu', 'energy'), ('Cu', 'f2')])
+            for elem in ('Zn', 'Fe', 'Cu', 'Zn'):
+                self.assertTrue(np.allclose(xdb.f2_chantler(elem, ENERGIES),
+                                            ref[elem], rtol=1.e-14))
+                self.assertTrue(len(xdb._chantler_interps) <= 3)
+            self.assertEqual(list(xdb._chantler_interps.keys())[-1],
+                             ('Zn', 'f2'))
+        finally:
+            self.xraydb.CHANTLER_CACHE = nkeep
+
+    def test_material_mu(self):
+        "compiled Material mu is the sum of mu_elam for its elements"
+        from larch_plugins.xray.materials import Material
+        from larch_plugins.xray import chemparse
+        energy = np.array([[2000., 7100., 7125.], [10000., 30000., 90000.]])
+        for formula, density in (('H2O', 1.0), ('Fe2O3', 5.24),
+                                 ('PbSO4', 6.29)):
+            for kind in ('total', 'photo'):
+                mat = Material(formula, density, kind=kind,
+                               _larch=self._larch)
+                mass, mu = 0.0, 0.0
+                for elem, frac in chemparse(formula).items():
+                    emass = frac*self.xdb.molar_mass(elem)
+                    mass += emass
+                    mu = mu + emass*self.xdb.mu_elam(elem, energy.ravel(),
+                                                     kind=kind)
+                ref = density*mu.reshape(energy.shape)/mass
+                out = mat.mu(energy)
+                self.assertEqual(out.shape, energy.shape)
+                self.assertTrue(np.allclose(out, ref, rtol=1.e-10))
+                # repeated calls return the same values, scalars a float
+                self.assertTrue(np.allclose(mat.mu(energy), ref, rtol=1.e-10))
+                self.assertAlmostEqual(mat.mu(10000.0)/ref[1, 0], 1.0,
+                                       places=10)
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestElamSpline, TestXrayDB):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
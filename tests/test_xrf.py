@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+""" Tests of XRF deadtime correction and background fitting """
+import unittest
+import numpy as np
+
+from utils import TestCase
+
+def ref_background(spec, slope, width=4, exponent=2, tangent=False,
+                   ampl=100., huge=1.e20, tiny=1.e-20, max_tangent=2):
+    """background of one spectrum, fitting the power functions one
+    channel at a time, as the original XRFBackground.calc()"""
+    nchans = len(spec)
+    bckgnd = np.arange(nchans, dtype=float) - huge
+    denom = max(tiny, (width / (2. * slope)**exponent))
+    indices = np.arange(nchans*2+1, dtype=float) - nchans
+    with np.errstate(invalid='ignore'):
+        power_funct = indices**exponent * (ampl / denom)
+        power_funct = np.compress((power_funct <= max(spec)), power_funct)
+    max_index = len(power_funct)//2 - 1
+    for chan in range(nchans-1):
+        tan_slope = 0.
+        if tangent:
+            chan0 = max((chan - max_tangent), 0)
+            chan1 = min((chan + max_tangent), (nchans-1))
+            tan_slope = (spec[chan] - spec[chan0:chan1+1]) / max(chan, 1)
+            tan_slope = np.sum(tan_slope) / (chan1 - chan0)
+        chan0 = max((chan - max_index), 0)
+        chan1 = min((chan + max_index), (nchans-1))
+        chan1 = max(chan1, chan0)
+        nc = chan1 - chan0 + 1
+        lin_offset = spec[chan] + (np.arange(float(nc)) - nc//2) * tan_slope
+        f = chan0 - chan + max_index
+        l = chan1 - chan + max_index
+        height = min(spec[chan0:chan1+1] - lin_offset + power_funct[f:l+1])
+        test = height + lin_offset - power_funct[f:l+1]
+        bckgnd[chan0:chan1+1] = np.maximum(bckgnd[chan0:chan1+1], test)
+    return bckgnd
+
+def xrf_spectra(nspec, nchans, seed=0):
+    """XRF-like spectra (nspec+2, nchans): Poisson counts of peaks of very
+    different heights on a sloping background, a flat spectrum and one
+    with a spike down to 0"""
+    rng = np.random.RandomState(seed)
+    chan = np.arange(nchans)
+    out = []
+    for i in range(nspec):
+        scale = 10**rng.uniform(1, 5)
+        spec = 1.5 - chan/(1.0*nchans)
+        for j in range(4):
+            cen, sig = rng.uniform(0, nchans), rng.uniform(1, 6)
+            spec = spec + rng.uniform(0.1, 20)*np.exp(-(chan-cen)**2/(2*sig**2))
+        out.append(rng.poisson(scale*spec))
+    out.append(7.0*np.ones(nchans))
+    out.append(np.where(chan == nchans//3, 0.0, 500.0))
+    return np.array(out, dtype=float)
+
+class TestDeadtime(TestCase):
+    '''testing of deadtime corrections'''
+    def setUp(self):
+        TestCase.setUp(self)
+        self._larch = self.session._larch
+        import larch_plugins.xrf.deadtime
+        self.deadtime = larch_plugins.xrf.deadtime
+
+    def test_icr_roundtrip(self):
+        "icr from ocr = icr*exp(-icr*tau), up to the top of the curve"
+        tau = np.array([1.e-7, 2.e-6, 5.e-5])[:, np.newaxis]
+        icr = np.linspace(0, 1, 101)[np.newaxis, :]/tau
+        icr[:, -1] = 1.0/tau[:, 0]
+        ocr = icr*np.exp(-icr*tau)
+        for lambertw in (False, True):
+            out, valid = self.deadtime.calc_icr_array(ocr, tau,
+                                                      lambertw=lambertw)
+            self.assertEqual(out.shape, icr.shape)
+            self.assertTrue(valid.all())
+            self.assertTrue(np.allclose(out, icr, rtol=1.e-6, atol=0))
+        # a scalar tau broadcasts, and scalars give 0-d arrays
+        out, valid = self.deadtime.calc_icr_array(ocr[1], 2.e-6)
+        self.assertTrue(np.allclose(out, icr[1], rtol=1.e-6, atol=0))
+        out, valid = self.deadtime.calc_icr_array(ocr[1, 30], 2.e-6)
+        self.assertEqual(out.shape, ())
+        self.assertAlmostEqual(self.deadtime.calc_icr(ocr[1, 30], 2.e-6)/icr[1, 30],
+                               1.0, places=8)
+
+    def test_icr_edges(self):
+        "icr for no deadtime, negative, zero and uncorrectable ocr"
+        tau = 1.e-5
+        max_ocr = np.exp(-1)/tau
+        ocr = np.array([1.e4, -5.0, 0.0, 1.01*max_ocr, 10*max_ocr, np.nan])
+        for lambertw in (False, True):
+            icr, valid = self.deadtime.calc_icr_array(ocr, tau,
+                                                      lambertw=lambertw)
+            self.assertEqual(list(valid), [True, False, True, False, False,
+                                           False])
+            self.assertAlmostEqual(icr[0]*np.exp(-icr[0]*tau)/1.e4, 1.0,
+                                   places=8)
+            # uncorrectable points are given the top of the curve
+            self.assertEqual(list(icr[1:5]), [0, 0, 1/tau, 1/tau])
+
+            # tau = 0: icr = ocr, negative ocr is still not valid
+            icr, valid = self.deadtime.calc_icr_array(ocr[:3], 0.0,
+                                                      lambertw=lambertw)
+            self.assertEqual(list(icr), [1.e4, 0, 0])
+            self.assertEqual(list(valid), [True, False, True])
+        self.assertTrue(self.deadtime.calc_icr(1.01*max_ocr, tau) is None)
+        self.assertEqual(self.deadtime.calc_icr(1.e4, 0), 1.e4)
+
+class TestXRFBackground(TestCase):
+    '''testing of XRF background fitting'''
+    def setUp(self):
+        TestCase.setUp(self)
+        self._larch = self.session._larch
+        import larch_plugins.xrf.xrf_bgr
+        self.xrf_bgr = larch_plugins.xrf.xrf_bgr
+
+    def test_fit_power_functions(self):
+        "background of many spectra at once matches the per-channel fit"
+        spectra = [xrf_spectra(12, 160), xrf_spectra(10, 128, seed=3)]
+        # the loops over offsets stop early (PRUNE_STEP) at offsets
+        # depending on the spectra and widths
+        for ispec, width, exponent, tangent in ((0, 4, 2, False),
+                                                (0, 0.05, 2, False),
+                                                (1, 0.1, 2, False),
+                                                (1, 4, 2, False),
+                                                (0, 4, 4, False),
+                                                (0, 4, 3, False),
+                                                (0, 4, 2.5, False),
+                                                (0, 4, 2, True),
+                                                (1, 0.5, 4, True)):
+            bgr = self.xrf_bgr._fit_power_functions(spectra[ispec], 0.01,
+                                                    width=width,
+                                                    exponent=exponent,
+                                                    tangent=tangent)
+            self.assertEqual(bgr.shape, spectra[ispec].shape)
+            for spec, out in zip(spectra[ispec], bgr):
+                ref = ref_background(spec, 0.01, width=width,
+                                     exponent=exponent, tangent=tangent)
+                self.assertTrue(np.allclose(out, ref, rtol=1.e-10, atol=1.e-8),
+                                (width, exponent, tangent))
+
+    def test_map_spectra(self):
+        "background of (nrows, npts, nchans) spectra, fitted in blocks"
+        spectra = xrf_spectra(10, 256, seed=3).reshape((3, 4, 256))
+        blocksize = self.xrf_bgr.BLOCKSIZE
+        try:
+            self.xrf_bgr.BLOCKSIZE = 5
+            bgr = self.xrf_bgr.XRFBackground(spectra, slope=0.01).bgr
+        finally:
+            self.xrf_bgr.BLOCKSIZE = blocksize
+        self.assertEqual(bgr.shape, spectra.shape)
+        for irow in range(3):
+            for ipt in range(4):
+                one = self.xrf_bgr.XRFBackground(spectra[irow, ipt], slope=0.01)
+                self.assertTrue(np.all(bgr[irow, ipt] == one.bgr))
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestDeadtime, TestXRFBackground):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+""" Tests of XRF map files, row handling and folder watching """
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from utils import TestCase
+
+NMCA, NCHAN, NSIS = 2, 64, 3
+# [left, right) channel limits of ROIs, for each detector
+ROI_LIMITS = [[[10, 20], [11, 21]],
+              [[30, 45], [30, 44]],
+              [[0, 64], [0, 64]]]
+
+def write_raw_row(folder, irow, npts, scale=50.0, rtime=1.e-3, seed=0):
+    """write raw data files for a row of a map, as Xspress3 HDF5 MCA data
+    (Poisson counts of two peaks), struck scaler and XPS position files.
+    returns the names of the xrf, xps and struck files"""
+    import h5py
+    rng = np.random.RandomState(seed + irow)
+    chan = np.arange(NCHAN)
+    spec = 1 + np.exp(-(chan-15)**2/8.0) + 0.5*np.exp(-(chan-37)**2/18.0)
+    amp = rng.uniform(0.5, 2, size=(npts, NMCA, 1))
+    counts = rng.poisson(scale*amp*spec).astype('uint32')
+    xrffile = 'xsp3.%4.4i' % (irow+1)
+    with h5py.File(os.path.join(folder, xrffile), 'w') as h5:
+        h5['entry/instrument/detector/data'] = counts
+        attrs = 'entry/instrument/detector/NDAttributes/CHAN%iSCA0'
+        for idet in range(NMCA):
+            h5[attrs % (idet+1)] = np.full(npts, rtime*1.e6/12.5e-3)
+
+    xpsfile = 'xps.%4.4i' % (irow+1)
+    with open(os.path.join(folder, xpsfile), 'w') as fh:
+        fh.write('# gathering\n')
+        for ipt in range(npts+1):
+            fh.write('%.4f %.4f\n' % (0.01*ipt, 0.1*irow))
+
+    sisfile = 'struck.%4.4i' % (irow+1)
+    names = ' | '.join(['I%i' % i for i in range(NSIS)])
+    with open(os.path.join(folder, sisfile), 'w') as fh:
+        fh.write('# scalers\n# %s\n# %s\n' % (names, names))
+        for ipt in range(npts):
+            fh.write(' '.join(['%i' % rng.randint(10000, 20000)
+                               for i in range(NSIS)]) + '\n')
+    return xrffile, xpsfile, sisfile
+
+def bin_sums(data, factor):
+    "sum map data (nrows, npts, ...) over bins of factor x factor pixels"
+    nrows, npts = data.shape[:2]
+    out = np.zeros(((nrows+factor-1)//factor, (npts+factor-1)//factor)
+                   + data.shape[2:])
+    for i in range(out.shape[0]):
+        for j in range(out.shape[1]):
+            out[i, j] = data[i*factor:(i+1)*factor,
+                             j*factor:(j+1)*factor].sum(axis=(0, 1))
+    return out
+
+class TestXRMMap(TestCase):
+    '''testing of xrmmap helpers'''
+    def setUp(self):
+        TestCase.setUp(self)
+        self._larch = self.session._larch
+        import larch_plugins.xrmmap.xrm_mapfile
+        self.mapfile = larch_plugins.xrmmap.xrm_mapfile
+
+    def test_xvals(self):
+        "pixel x positions from npts+1 gathered boundary positions"
+        xpos = 10.0 + 0.5*np.arange(6)
+        xvals = self.mapfile.pixel_xvals(xpos, 5)
+        self.assertEqual(len(xvals), 5)
+        self.assertTrue(np.allclose(xvals, 10.25 + 0.5*np.arange(5)))
+        # extra gathered positions are ignored
+        xvals = self.mapfile.pixel_xvals(xpos, 3)
+        self.assertTrue(np.allclose(xvals, [10.25, 10.75, 11.25]))
+
+    def test_xvals_npts(self):
+        "pixel x positions when there are only npts gathered positions"
+        xpos = 10.0 + 0.5*np.arange(5)
+        xvals = self.mapfile.pixel_xvals(xpos, 5)
+        self.assertEqual(len(xvals), 5)
+        self.assertTrue(np.allclose(xvals, 10.25 + 0.5*np.arange(5)))
+        # a reversed (serpentine) row steps the other way
+        xvals = self.mapfile.pixel_xvals(xpos[::-1], 5)
+        self.assertTrue(np.allclose(xvals, 11.75 - 0.5*np.arange(5)))
+        self.assertTrue(np.allclose(self.mapfile.pixel_xvals([3.0], 1), [3.0]))
+
+    def test_roi_integrate(self):
+        "ROI sums from cumulative sums equal direct sums over channels"
+        rng = np.random.RandomState(1)
+        counts = rng.poisson(20.0, size=(NMCA, 7, NCHAN)).astype('uint32')
+        limits = ROI_LIMITS + [[[5, 5], [70, 80]], [[-3, 2], [60, 90]]]
+        for dat in (counts, counts*1.5):
+            sums = self.mapfile.roi_integrate(dat, limits)
+            self.assertEqual(sums.shape, (NMCA, 7, len(limits)))
+            for iroi, lims in enumerate(limits):
+                for idet, (lo, hi) in enumerate(lims):
+                    lo, hi = max(lo, 0), min(hi, NCHAN)
+                    self.assertTrue(np.allclose(sums[idet, :, iroi],
+                                                dat[idet, :, lo:hi].sum(axis=1)))
+        # into given output and work arrays
+        out = np.zeros((NMCA, 7, len(limits)))
+        work = np.zeros((NMCA, 7, NCHAN+1), dtype=np.int64)
+        sums = self.mapfile.roi_integrate(counts, limits, out=out, work=work)
+        self.assertTrue(sums is out)
+        self.assertTrue(np.allclose(out, self.mapfile.roi_integrate(counts,
+                                                                    limits)))
+
+    def test_folderwatch(self):
+        "files are complete only when unchanged across two observations"
+        from larch_plugins.xrmmap import MapFolderWatcher
+        folder = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(folder, 'xmap.001')
+            with open(fname, 'w') as fh:
+                fh.write('data')
+            # an old modification time (or a skewed file server clock)
+            # does not make a file complete when first seen
+            os.utime(fname, (time.time()-3600, time.time()-3600))
+            watcher = MapFolderWatcher(folder, settle=0.05, use_inotify=False)
+            self.assertFalse(watcher.is_complete('xmap.001'))
+            time.sleep(0.1)
+            self.assertTrue(watcher.is_complete('xmap.001'))
+            # a change restarts the settle time
+            with open(fname, 'a') as fh:
+                fh.write('more data')
+            self.assertFalse(watcher.is_complete('xmap.001'))
+            time.sleep(0.1)
+            self.assertTrue(watcher.all_complete(['xmap.001', '']))
+            # missing and empty files are never complete
+            open(os.path.join(folder, 'empty.001'), 'w').close()
+            time.sleep(0.1)
+            self.assertFalse(watcher.all_complete(['xmap.001', 'empty.001']))
+            self.assertFalse(watcher.is_complete('missing.001'))
+            watcher.close()
+        finally:
+            shutil.rmtree(folder)
+
+class TestXRMMapFile(TestCase):
+    '''testing of XRF map files built from synthetic rows'''
+    def setUp(self):
+        TestCase.setUp(self)
+        self._larch = self.session._larch
+        self.folder = tempfile.mkdtemp()
+        self.maps = []
+
+    def tearDown(self):
+        for xmap in self.maps:
+            if xmap.h5root is not None:
+                xmap.h5root.close()
+        shutil.rmtree(self.folder)
+
+    def make_map(self, nrows=6, npts=20, storage=None, nlevels=None, **kws):
+        """write a map file of nrows rows of synthetic raw data, read with
+        GSEXRM_MapRow and added with add_rowdata(), building nlevels
+        pyramid levels before the rows are added if nlevels is given.
+        returns the GSEXRM_MapFile and the list of rows"""
+        from larch_plugins.xrmmap import GSEXRM_MapFile, get_storage_policy
+        from larch_plugins.xrmmap.xrm_mapfile import (create_xrmmap,
+                                                      GSEXRM_MapRow)
+        fname = os.path.join(self.folder, 'map%i.h5' % len(self.maps))
+        h5root = get_storage_policy(storage).open(fname, 'w')
+        create_xrmmap(h5root)
+        h5root.close()
+        xmap = GSEXRM_MapFile(filename=fname, storage=storage)
+        self.maps.append(xmap)
+        xmap.flag_xrf, xmap.flag_xrd = True, False
+        xmap.npts = npts
+        xmap.pos_desc = ['fine x', 'fine y']
+        xmap.pos_addr = ['13XRM:m1', '13XRM:m2']
+        conf = xmap.xrmmap['config']
+        for name, val in (('offset', [-0.1]*NMCA), ('slope', [0.25]*NMCA),
+                          ('quad', [0.0]*NMCA)):
+            xmap.add_data(conf['mca_calib'], name, np.array(val))
+        xmap.add_data(conf['rois'], 'name', ['A', 'B', 'All'])
+        xmap.add_data(conf['rois'], 'address',
+                      ['dxp:mca%%i.R%i' % i for i in range(3)])
+        xmap.add_data(conf['rois'], 'limits', np.array(ROI_LIMITS))
+        xmap.xrmmap.attrs['N_Detectors'] = NMCA
+
+        rows = []
+        for irow in range(nrows):
+            xrffile, xpsfile, sisfile = write_raw_row(self.folder, irow,
+                                                      npts, **kws)
+            rows.append(GSEXRM_MapRow(0.1*irow, xrffile, '', xpsfile,
+                                      sisfile, self.folder, npts=npts,
+                                      irow=irow, reverse=(irow % 2 != 0)))
+            self.assertTrue(rows[-1].read_ok)
+        xmap.build_schema(rows[0])
+        if nlevels is not None:
+            xmap.build_pyramid(nlevels=nlevels)
+        for row in rows:
+            xmap.add_rowdata(row, verbose=False)
+        xmap.resize_arrays(nrows)
+        return xmap, rows
+
+    def test_detsum_dtype(self):
+        "detector sums are stored with the counts data type of the policy"
+        from larch_plugins.xrmmap import get_storage_policy
+        policy = get_storage_policy(counts_dtype='int32')
+        xmap, rows = self.make_map(nrows=2, storage=policy, scale=2.e4,
+                                   rtime=1.0)
+        detsum = xmap.xrmmap['detsum/counts']
+        self.assertEqual(detsum.dtype, np.int32)
+        for irow, row in enumerate(rows):
+            total = np.zeros(row.total.shape, dtype='float32')
+            for idet in range(NMCA):
+                counts = xmap.xrmmap['det%i/counts' % (idet+1)][irow]
+                self.assertTrue(np.all(counts == row.counts[idet]))
+                total += counts*row.dtfactor[idet][:, np.newaxis]
+            self.assertTrue(total.max() > 40000)
+            self.assertTrue(np.allclose(detsum[irow], total, rtol=0, atol=1))
+
+    def check_roimaps(self, xmap, names, limits):
+        """check the roimap arrays for ROIs against sums of the detector
+        counts over the [left, right) channel limits for each detector"""
+        roimap = xmap.xrmmap['roimap']
+        det_names = [n.lower() for n in roimap['det_name']]
+        sum_names = [n.lower() for n in roimap['sum_name']]
+        for name, lims in zip(names, limits):
+            sum_raw, sum_cor = 0.0, 0.0
+            for idet, (lo, hi) in enumerate(lims):
+                grp = xmap.xrmmap['det%i' % (idet+1)]
+                raw = grp['counts'][:, :, lo:hi].sum(axis=2)
+                cor = raw*grp['dtfactor'][:]
+                icol = det_names.index(('%s (mca%i)' % (name, idet+1)).lower())
+                self.assertTrue(np.all(roimap['det_raw'][:, :, icol] == raw))
+                self.assertTrue(np.allclose(roimap['det_cor'][:, :, icol], cor,
+                                            rtol=1.e-6))
+                sum_raw, sum_cor = sum_raw + raw, sum_cor + cor
+            icol = sum_names.index(name.lower())
+            self.assertTrue(np.all(roimap['sum_raw'][:, :, icol] == sum_raw))
+            self.assertTrue(np.allclose(roimap['sum_cor'][:, :, icol], sum_cor,
+                                        rtol=1.e-6))
+            self.assertTrue(np.allclose(xmap.get_roimap(name), sum_cor[:, 1:-1],
+                                        rtol=1.e-6))
+
+    def test_roimaps(self):
+        "ROI maps of added rows are sums of the counts over the ROIs"
+        xmap, rows = self.make_map(nrows=6, npts=20)
+        self.check_roimaps(xmap, ['A', 'B', 'All'], ROI_LIMITS)
+        # scalers are stored as read
+        roimap = xmap.xrmmap['roimap']
+        for irow, row in enumerate(rows):
+            self.assertTrue(np.all(roimap['det_raw'][irow, :, :NSIS] ==
+                                   row.sisdata[:20]))
+
+    def test_add_rois(self):
+        "ROI maps added to a map file are sums of the counts over the ROIs"
+        xmap, rows = self.make_map(nrows=6, npts=20, nlevels=1)
+        dets = xmap._mca_dets()
+        rois = [('C', 2.0, 4.5), ('D', 8.0, 12.0), ('A', 1.0, 1.5)]
+        limits = [xmap._roi_limits(dets, low, high) for name, low, high in rois]
+        # limits of channels with energies in [low, high]
+        energy = xmap.xrmmap['det1/energy'][:]
+        self.assertTrue(energy[limits[0][0][0]] >= 2.0 > energy[limits[0][0][0]-1])
+        self.assertTrue(energy[limits[0][0][1]-1] <= 4.5 < energy[limits[0][0][1]])
+
+        # an existing ROI is kept without overwrite
+        xmap.add_rois(rois, nworkers=1)
+        self.check_roimaps(xmap, ['A', 'B', 'All', 'C', 'D'],
+                           ROI_LIMITS + limits[:2])
+        xmap.add_rois(rois[2:], overwrite=True, nworkers=3)
+        self.check_roimaps(xmap, ['A', 'B', 'All', 'C', 'D'],
+                           limits[2:] + ROI_LIMITS[1:] + limits[:2])
+        names = list(xmap.xrmmap['config/rois/name'])
+        self.assertEqual(names, ['A', 'B', 'All', 'C', 'D'])
+        self.assertTrue(np.all(xmap.xrmmap['config/rois/limits'][:] ==
+                               np.array(limits[2:] + ROI_LIMITS[1:] + limits[:2])))
+        # the pyramid levels are rebuilt for the new ROI maps
+        pyr = xmap.xrmmap['pyramid/level1']
+        self.assertTrue(np.allclose(pyr['sum_cor'][:],
+                                    bin_sums(xmap.xrmmap['roimap/sum_cor'][:, 1:-1],
+                                             2)))
+
+    def test_counts_index(self):
+        "MCA spectra of rectangles and areas from the counts index"
+        xmap, rows = self.make_map(nrows=6, npts=20)
+        total = self.dtcor_counts(xmap)
+        raw1 = xmap.xrmmap['det1/counts'][:]
+        rects = [(0, 6, 0, 20), (1, 5, 3, 17), (0, 2, 4, 8), (2, 3, 1, 19),
+                 (1, 6, 0, 5)]
+        area = np.zeros((6, 20), dtype=bool)
+        area[1:5, 2:13] = True
+        area[2, 5] = False
+        for det, dtcorrect, ref in ((None, True, total), (1, False, raw1)):
+            index = xmap.build_counts_index(det=det, dtcorrect=dtcorrect,
+                                            tilesize=2)
+            self.assertEqual(index.shape, (4, 11, NCHAN))
+            for ymin, ymax, xmin, xmax in rects:
+                direct = ref[ymin:ymax, xmin:xmax].sum(axis=(0, 1))
+                counts = xmap.get_counts_rect(ymin, ymax, xmin, xmax, det=det,
+                                              dtcorrect=dtcorrect)
+                self.assertTrue(np.allclose(counts, direct, rtol=1.e-6))
+                counts = xmap._counts_rect_indexed(index, ymin, ymax, xmin,
+                                                   xmax, det=det,
+                                                   dtcorrect=dtcorrect)
+                if ymax - ymin >= 4 and xmax - xmin >= 4:
+                    self.assertTrue(counts is not None)
+                if counts is not None:
+                    self.assertTrue(np.allclose(counts, direct, rtol=1.e-6))
+            direct = ref[area].sum(axis=0)
+            counts = xmap._counts_rect_indexed(index, 0, 6, 0, 20, det=det,
+                                               area=area, dtcorrect=dtcorrect)
+            self.assertTrue(np.allclose(counts, direct, rtol=1.e-6))
+            counts = xmap.get_counts_rect(0, 6, 0, 20, det=det, area=area,
+                                          dtcorrect=dtcorrect, use_index=False)
+            self.assertTrue(np.allclose(counts, direct, rtol=1.e-6))
+
+    def dtcor_counts(self, xmap):
+        "dead-time corrected counts (nrows, npts, nchan), summed over detectors"
+        total = 0.0
+        for idet in range(NMCA):
+            grp = xmap.xrmmap['det%i' % (idet+1)]
+            total = total + grp['counts'][:]*grp['dtfactor'][:][:, :, np.newaxis]
+        return total
+
+    def pyramid_arrays(self, xmap):
+        "copies of all pyramid level arrays"
+        pyr = xmap.xrmmap['pyramid']
+        return dict([((level, name), pyr['level%i/%s' % (level, name)][:])
+                     for level in range(1, pyr.attrs['nlevels']+1)
+                     for name in ('counts', 'det_raw', 'det_cor',
+                                  'sum_raw', 'sum_cor')])
+
+    def test_pyramid(self):
+        "pyramid levels hold sums of the full resolution maps in each bin"
+        xmap, rows = self.make_map(nrows=6, npts=20, nlevels=2)
+        pyr = xmap.xrmmap['pyramid']
+        self.assertEqual(pyr.attrs['nrows'], 6)
+        total = self.dtcor_counts(xmap)[:, 1:-1]
+        roimap = xmap.xrmmap['roimap']
+        for level in (1, 2):
+            grp = pyr['level%i' % level]
+            self.assertTrue(np.allclose(grp['counts'][:],
+                                        bin_sums(total, 2**level), rtol=1.e-5))
+            for name in ('det_raw', 'det_cor', 'sum_raw', 'sum_cor'):
+                self.assertTrue(np.allclose(grp[name][:],
+                                            bin_sums(roimap[name][:, 1:-1],
+                                                     2**level)))
+        # the levels built from the file match those built row by row
+        added = self.pyramid_arrays(xmap)
+        xmap.build_pyramid(nlevels=2)
+        for key, arr in self.pyramid_arrays(xmap).items():
+            self.assertTrue(np.allclose(arr, added[key], rtol=1.e-6))
+
+        # energy range maps are counts summed over the bins
+        energy = xmap.xrmmap['detsum/energy'][:]
+        lo, hi = np.searchsorted(energy, 2.0), np.searchsorted(energy, 5.0,
+                                                               side='right')
+        emap = xmap.get_mca_erange(emin=2.0, emax=5.0, size=(2, 5))
+        self.assertEqual(emap.shape, (2, 5))
+        self.assertTrue(np.allclose(emap, bin_sums(total[:, :, lo:hi].sum(axis=2),
+                                                   4), rtol=1.e-5))
+        # sums over all bins equal the full resolution sum
+        full = xmap.get_mca_erange(emin=2.0, emax=5.0)
+        self.assertEqual(full.shape, (6, 18))
+        self.assertTrue(np.allclose(emap.sum(), full.sum(), rtol=1.e-5))
+        # hot columns are only left out of the pyramid levels
+        self.assertEqual(xmap.get_mca_erange(emin=2.0, emax=5.0, size=(2, 5),
+                                             no_hotcols=False).shape, (6, 20))
+        rmap = xmap.get_roimap('A', size=(3, 9))
+        self.assertEqual(rmap.shape, (3, 9))
+        self.assertTrue(np.allclose(rmap.sum(), xmap.get_roimap('A').sum()))
+        self.assertEqual(xmap.get_roimap('A', size=(3, 9),
+                                         no_hotcols=False).shape, (6, 20))
+
+    def test_pyramid_readd(self):
+        "adding a row again replaces it in the pyramid levels"
+        xmap, rows = self.make_map(nrows=6, npts=20, nlevels=2)
+        added = self.pyramid_arrays(xmap)
+        for irow in (3, 4):
+            xmap.last_row = irow - 1
+            xmap.add_rowdata(rows[irow], verbose=False)
+        self.assertEqual(xmap.xrmmap['pyramid'].attrs['nrows'], 6)
+        for key, arr in self.pyramid_arrays(xmap).items():
+            self.assertTrue(np.allclose(arr, added[key], rtol=1.e-6))
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestXRMMap, TestXRMMapFile):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=2).run(suite)